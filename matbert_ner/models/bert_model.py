@@ -2,7 +2,7 @@ import numpy as np
 import torch
 import torch.nn as nn
 from transformers import AutoConfig
-from transformers import BertTokenizer
+from transformers import BertTokenizerFast
 from transformers.models.bert.modeling_bert import BertModel, BertPreTrainedModel
 from matbert_ner.models.crf_layer import CRF
 from matbert_ner.models.valid_sequence_output import valid_sequence_output
@@ -12,23 +12,27 @@ class BERTNER(BertPreTrainedModel):
     '''
     An BERT model with additional layers for a downstream NER task
     '''
-    def __init__(self, model_file, classes, scheme, seed=None):
+    def __init__(self, model_file, classes, scheme, seed=None, constrained_crf=False, config=None, tokenizer=None, pretrained=True):
         '''
         Initializes the BERT NER model
             Arguments:
-                model_file: Path to the pretrained BERT model
+                model_file: Path to the pretrained BERT model (may be None if a config and tokenizer are provided and pretrained is False)
                 classes: A list of classes (labels)
                 scheme: The labeling scheme e.g. IOB1, IOB2, or IOBES
                 seed: Random seed for parameter initialization
+                constrained_crf: Boolean controlling whether invalid CRF transitions are hard constraints instead of penalties
+                config: Optional BERT configuration (loaded from the model file if not provided)
+                tokenizer: Optional BERT tokenizer e.g. the one already loaded by NERData (loaded from the model file if not provided)
+                pretrained: Boolean controlling whether the pretrained BERT weights are loaded (set False when a fine-tuned state will overwrite them)
             Returns:
                 BERTNER model
         '''
         # model file
         self.model_file = model_file
         # generate configuration from file
-        self.config = AutoConfig.from_pretrained(self.model_file)
+        self.config = config if config is not None else AutoConfig.from_pretrained(self.model_file)
         # initialize tokenizer from file
-        self.tokenizer = BertTokenizer.from_pretrained(self.model_file)
+        self.tokenizer = tokenizer if tokenizer is not None else BertTokenizerFast.from_pretrained(self.model_file)
         # initialize pretrained BERT model parent class
         super(BERTNER, self).__init__(self.config)
         # classes
@@ -37,15 +41,17 @@ class BERTNER(BertPreTrainedModel):
         self.scheme = scheme
         # seed for parameter initialization
         self.seed = seed
+        # hard CRF constraints
+        self.constrained_crf = constrained_crf
         # build model layers
-        self.build_model()
+        self.build_model(pretrained=pretrained)
     
 
-    def build_model(self):
+    def build_model(self, pretrained=True):
         '''
         Builds BERT NER model layers
             Arguments:
-                None
+                pretrained: Boolean controlling whether the BERT weights are loaded from the pretrained model file instead of only built from the configuration
             Returns:
                 None
         '''
@@ -54,19 +60,34 @@ class BERTNER(BertPreTrainedModel):
             torch.manual_seed(self.seed)
             torch.cuda.manual_seed(self.seed)
             np.random.seed(self.seed)
-        # initialize BERT model from file
-        self.bert = BertModel(self.config).from_pretrained(self.model_file)
+        # initialize BERT model from file (loaded once) or from the configuration alone
+        if pretrained:
+            self.bert = BertModel.from_pretrained(self.model_file, config=self.config)
+        else:
+            self.bert = BertModel(self.config)
         # dropout layer for bert output
         self.dropout = nn.Dropout(self.config.hidden_dropout_prob)
+        # classification and CRF output layers
+        self.build_classifier()
+
+
+    def build_classifier(self):
+        '''
+        Builds the classification and CRF output layers for the current classes (e.g. after the classes change)
+            Arguments:
+                None
+            Returns:
+                None
+        '''
         # dense classification layer
         self.classifier = nn.Linear(self.config.hidden_size, len(self.classes))
         # CRF output layer
-        self.crf = CRF(classes=self.classes, scheme=self.scheme, batch_first=True)
+        self.crf = CRF(classes=self.classes, scheme=self.scheme, batch_first=True, constrained=self.constrained_crf)
         # initialize CRF with seed
         self.crf.initialize(self.seed)
     
 
-    def forward(self, input_ids, label_ids=None, attention_mask=None, valid_mask=None, return_logits=False, device='cpu'):
+    def forward(self, input_ids, label_ids=None, attention_mask=None, valid_mask=None, valid_index=None, return_logits=False, decode=True, device='cpu'):
         '''
         BERT NER forward call function
             Arguments:
@@ -74,7 +95,9 @@ class BERTNER(BertPreTrainedModel):
                 label_ids: Batch of label ids
                 attention_mask: Batch of attention masks
                 valid_mask: Batch of valid masks
+                valid_index: Optional precomputed compaction indices and lengths from valid_sequence_index
                 return_logits: Boolean controlling whether logits are returned
+                decode: Boolean controlling whether the Viterbi decode is run (prediction_ids are None otherwise)
                 device: Device used for computation
             Returns:
                 always returns prediction_ids
@@ -90,13 +113,16 @@ class BERTNER(BertPreTrainedModel):
         # final hidden layer
         sequence_output = outputs[0]
         # valid outputs
-        sequence_output, label_ids, attention_mask = valid_sequence_output(sequence_output, label_ids, attention_mask, valid_mask, device)
+        sequence_output, label_ids, attention_mask = valid_sequence_output(sequence_output, label_ids, attention_mask, valid_mask, device, valid_index)
         # dropout on valid hidden layer output
         sequence_output = self.dropout(sequence_output)
         # classification logits
         logits = self.classifier(sequence_output)
-        # prediction ids from Viterbi decode
-        prediction_ids = self.crf.decode(logits, mask=attention_mask)
+        # prediction ids from Viterbi decode (padded tensor, zero beyond the valid length of each sequence)
+        if decode:
+            prediction_ids, _ = self.crf.decode(logits, mask=attention_mask)
+        else:
+            prediction_ids = None
         # if labels are provided, calculate loss
         if label_ids is not None:
             label_ids = label_ids.type(torch.long)
@@ -7,13 +7,14 @@ class CRF(nn.Module):
     '''
     Module implementing a conditional random field (CRF) output layer with the capacity for initializing transitions sensitive to the provided labeling scheme
     '''
-    def __init__(self, classes, scheme, batch_first):
+    def __init__(self, classes, scheme, batch_first, constrained=False):
         '''
         Initializes the CRF module
             Arguments:
                 classes: A list of classes (labels)
                 scheme: The labeling scheme e.g. IOB1, IOB2, or IOBES
                 batch_first: If True, the batch index is the first dimension as opposed to the last
+                constrained: If True, invalid transitions are excluded from the loss and decoding entirely (hard constraints) rather than penalized
             Returns:
                 CRF module object
         '''
@@ -24,6 +25,10 @@ class CRF(nn.Module):
         self.prefixes = set([class_.split('-')[0] for class_ in self.classes])
         # labeling scheme
         self.scheme = scheme
+        # hard constraints
+        self.constrained = constrained
+        # static (non-learnable) score for invalid starts and ends under hard constraints
+        self.mask_value = -10000.0
         # initialize CRF
         self.crf = torchcrf.CRF(num_tags=len(self.classes), batch_first=batch_first)
     
@@ -46,6 +51,9 @@ class CRF(nn.Module):
         if len(self.classes) > 1:
             # construct definitions of invalid transitions
             self.define_invalid_crf_transitions()
+        # construct allowed transition structure
+        self.init_crf_structure()
+        if len(self.classes) > 1:
             # initialize transitions
             self.init_crf_transitions()
     
@@ -58,7 +66,7 @@ class CRF(nn.Module):
             Returns:
                 None
         '''
-        if self.scheme == 'IOB':
+        if self.scheme in ['IOB', 'IOB1']:
             # (B)eginning (I)nside (O)utside
             # must begin with O (outside) due to [CLS] token
             self.invalid_begin = ('B', 'I')
@@ -102,6 +110,46 @@ class CRF(nn.Module):
                                              'I': 'IE'}
     
 
+    def init_crf_structure(self):
+        '''
+        Constructs hard masks for the allowed starts, ends, and transitions as dictated by the labeling scheme alongside a sparse index of the allowed previous tags for each tag
+            Arguments:
+                None
+            Returns:
+                None
+        '''
+        num_tags = len(self.classes)
+        # prefixes and types for each class
+        prefixes = np.array([class_.split('-')[0] for class_ in self.classes])
+        types = np.array([class_.split('-')[1] if '-' in class_ else '' for class_ in self.classes])
+        # everything is allowed for a single class
+        allowed_start = np.ones(num_tags, dtype=bool)
+        allowed_end = np.ones(num_tags, dtype=bool)
+        allowed_transitions = np.ones((num_tags, num_tags), dtype=bool)
+        if num_tags > 1:
+            # bad beginnings and endings
+            allowed_start &= ~np.isin(prefixes, self.invalid_begin)
+            allowed_end &= ~np.isin(prefixes, self.invalid_end)
+            # invalid consecutive labels by position
+            for from_label, to_label_list in self.invalid_transitions_position.items():
+                allowed_transitions[np.outer(prefixes == from_label, np.isin(prefixes, list(to_label_list)))] = False
+            # invalid consecutive labels by label
+            for from_label, to_label_list in self.invalid_transitions_tags.items():
+                allowed_transitions[np.outer(prefixes == from_label, np.isin(prefixes, list(to_label_list))) & (types[:, None] != types[None, :])] = False
+        # sparse index of allowed previous tags for each tag, padded to the maximum number of allowed previous tags
+        max_degree = max(1, int(allowed_transitions.sum(axis=0).max()))
+        from_index = np.zeros((num_tags, max_degree), dtype=np.int64)
+        from_mask = np.zeros((num_tags, max_degree), dtype=bool)
+        for j in range(num_tags):
+            index = np.nonzero(allowed_transitions[:, j])[0]
+            from_index[j, :len(index)] = index
+            from_mask[j, :len(index)] = True
+        # store as (non-persistent) buffers so that they follow the module across devices without entering the state dictionary
+        for name, value in [('allowed_start', allowed_start), ('allowed_end', allowed_end), ('allowed_transitions', allowed_transitions),
+                            ('from_index', from_index), ('from_mask', from_mask)]:
+            self.register_buffer(name, torch.from_numpy(value).to(self.crf.transitions.device), persistent=False)
+
+
     def init_crf_transitions(self, penalty=-10000):
         '''
         Initializes CRF transitions according to invalid transitions as dictating by the labeling scheme
@@ -110,47 +158,144 @@ class CRF(nn.Module):
             Returns:
                 None
         '''
+        with torch.no_grad():
+            # penalize bad beginnings and endings
+            self.crf.start_transitions.masked_fill_(~self.allowed_start, penalty)
+            self.crf.end_transitions.masked_fill_(~self.allowed_end, penalty)
+            # penalize invalid consecutive labels
+            self.crf.transitions.masked_fill_(~self.allowed_transitions, penalty)
+
+
+    def potentials(self):
+        '''
+        Retrieves the start, end, and transition scores, applying the hard masks if constrained
+            Arguments:
+                None
+            Returns:
+                start scores, end scores, transition scores
+        '''
+        if self.constrained:
+            return (self.crf.start_transitions.masked_fill(~self.allowed_start, self.mask_value),
+                    self.crf.end_transitions.masked_fill(~self.allowed_end, self.mask_value),
+                    self.crf.transitions.masked_fill(~self.allowed_transitions, self.mask_value))
+        else:
+            return self.crf.start_transitions, self.crf.end_transitions, self.crf.transitions
+
+
+    def sparse_transitions(self):
+        '''
+        Retrieves the transition scores from the allowed previous tags into each tag (padding is negative infinity)
+            Arguments:
+                None
+            Returns:
+                Sparse transition scores with shape (num_tags, max number of allowed previous tags)
+        '''
         num_tags = len(self.classes)
-        # penalize bad beginnings and endings
-        for i in range(num_tags):
-            class_ = self.classes[i]
-            if class_.split('-')[0] in self.invalid_begin:
-                torch.nn.init.constant_(self.crf.start_transitions[i], penalty)
-            if class_.split('-')[0] in self.invalid_end:
-                torch.nn.init.constant_(self.crf.end_transitions[i], penalty)
-        # build label type dictionary
-        label_is = {}
-        for label_position in self.prefixes:
-            label_is[label_position] = [i for i, class_ in enumerate(self.classes) if class_.split('-')[0] == label_position]
-        # penalties for invalid consecutive labels by position
-        for from_label, to_label_list in self.invalid_transitions_position.items():
-            to_labels = list(to_label_list)
-            for from_label_i in label_is[from_label]:
-                for to_label in to_labels:
-                    for to_label_i in label_is[to_label]:
-                        torch.nn.init.constant_(self.crf.transitions[from_label_i, to_label_i], penalty)
-        # penalties for invalid consecutive labels by label
-        for from_label, to_label_list in self.invalid_transitions_tags.items():
-            to_labels = list(to_label_list)
-            for from_label_i in label_is[from_label]:
-                for to_label in to_labels:
-                    for to_label_i in label_is[to_label]:
-                        if self.classes[from_label_i].split('-')[1] != self.classes[to_label_i].split('-')[1]:
-                            torch.nn.init.constant_(self.crf.transitions[from_label_i, to_label_i], penalty)
-    
+        sparse_transitions = self.crf.transitions[self.from_index, torch.arange(num_tags, device=self.from_index.device).unsqueeze(1)]
+        return sparse_transitions.masked_fill(~self.from_mask, float('-inf'))
+
+
+    def compute_score(self, emissions, labels, mask):
+        '''
+        Calculates the scores of labeled sequences under the hard constraints
+            Arguments:
+                emissions: Sequence logits (batch first)
+                labels: Sequence ground truth labels (batch first)
+                mask: Mask for valid classification targets (batch first)
+            Returns:
+                Sequence scores
+        '''
+        start, end, transitions = self.potentials()
+        mask = mask.to(emissions.dtype)
+        # start scores
+        score = start[labels[:, 0]]
+        # emission scores
+        score = score+(emissions.gather(2, labels.unsqueeze(2)).squeeze(2)*mask).sum(dim=1)
+        # transition scores
+        score = score+(transitions[labels[:, :-1], labels[:, 1:]]*mask[:, 1:]).sum(dim=1)
+        # end scores
+        last_labels = labels.gather(1, (mask.long().sum(dim=1)-1).unsqueeze(1)).squeeze(1)
+        return score+end[last_labels]
+
+
+    def compute_normalizer(self, emissions, mask):
+        '''
+        Calculates the log-partition function with the forward algorithm over allowed transitions only
+            Arguments:
+                emissions: Sequence logits (batch first)
+                mask: Mask for valid classification targets (batch first)
+            Returns:
+                Sequence log-partition values
+        '''
+        start, end, _ = self.potentials()
+        sparse_transitions = self.sparse_transitions()
+        # start scores and first emissions
+        score = start+emissions[:, 0]
+        for i in range(1, emissions.size(1)):
+            # sum (log-sum-exp) over the allowed previous tags for each tag
+            next_score = torch.logsumexp(score[:, self.from_index]+sparse_transitions, dim=2)+emissions[:, i]
+            # only update scores for valid timesteps
+            score = torch.where(mask[:, i].unsqueeze(1), next_score, score)
+        # end scores
+        return torch.logsumexp(score+end, dim=1)
+
 
     def decode(self, emissions, mask):
         '''
-        Decodes emmissions (logits) given a mask using a Viterbi decoder
+        Decodes emmissions (logits) given a mask using a batched Viterbi decoder
             Arguments:
                 emissions: Sequence logits
-                mask: Mask for valid classification targets
+                mask: Mask for valid classification targets (must be contiguous from the first timestep)
             Returns:
-                Most probable output sequence
+                Most probable output sequences as a padded tensor (zero beyond each sequence length), sequence lengths
         '''
-        # verterbi decode logits (emissions) using valid attention mask
-        crf_out = self.crf.decode(emissions, mask=mask)
-        return crf_out
+        # use batch first ordering
+        if not self.crf.batch_first:
+            emissions = emissions.transpose(0, 1)
+            mask = mask.transpose(0, 1)
+        mask = mask.bool()
+        batch_size, seq_length, num_tags = emissions.shape
+        # sequence lengths
+        lengths = mask.long().sum(dim=1)
+        # start, end, and transition scores
+        start, end, transitions = self.potentials()
+        if self.constrained:
+            sparse_transitions = self.sparse_transitions()
+        # start transitions and first emissions
+        score = start+emissions[:, 0]
+        # best previous tags for every timestep after the first
+        history = []
+        # max-product recursion over timesteps for all sequences and tags at once
+        for i in range(1, seq_length):
+            if self.constrained:
+                # score for every (allowed previous tag, next tag) pair
+                next_score, indices = (score[:, self.from_index]+sparse_transitions).max(dim=2)
+                # map back from the sparse index to the previous tags
+                indices = self.from_index[torch.arange(num_tags, device=emissions.device).unsqueeze(0), indices]
+                next_score = next_score+emissions[:, i]
+            else:
+                # score for every (previous tag, next tag) pair
+                next_score, indices = (score.unsqueeze(2)+transitions+emissions[:, i].unsqueeze(1)).max(dim=1)
+            # only update scores for valid timesteps
+            score = torch.where(mask[:, i].unsqueeze(1), next_score, score)
+            history.append(indices)
+        # end transitions
+        score = score+end
+        # best last tags
+        _, best_last = score.max(dim=1)
+        # backtrack for all sequences at once
+        tags = torch.zeros(batch_size, seq_length, dtype=torch.long, device=emissions.device)
+        current = best_last
+        for i in range(seq_length-1, -1, -1):
+            # sequences ending at this timestep start from their best last tag
+            current = torch.where(lengths-1 == i, best_last, current)
+            tags[:, i] = current
+            # step back to the best previous tags
+            if i > 0:
+                current = history[i-1].gather(1, current.unsqueeze(1)).squeeze(1)
+        # zero out timesteps beyond each sequence length
+        tags = tags.masked_fill(~mask, 0)
+        return tags, lengths
 
 
     def forward(self, emissions, labels, mask, reduction='token_mean'):
@@ -166,5 +311,23 @@ class CRF(nn.Module):
         '''
         # calculate loss with forward pass of crf given logits (emissions) and valid attention mask
         # loss is mean over tokens
-        crf_loss = self.crf(emissions, tags=labels, mask=mask, reduction=reduction)
-        return crf_loss
+        if not self.constrained:
+            crf_loss = self.crf(emissions, tags=labels, mask=mask, reduction=reduction)
+            return crf_loss
+        # use batch first ordering
+        if not self.crf.batch_first:
+            emissions = emissions.transpose(0, 1)
+            labels = labels.transpose(0, 1)
+            mask = mask.transpose(0, 1)
+        mask = mask.bool()
+        # log likelihood restricted to allowed transitions
+        llh = self.compute_score(emissions, labels, mask)-self.compute_normalizer(emissions, mask)
+        # reduce consistently with torchcrf
+        if reduction == 'none':
+            return llh
+        elif reduction == 'sum':
+            return llh.sum()
+        elif reduction == 'mean':
+            return llh.mean()
+        else:
+            return llh.sum()/mask.to(emissions.dtype).sum()
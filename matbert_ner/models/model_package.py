@@ -0,0 +1,111 @@
+import os
+import json
+import struct
+import tempfile
+import numpy as np
+import torch
+from transformers import BertConfig, BertTokenizerFast
+from matbert_ner.models.bert_model import BERTNER
+
+
+# package format version (bump whenever a change alters the stored contents)
+package_version = 1
+# safetensors dtype names of the storage types
+dtype_names = {np.dtype(np.float64): 'F64', np.dtype(np.float32): 'F32', np.dtype(np.float16): 'F16',
+               np.dtype(np.int64): 'I64', np.dtype(np.int32): 'I32', np.dtype(np.int16): 'I16', np.dtype(np.int8): 'I8',
+               np.dtype(np.uint8): 'U8', np.dtype(np.bool_): 'BOOL'}
+name_dtypes = {name: dtype for dtype, name in dtype_names.items()}
+# the data section starts at a multiple of this many bytes
+alignment = 8
+
+
+def save_package(package_path, model, tokenizer):
+    '''
+    Saves an inference package (configuration, tokenizer, classes, labeling scheme, and fine-tuned weights) as a single file in the safetensors layout:
+    an 8-byte little-endian header size, a JSON header with the metadata and the dtype, shape, and data offsets of every tensor, and the raw tensor data
+        Arguments:
+            package_path: Path to save the package to
+            model: BERTNER model (with fine-tuned weights)
+            tokenizer: BERT tokenizer used for the model inputs
+        Returns:
+            None
+    '''
+    # tokenizer files are stored as text in the metadata
+    with tempfile.TemporaryDirectory() as tokenizer_dir:
+        tokenizer.save_pretrained(tokenizer_dir)
+        tokenizer_files = {}
+        for name in os.listdir(tokenizer_dir):
+            with open(os.path.join(tokenizer_dir, name), 'r', encoding='utf-8') as f:
+                tokenizer_files[name] = f.read()
+    # the safetensors metadata is a mapping of strings to strings
+    metadata = {'format': 'pt', 'matbert_ner_version': str(package_version),
+                'config': model.config.to_json_string(), 'tokenizer': json.dumps(tokenizer_files),
+                'classes': json.dumps(model.classes), 'scheme': model.scheme, 'constrained_crf': json.dumps(model.constrained_crf)}
+    # contiguous cpu arrays of the model parameters (ordered by decreasing item size so every tensor is aligned without gaps)
+    arrays = {name: np.ascontiguousarray(tensor.detach().cpu().numpy()) for name, tensor in model.state_dict().items()}
+    arrays = dict(sorted(arrays.items(), key=lambda item: (-item[1].dtype.itemsize, item[0])))
+    header = {'__metadata__': metadata}
+    offset = 0
+    for name, array in arrays.items():
+        header[name] = {'dtype': dtype_names[array.dtype], 'shape': list(array.shape), 'data_offsets': [offset, offset+array.nbytes]}
+        offset += array.nbytes
+    header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    # pad the header with spaces so that the tensor data is aligned
+    header_bytes += b' '*(-(8+len(header_bytes)) % alignment)
+    # write to a temporary file and move it into place so that readers never see a partial package
+    package_dir = os.path.dirname(os.path.abspath(package_path))
+    fd, tmp_path = tempfile.mkstemp(dir=package_dir, prefix='.tmp_package_')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+        for array in arrays.values():
+            f.write(array.tobytes())
+    os.replace(tmp_path, package_path)
+
+
+def read_package(package_path):
+    '''
+    Reads the metadata of a package and memory-maps its tensors (the weights are only paged in from disk as they are used)
+        Arguments:
+            package_path: Path to the package
+        Returns:
+            metadata, dictionary of tensors by parameter name
+    '''
+    with open(package_path, 'rb') as f:
+        header_size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_size).decode('utf-8'))
+    metadata = header.pop('__metadata__', {})
+    if int(metadata.get('matbert_ner_version', -1)) != package_version:
+        raise ValueError('Unsupported package version in {}'.format(package_path))
+    # copy-on-write map of the data section (writable for torch without copying the file into memory)
+    data = np.asarray(np.memmap(package_path, dtype=np.uint8, mode='c', offset=8+header_size))
+    tensors = {}
+    for name, info in header.items():
+        begin, end = info['data_offsets']
+        tensors[name] = torch.from_numpy(data[begin:end].view(name_dtypes[info['dtype']]).reshape(info['shape']))
+    return metadata, tensors
+
+
+def load_package(package_path, device='cpu', seed=None):
+    '''
+    Loads a model and tokenizer from a package, instantiating the model from the stored configuration (no pretrained weights are loaded)
+        Arguments:
+            package_path: Path to the package
+            device: Computation device
+            seed: Random seed for parameter initialization (overwritten by the stored weights)
+        Returns:
+            BERTNER model, BERT tokenizer
+    '''
+    metadata, tensors = read_package(package_path)
+    # reconstruct the tokenizer from its stored files
+    with tempfile.TemporaryDirectory() as tokenizer_dir:
+        for name, contents in json.loads(metadata['tokenizer']).items():
+            with open(os.path.join(tokenizer_dir, name), 'w', encoding='utf-8') as f:
+                f.write(contents)
+        tokenizer = BertTokenizerFast.from_pretrained(tokenizer_dir)
+    config = BertConfig.from_dict(json.loads(metadata['config']))
+    model = BERTNER(model_file=None, classes=json.loads(metadata['classes']), scheme=metadata['scheme'], seed=seed,
+                    constrained_crf=json.loads(metadata['constrained_crf']), config=config, tokenizer=tokenizer, pretrained=False)
+    model.load_state_dict(tensors)
+    model.to(device)
+    return model, tokenizer
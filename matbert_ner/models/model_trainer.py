@@ -1,13 +1,12 @@
 import copy
+from itertools import chain
 import numpy as np
 from tqdm import tqdm
 import torch
 from torch.optim.lr_scheduler import LambdaLR
-from transformers import AdamW
-from torchtools.optim import RangerLars, Ralamb, Ranger, Novograd, RAdam, Lamb, Lookahead
-from seqeval.scheme import IOB1, IOB2, IOBES
-from seqeval.metrics import accuracy_score, classification_report
 import json
+from matbert_ner.models.valid_sequence_output import valid_sequence_index, valid_sequence_gather
+from matbert_ner.models.model_package import save_package
 
 
 class NpEncoder(json.JSONEncoder):
@@ -65,16 +64,158 @@ class StateCacher(object):
         return self.cached.get(key)
 
 
+class MetricAccumulator(object):
+    '''
+    An object that incrementally accumulates strict entity-level counts, token accuracy counts, and losses over batches
+    '''
+    def __init__(self, scheme):
+        '''
+        Initializes the metric accumulator object
+            Arguments:
+                scheme: The seqeval labeling scheme used to extract entities e.g. IOB1, IOB2, or IOBES
+            Returns:
+                None
+        '''
+        # labeling scheme
+        self.scheme = scheme
+        # initialize empty counts
+        self.reset()
+
+
+    def reset(self):
+        '''
+        Resets the accumulated counts
+            Arguments:
+                None
+            Returns:
+                None
+        '''
+        # dictionary of entity counts by tag: [true positives, predicted entities, true entities]
+        self.counts = {}
+        # token accuracy counts
+        self.n_correct = 0
+        self.n_tokens = 0
+        # loss sums
+        self.loss_sum = 0.0
+        self.n_losses = 0
+
+
+    def update(self, labels, predictions, loss=None):
+        '''
+        Updates the counts with a batch of labels and predictions
+            Arguments:
+                labels: List of label sequences
+                predictions: List of prediction sequences
+                loss: Optional batch loss
+            Returns:
+                None
+        '''
+        from seqeval.scheme import Entities
+        # update loss sums
+        self.update_loss(loss)
+        # extract strict entities with the seqeval scheme (entities never cross sequences, so batches can be counted independently)
+        entities_true = set(chain(*Entities(labels, self.scheme).entities))
+        entities_pred = set(chain(*Entities(predictions, self.scheme).entities))
+        # update true entity, predicted entity, and true positive counts by tag
+        for index, entities in ((2, entities_true), (1, entities_pred), (0, entities_true & entities_pred)):
+            for entity in entities:
+                self.counts.setdefault(entity.tag, [0, 0, 0])[index] += 1
+        # update token accuracy counts
+        for label, prediction in zip(labels, predictions):
+            self.n_correct += sum(l == p for l, p in zip(label, prediction))
+            self.n_tokens += len(label)
+
+
+    def update_loss(self, loss):
+        '''
+        Updates the loss sums with a batch loss
+            Arguments:
+                loss: Batch loss (ignored if None)
+            Returns:
+                None
+        '''
+        if loss is not None:
+            self.loss_sum += loss
+            self.n_losses += 1
+
+
+    @staticmethod
+    def scores(tp, pred, true):
+        '''
+        Calculates precision, recall, and f1-score from counts (zero divisions are set to zero)
+            Arguments:
+                tp: True positive count
+                pred: Predicted entity count
+                true: True entity count
+            Returns:
+                precision, recall, f1-score
+        '''
+        precision = tp/pred if pred > 0 else 0.0
+        recall = tp/true if true > 0 else 0.0
+        f1 = 2*precision*recall/(precision+recall) if precision+recall > 0 else 0.0
+        return precision, recall, f1
+
+
+    def summary(self):
+        '''
+        Summarizes the accumulated micro-averaged metrics
+            Arguments:
+                None
+            Returns:
+                Dictionary of precision, recall, f1-score, accuracy, and loss
+        '''
+        # micro averages over all tags
+        tp, pred, true = [sum(count[i] for count in self.counts.values()) for i in range(3)]
+        summary = dict(zip(['precision', 'recall', 'f1-score'], self.scores(tp, pred, true)))
+        summary['accuracy'] = self.n_correct/self.n_tokens if self.n_tokens > 0 else 0.0
+        summary['loss'] = self.loss_sum/self.n_losses if self.n_losses > 0 else 0.0
+        return summary
+
+
+    def report(self):
+        '''
+        Constructs a classification report matching seqeval's strict classification_report (output_dict=True) alongside accuracy and loss
+            Arguments:
+                None
+            Returns:
+                Dictionary of metrics by tag and averages
+        '''
+        # accumulated micro averages, accuracy, and loss
+        summary = self.summary()
+        # per-tag metrics
+        report = {}
+        for tag in sorted(self.counts.keys()):
+            tp, pred, true = self.counts[tag]
+            report[tag] = dict(zip(['precision', 'recall', 'f1-score'], self.scores(tp, pred, true)))
+            report[tag]['support'] = true
+        tags = list(report.keys())
+        support = sum(report[tag]['support'] for tag in tags)
+        # micro average
+        report['micro avg'] = {m: summary[m] for m in ['precision', 'recall', 'f1-score']}
+        # macro average (unweighted mean over tags)
+        report['macro avg'] = {m: np.mean([report[tag][m] for tag in tags]) if tags else np.nan for m in ['precision', 'recall', 'f1-score']}
+        # weighted average (weighted by tag support)
+        report['weighted avg'] = {m: np.sum([report[tag][m]*report[tag]['support'] for tag in tags])/support if support > 0 else 0.0 for m in ['precision', 'recall', 'f1-score']}
+        for average in ['micro avg', 'macro avg', 'weighted avg']:
+            report[average]['support'] = support
+        # add accuracy and loss to report
+        report['accuracy'] = summary['accuracy']
+        report['loss'] = summary['loss']
+        return report
+
+
 class NERTrainer(object):
     '''
     NER Trainer object for BERT NER
     '''
-    def __init__(self, model, device):
+    def __init__(self, model, device, batch_reports=False, metric_interval=1):
         '''
         Initializes NER Trainer
             Arguments:
                 model: Model to be trained
                 device: Computation device
+                batch_reports: Boolean controlling whether full per-batch classification reports are stored alongside the epoch metrics
+                metric_interval: Number of training batches between decoded (metric) batches, training reports only the loss if 0
             Returns:
                 NER Trainer object
         '''
@@ -94,15 +235,25 @@ class NERTrainer(object):
         self.scheduler = None
         # metric reporting mode
         self.metric_mode = 'strict'
-        # set metric scheme according to labeling scheme used by model
-        if self.model.scheme == 'IOB1':
-            self.metric_scheme = IOB1
-        elif self.model.scheme == 'IOB2':
-            self.metric_scheme = IOB2
-        elif self.model.scheme == 'IOBES':
-            self.metric_scheme = IOBES
+        # per-batch classification reports
+        self.batch_reports = batch_reports
+        # interval for decoding training batches to calculate metrics
+        self.metric_interval = metric_interval
         # past training epochs
         self.past_epoch = 0
+
+
+    @property
+    def metric_scheme(self):
+        '''
+        Seqeval metric scheme according to the labeling scheme used by the model (seqeval is only imported once metrics are calculated)
+            Arguments:
+                None
+            Returns:
+                Seqeval labeling scheme e.g. IOB1, IOB2, or IOBES
+        '''
+        from seqeval.scheme import IOB1, IOB2, IOBES
+        return {'IOB1': IOB1, 'IOB2': IOB2, 'IOBES': IOBES}.get(self.model.scheme)
     
 
     def save_state(self, state_path, optimizer=True):
@@ -135,10 +286,10 @@ class NERTrainer(object):
         '''
         # load checkpoint and map to device
         checkpoint = torch.load(state_path, map_location=torch.device(self.device))
-        # set classes in model
-        self.model.classes = checkpoint['classes']
-        # rebuild model layers
-        self.model.build_model()
+        # if the classes differ, set classes in model and rebuild the output layers (the BERT weights are overwritten by the state either way)
+        if list(checkpoint['classes']) != list(self.model.classes):
+            self.model.classes = checkpoint['classes']
+            self.model.build_classifier()
         # send model to device
         self.model.to(self.device)
         # load model parameters from state dictionary
@@ -148,6 +299,17 @@ class NERTrainer(object):
             self.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
 
 
+    def save_package(self, package_path):
+        '''
+        Saves the model as a single-file inference package (configuration, tokenizer, classes, labeling scheme, and weights)
+            Arguments:
+                package_path: Path to save the package to
+            Returns:
+                None
+        '''
+        save_package(package_path, self.model, self.model.tokenizer)
+
+
     def save_state_to_cache(self, key, optimizer=True):
         '''
         Saves state to cache
@@ -231,6 +393,9 @@ class NERTrainer(object):
             Returns:
                 None
         ''' 
+        # optimizers are imported on first use (not needed for evaluation or prediction)
+        from transformers import AdamW
+        from torchtools.optim import RangerLars, Ralamb, Ranger, Novograd, RAdam, Lamb, Lookahead
         # optimizer dict
         optimizer_options = optimizer_name.split('_')
         optimizer_name = optimizer_options[0]
@@ -294,52 +459,37 @@ class NERTrainer(object):
         '''
         Construct valid input ids, valid label ids, and valid attention masks
             Arguments:
-                inputs: BERTNER inputs
+                inputs: BERTNER inputs (reuses the compaction indices under valid_index if present)
             Returns:
-                Valid input ids, valid label ids, and valid attention masks as lists of NumPy arrays
+                Valid input ids, valid label ids, and valid attention masks as tensors
         '''
-        # size of arrays
-        batch_size, max_len = inputs['valid_mask'].shape
-        # initialize empty arrays
-        valid = {key: np.zeros((batch_size, max_len), dtype=int) for key in ['input_ids', 'label_ids', 'attention_mask']}
-        # for batch index
-        for i in range(batch_size):
-            # set valid index to 0
-            k = 0
-            # for sequence index
-            for j in range(max_len):
-                # if sequence index is valid
-                if inputs['valid_mask'][i][j].item() == 1:
-                    # assign valid values at (batch index, valid index) to input values at (batch index, sequence index)
-                    for key in valid.keys():
-                        valid[key][i, k] = inputs[key][i][j].item()
-                    # increment valid index
-                    k += 1
-        # return valid inputs
-        return tuple([list(valid[key]) for key in valid.keys()])
-    
+        # compaction indices (computed once per batch and shared with the model forward call)
+        valid_index = inputs.get('valid_index')
+        if valid_index is None:
+            valid_index = valid_sequence_index(inputs['valid_mask'])
+        # gather valid values to the front of each sequence
+        return tuple([valid_sequence_gather(inputs[key], *valid_index) for key in ['input_ids', 'label_ids', 'attention_mask']])
+
 
     def process_labels(self, inputs, prediction_ids):
         '''
         Process labels for metric evaluation accounting for invalid indices while filtering out [CLS] and [SEP] tokens
             Arguments:
                 inputs: BERTNER inputs
-                prediction_ids: BERTNER output predictions
+                prediction_ids: BERTNER output predictions (padded tensor aligned with the valid inputs)
             Returns:
                 Dictionary of valid labels and predictions
         '''
         # construct valid inputs
         valid_input_ids, valid_label_ids, valid_attention_mask = self.construct_valid_inputs(inputs)
-        # for sequence in batch
-        for i in range(len(valid_attention_mask)):
-            # identify padding indices
-            idx = np.where(valid_attention_mask[i] == 0)
-            # trim padding indices
-            valid_input_ids[i] = np.delete(valid_input_ids[i], idx, axis=0)
-            valid_label_ids[i] = np.delete(valid_label_ids[i], idx, axis=0)
-        # convert labels and predictions into classes given indices as long as the corresponding input ids do not correspond to [CLS] or [SEP]
-        labels = [[self.model.classes[vli] for vli, vii in zip(vlis, viis) if vii not in (self.cls_dict['id'], self.sep_dict['id'])] for vlis, viis in zip(valid_label_ids, valid_input_ids)]
-        predictions = [[self.model.classes[pi] for pi, vii in zip(pis, viis) if vii not in (self.cls_dict['id'], self.sep_dict['id'])] for pis, viis in zip(prediction_ids, valid_input_ids)]
+        # entries that are not padding and do not correspond to [CLS] or [SEP]
+        keep = valid_attention_mask & (valid_input_ids != self.cls_dict['id']) & (valid_input_ids != self.sep_dict['id'])
+        # boundaries between sequences in the flattened kept entries
+        bounds = np.cumsum(keep.sum(dim=1).cpu().numpy())[:-1]
+        # convert labels and predictions into classes given indices
+        classes = np.array(self.model.classes, dtype=object)
+        labels = [sequence.tolist() for sequence in np.split(classes[valid_label_ids[keep].long().cpu().numpy()], bounds)]
+        predictions = [sequence.tolist() for sequence in np.split(classes[prediction_ids[keep].cpu().numpy()], bounds)]
         # return dictionary of valid labels and predictions
         return {'labels': labels, 'predictions': predictions}
     
@@ -363,7 +513,7 @@ class NERTrainer(object):
             input_ids[i] = np.delete(np.array(input_ids[i]), idx, axis=0)
             valid_mask[i] = np.delete(np.array(valid_mask[i]), idx, axis=0)
         # convert token ids to tokens for each entry
-        toks = [self.model.tokenizer.convert_ids_to_tokens(sequence) for sequence in input_ids]
+        toks = [self.model.tokenizer.convert_ids_to_tokens(sequence.tolist()) for sequence in input_ids]
         # convert label ids to classifications for each entry
         lbls = [[self.model.classes[l] for l in sequence] for sequence in prediction_ids]
         # initialize empty lists of entries for tokens and labels
@@ -472,9 +622,11 @@ class NERTrainer(object):
                 mode == test: metrics and test results
                 mode == predict: prediction results
         '''
-        # if mode is not prediction, initialize empty list for metrics
+        # if mode is not prediction, initialize metric accumulator (and empty list for per-batch reports)
         if mode != 'predict':
-            metrics = []
+            metric_accumulator = MetricAccumulator(self.metric_scheme)
+            if self.batch_reports:
+                batch_metrics = []
         # if mode is test, initialize dictionary of labels and predictions
         if mode == 'test':
             test_results = {'labels': [], 'predictions': []}
@@ -484,7 +636,9 @@ class NERTrainer(object):
         # initialize batch range
         batch_range = tqdm(iterator, desc='')
         # for batch
-        for batch in batch_range:
+        for batch_index, batch in enumerate(batch_range):
+            # decode all evaluation batches, but only training batches at the metric interval
+            decode = mode != 'train' or (self.metric_interval > 0 and batch_index % self.metric_interval == 0)
             # collect inputs from batch
             ids = batch[0].cpu().numpy()
             pts = batch[1].cpu().numpy()
@@ -495,15 +649,18 @@ class NERTrainer(object):
             # collect labels if the mode is not predict
             if mode != 'predict':
                 inputs['label_ids'] = batch[3].to(self.device, non_blocking=True)
+                # compaction indices for valid entries, shared by the model and label processing
+                inputs['valid_index'] = valid_sequence_index(inputs['valid_mask'])
 
             # zero out prior gradients for training
             if mode == 'train':
                 self.optimizer.zero_grad()
 
-            # if mode is not predict, collect loss and prediction ids and then process labels
+            # if mode is not predict, collect loss and prediction ids and then process labels (if decoded)
             if mode != 'predict':
-                loss, prediction_ids = self.model.forward(**inputs)
-                batch_results = self.process_labels(inputs, prediction_ids)
+                loss, prediction_ids = self.model.forward(**inputs, decode=decode)
+                if decode:
+                    batch_results = self.process_labels(inputs, prediction_ids)
             # if mode is predict, only collect prediction ids
             else:
                 prediction_ids = self.model.forward(**inputs)                
@@ -520,25 +677,30 @@ class NERTrainer(object):
                     elif key == 'pts':
                         prediction_results[key].extend(pts)
                     elif key == 'prediction_ids':
-                        prediction_results[key].extend(prediction_ids)
+                        # trim padded predictions to the number of valid entries in each sequence
+                        prediction_results[key].extend([p[:n] for p, n in zip(prediction_ids.cpu().numpy(), inputs['valid_mask'].sum(dim=1).cpu().numpy())])
                     else:
                         prediction_results[key].extend(list(inputs[key].cpu().numpy()))
 
-            # if mode is not predice
-            if mode != 'predict':
-                # generate classification report from labels and predictions (with filtered out special tokens)
-                report = classification_report(batch_results['labels'], batch_results['predictions'], mode=self.metric_mode, scheme=self.metric_scheme, output_dict=True)
-                # add accuracy score to report
-                report['accuracy'] = accuracy_score(batch_results['labels'], batch_results['predictions'])
-                # add loss to report
-                report['loss'] = loss.item()
-                # append report to metrics
-                metrics.append(report)
-                # calculate rolling means for precision, recall and f1-score
-                means = {m: np.mean([r['micro avg'][m] for r in metrics]) for m in ['precision', 'recall', 'f1-score']}
-                # calculate rolling means for accuracy and loss
-                means['accuracy'] = np.mean([r['accuracy'] for r in metrics])
-                means['loss'] = np.mean([r['loss'] for r in metrics])
+            # if mode is not predict and the batch was not decoded, only accumulate the loss
+            if mode != 'predict' and not decode:
+                metric_accumulator.update_loss(loss.item())
+                means = metric_accumulator.summary()
+            # if mode is not predict and the batch was decoded
+            elif mode != 'predict':
+                # accumulate entity counts, token accuracy counts, and loss from labels and predictions (with filtered out special tokens)
+                metric_accumulator.update(batch_results['labels'], batch_results['predictions'], loss.item())
+                # if specified, generate full classification report for the batch
+                if self.batch_reports:
+                    from seqeval.metrics import accuracy_score, classification_report
+                    report = classification_report(batch_results['labels'], batch_results['predictions'], mode=self.metric_mode, scheme=self.metric_scheme, output_dict=True)
+                    # add accuracy score and loss to report
+                    report['accuracy'] = accuracy_score(batch_results['labels'], batch_results['predictions'])
+                    report['loss'] = loss.item()
+                    # append report to batch metrics
+                    batch_metrics.append(report)
+                # running metrics over the epoch so far
+                means = metric_accumulator.summary()
 
             # backpropagate the gradients and step the optimizer forward
             if mode == 'train':
@@ -546,8 +708,14 @@ class NERTrainer(object):
                 torch.nn.utils.clip_grad_norm_(parameters=self.model.parameters(), max_norm=self.max_grad_norm)
                 self.optimizer.step()
 
+            # if training without metrics
+            if mode == 'train' and self.metric_interval == 0:
+                del loss
+                # display epoch progress, mode, and rolling loss alongside batch progress
+                msg = '| epoch: {:d}/{:d} | {} | loss: {:.4f} |'
+                info = (self.past_epoch+epoch+1, self.past_epoch+n_epoch, mode, means['loss'])
             # if mode is not predict
-            if mode != 'predict':
+            elif mode != 'predict':
                 del loss
                 # display epoch progress, mode, and rolling averages alongside batch progress
                 msg = '| epoch: {:d}/{:d} | {} | loss: {:.4f} | accuracy: {:.4f} | precision: {:.4f} | recall: {:.4f} | f1-score: {:.4f} |'
@@ -559,6 +727,11 @@ class NERTrainer(object):
                 info = (self.past_epoch+epoch+1, self.past_epoch+n_epoch, mode)
             # set progress bar description
             batch_range.set_description(msg.format(*info))
+        # if mode is not predict, construct epoch metrics from the accumulated counts
+        if mode != 'predict':
+            metrics = metric_accumulator.report()
+            if self.batch_reports:
+                metrics['batches'] = batch_metrics
         # return statements
         if mode == 'test':
             return metrics, test_results
@@ -696,7 +869,7 @@ class NERTrainer(object):
                 # append_history
                 self.epoch_metrics['validation']['epoch_{}'.format(self.past_epoch+epoch)] = valid_metrics
                 # save best
-                validation_f1 = np.mean([batch_metrics['micro avg']['f1-score'] for batch_metrics in valid_metrics])
+                validation_f1 = valid_metrics['micro avg']['f1-score']
                 if validation_f1 >= best_validation_f1:
                     best_validation_f1 = validation_f1
                     if use_cache:
@@ -733,27 +906,61 @@ class NERTrainer(object):
     
 
     def merge_split_entries(self, prediction_results):
-        unique_ids = []
-        for id in prediction_results['ids']:
-            if id not in unique_ids:
-                unique_ids.append(id)
-        merged_prediction_results = {key: [] for key in prediction_results.keys() if key != 'pts'}
-        for id in unique_ids:
-            merged_prediction_results['ids'].append(id)
-            id_pts_ind = np.where(prediction_results['ids'] == id)[0]
-            id_pts_ind = id_pts_ind[np.argsort(np.array(prediction_results['pts'])[id_pts_ind])]
-            for i, u in enumerate(id_pts_ind):
-                if i == 0:
-                    for key in prediction_results.keys():
-                        if key not in ['ids', 'pts']:
-                            merged_prediction_results[key].append(list(prediction_results[key][u]))
-                else:
-                    for key in prediction_results.keys():
-                        if key not in ['ids', 'pts']:
-                            merged_prediction_results[key][-1].extend(list(prediction_results[key][u]))
+        '''
+        Merges the predictions for the parts of split entries, restoring the original entry order (ascending ids) regardless of the batch order
+            Arguments:
+                prediction_results: Dictionary of prediction results by part
+            Returns:
+                Dictionary of prediction results by entry
+        '''
+        ids = np.array(prediction_results['ids'])
+        pts = np.array(prediction_results['pts'])
+        # order by entry id and then by part
+        order = np.lexsort((pts, ids))
+        # boundaries between entries in the ordered parts
+        unique_ids, starts = np.unique(ids[order], return_index=True)
+        bounds = np.append(starts, len(order))
+        merged_prediction_results = {'ids': list(unique_ids)}
+        for key in prediction_results.keys():
+            if key not in ['ids', 'pts']:
+                merged_prediction_results[key] = [list(chain.from_iterable(prediction_results[key][u] for u in order[bounds[i]:bounds[i+1]])) for i in range(len(unique_ids))]
         return merged_prediction_results
     
 
+    def restore_original_data(self, annotations, original_data):
+        '''
+        Restores the metadata and original token text (before BERT tokenization) of annotated entries, rejoining the pieces of sentences that were split across parts
+            Arguments:
+                annotations: List of annotations by entry from process_ids
+                original_data: Original data before pre-processing
+            Returns:
+                List of annotations in the order of the original data
+        '''
+        output_annotations = []
+        annotation_dict = {}
+        for annotation in annotations:
+            annotation_dict[annotation['id']] = {'tokens': annotation['tokens']}
+        for original in original_data:
+            annotation = annotation_dict[original['id']]
+            # the pieces of a split sentence are separated by [SEP] tokens, so they are joined until the original sentence lengths are met
+            sentences = iter(annotation['tokens'])
+            output_sentences = []
+            for original_sentence in original['tokens']:
+                output_sentence = list(next(sentences, []))
+                while len(output_sentence) < len(original_sentence['text']):
+                    piece = next(sentences, None)
+                    if piece is None:
+                        break
+                    output_sentence.extend(piece)
+                output_sentences.append(output_sentence)
+            output_annotation = {'id': original['id'], 'meta': original['meta'], 'tokens': output_sentences}
+            for original_sentence, output_annotation_sentence  in zip(original['tokens'], output_annotation['tokens']):
+                for original_token, output_annotation_token in zip(original_sentence['text'], output_annotation_sentence):
+                    output_annotation_token['text'] = original_token
+            output_annotations.append(output_annotation)
+        return output_annotations
+
+
     def predict(self, predict_iter, original_data=None, state_path=None, predict_path=None, return_full_dict=False):
         '''
         Predicts classifications for a dataset
@@ -777,17 +984,7 @@ class NERTrainer(object):
         annotations = self.process_ids(prediction_results['ids'], prediction_results['input_ids'], prediction_results['attention_mask'],
                                        prediction_results['valid_mask'], prediction_results['prediction_ids'])
         if original_data is not None:
-            output_annotations = []
-            annotation_dict = {}
-            for annotation in annotations:
-                annotation_dict[annotation['id']] = {'tokens': annotation['tokens']}
-            for original in original_data:
-                annotation = annotation_dict[original['id']]
-                output_annotation = {'id': original['id'], 'meta': original['meta'], 'tokens': annotation['tokens']}
-                for original_sentence, output_annotation_sentence  in zip(original['tokens'], output_annotation['tokens']):
-                    for original_token, output_annotation_token in zip(original_sentence['text'], output_annotation_sentence):
-                        output_annotation_token['text'] = original_token
-                output_annotations.append(output_annotation)
+            output_annotations = self.restore_original_data(annotations, original_data)
         else:
             output_annotations = annotations
         annotations = self.process_summaries(output_annotations)
@@ -800,3 +997,77 @@ class NERTrainer(object):
             return annotations
         else:
             return [annotation['entities'] for annotation in annotations]
+    
+
+    def predict_stream(self, predict_iter, state_path=None, return_full_dict=False):
+        '''
+        Predicts classifications for a stream of batches, yielding the results of each entry (in input order) as soon as all of its parts have been predicted
+            Arguments:
+                predict_iter: Streaming prediction dataloader (see NERData.create_stream_dataloader)
+                state_path: Path to load the model state from
+                return_full_dict: Toggle for returning full JSON entries or only the detected entities
+            Returns:
+                Generator of full JSON entries or entity summaries
+        '''
+        # if state path provided, load state (excluding optimizer)
+        if state_path is not None:
+            self.load_state(state_path, optimizer=False)
+        # entries awaiting predictions (filled by the dataset as it streams each chunk)
+        pending = predict_iter.dataset.pending
+        # predicted parts by entry id
+        parts = {}
+        # make sure the model is set to evaluate
+        self.model.eval()
+        for batch in tqdm(predict_iter, desc='| predicting |'):
+            # collect inputs from batch
+            ids = batch[0].cpu().numpy()
+            pts = batch[1].cpu().numpy()
+            inputs = {'input_ids': batch[2].to(self.device, non_blocking=True),
+                      'attention_mask': batch[4].to(self.device, non_blocking=True),
+                      'valid_mask': batch[5].to(self.device, non_blocking=True),
+                      'device': self.device}
+            with torch.no_grad():
+                prediction_ids = self.model.forward(**inputs).cpu().numpy()
+            # sequences trimmed to their lengths and predictions trimmed to their numbers of valid entries
+            lengths = batch[4].sum(dim=1).numpy()
+            valid_lengths = batch[5].sum(dim=1).numpy()
+            input_ids, attention_mask, valid_mask = [batch[i].numpy() for i in [2, 4, 5]]
+            for i in range(len(ids)):
+                parts.setdefault(ids[i], []).append({'ids': ids[i], 'pts': pts[i], 'input_ids': input_ids[i, :lengths[i]], 'attention_mask': attention_mask[i, :lengths[i]],
+                                                     'valid_mask': valid_mask[i, :lengths[i]], 'prediction_ids': prediction_ids[i, :valid_lengths[i]]})
+            # entries at the front of the stream with all of their parts predicted
+            complete = []
+            for id, (entry, sequence_count) in pending.items():
+                if len(parts.get(id, [])) < sequence_count:
+                    break
+                complete.append(id)
+            if len(complete) > 0:
+                yield from self.process_stream_entries(complete, pending, parts, return_full_dict)
+        # entries without sequences (no predictions) are dropped
+        yield from self.process_stream_entries(list(pending.keys()), pending, parts, return_full_dict)
+
+
+    def process_stream_entries(self, complete, pending, parts, return_full_dict):
+        '''
+        Processes the predicted parts of completed entries from a prediction stream into annotations, releasing the entries
+            Arguments:
+                complete: List of completed entry ids
+                pending: Dictionary of pending entries and their numbers of sequences by id
+                parts: Dictionary of predicted parts by entry id
+                return_full_dict: Toggle for returning full JSON entries or only the detected entities
+            Returns:
+                Generator of full JSON entries or entity summaries
+        '''
+        original_data = [pending.pop(id)[0] for id in complete]
+        entry_parts = [part for id in complete for part in parts.pop(id, [])]
+        if len(entry_parts) == 0:
+            return
+        prediction_results = {key: [part[key] for part in entry_parts] for key in ['ids', 'pts', 'input_ids', 'attention_mask', 'valid_mask', 'prediction_ids']}
+        prediction_results = self.merge_split_entries(prediction_results)
+        annotations = self.process_ids(prediction_results['ids'], prediction_results['input_ids'], prediction_results['attention_mask'],
+                                       prediction_results['valid_mask'], prediction_results['prediction_ids'])
+        # entries without predictions are dropped
+        predicted = set(prediction_results['ids'])
+        annotations = self.process_summaries(self.restore_original_data(annotations, [original for original in original_data if original['id'] in predicted]))
+        for annotation in annotations:
+            yield annotation if return_full_dict else annotation['entities']
@@ -1,7 +1,50 @@
 import torch
 
 
-def valid_sequence_output(sequence_output, label_ids, attention_mask, valid_mask, device):
+def valid_sequence_index(valid_mask):
+    '''
+    Constructs the indices that compact a batch of sequences onto their valid entries while preserving order
+        Arguments:
+            valid_mask: Batch of sequence valid masks
+        Returns:
+            valid_index, valid_lengths
+    '''
+    # get shape of valid mask
+    batch_size, max_len = valid_mask.shape
+    # sequence positions
+    positions = torch.arange(max_len, device=valid_mask.device).unsqueeze(0)
+    # invalid positions are pushed behind all valid positions, keeping the order within each group (keys are unique, so no stable sort is required)
+    valid_index = torch.argsort(positions+max_len*(~valid_mask.bool()).long(), dim=1)
+    # number of valid entries per sequence
+    valid_lengths = valid_mask.bool().sum(dim=1)
+    # return compaction indices and lengths
+    return valid_index, valid_lengths
+
+
+def valid_sequence_gather(tensor, valid_index, valid_lengths):
+    '''
+    Gathers the valid entries of a batch of sequences to the front of each sequence, zeroing the remainder
+        Arguments:
+            tensor: Batch of sequences with shape (batch_size, max_len, ...)
+            valid_index: Compaction indices from valid_sequence_index
+            valid_lengths: Number of valid entries per sequence from valid_sequence_index
+        Returns:
+            valid_tensor
+    '''
+    # get shape of valid index
+    batch_size, max_len = valid_index.shape
+    # compacted positions that hold valid entries
+    valid_positions = torch.arange(max_len, device=valid_index.device).unsqueeze(0) < valid_lengths.unsqueeze(1)
+    # flatten batch and sequence dimensions so that whole rows (including any feature dimensions) are gathered at once
+    flat_index = (valid_index+max_len*torch.arange(batch_size, device=valid_index.device).unsqueeze(1)).view(-1)
+    valid_tensor = tensor.reshape(batch_size*max_len, *tensor.shape[2:])[flat_index].view(tensor.shape)
+    # broadcast mask over any trailing (feature) dimensions
+    mask = valid_positions.view(batch_size, max_len, *((tensor.dim()-2)*[1]))
+    # zero out the remainder
+    return valid_tensor.masked_fill(~mask, 0)
+
+
+def valid_sequence_output(sequence_output, label_ids, attention_mask, valid_mask, device, valid_index=None):
     '''
     Constructs valid tensors for the output BERT sequences, labels ids and attention mask by filtering out invalid indices
         Arguments:
@@ -10,34 +53,22 @@ def valid_sequence_output(sequence_output, label_ids, attention_mask, valid_mask
             attention_mask: Batch of sequence attention masks
             valid_mask: Batch of sequence valid masks
             device: Device used for computation
+            valid_index: Optional precomputed (valid_index, valid_lengths) from valid_sequence_index
         Returns:
             valid_sequence, valid_label_ids, valid_attention_mask
     '''
-    # get shape of bert output sequence
-    batch_size, max_len, feat_dim = sequence_output.shape
-    # initialize empty valid sequence
-    valid_sequence = torch.zeros(batch_size, max_len, feat_dim, dtype=torch.float32, device=device)
-    # initialize valid labels if label ids provided
+    # compute compaction indices if not provided
+    if valid_index is None:
+        valid_index = valid_sequence_index(valid_mask.to(device))
+    valid_index, valid_lengths = valid_index
+    # gather valid sequence
+    valid_sequence = valid_sequence_gather(sequence_output.to(dtype=torch.float32, device=device), valid_index, valid_lengths)
+    # gather valid labels if label ids provided
     if label_ids is not None:
-        valid_label_ids = torch.zeros(batch_size, max_len, dtype=torch.uint8, device=device)
+        valid_label_ids = valid_sequence_gather(label_ids.to(dtype=torch.uint8, device=device), valid_index, valid_lengths)
     else:
         valid_label_ids = None
-    # initialize valid attention mask
-    valid_attention_mask = torch.zeros(batch_size, max_len, dtype=torch.bool, device=device)
-    # loop through samples in batch
-    for i in range(batch_size):
-        # valid index starts at zero
-        k = 0
-        # loop through length of sample
-        for j in range(max_len):
-            # if valid entry
-            if valid_mask[i][j].item() == 1:
-                # fill in the valid tensors
-                valid_sequence[i][k] = sequence_output[i][j]
-                if label_ids is not None:
-                    valid_label_ids[i][k] = label_ids[i][j]
-                valid_attention_mask[i][k] = attention_mask[i][j]
-                # increment index for valid tensors
-                k += 1
+    # gather valid attention mask
+    valid_attention_mask = valid_sequence_gather(attention_mask.to(dtype=torch.bool, device=device), valid_index, valid_lengths)
     # return valid tensors
     return valid_sequence, valid_label_ids, valid_attention_mask
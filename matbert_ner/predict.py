@@ -1,12 +1,15 @@
 import os
 import json
+import threading
+from itertools import islice
 import torch
-from matbert_ner.utils.data import NERData
+from matbert_ner.utils.data import NERData, iterate_json
 from matbert_ner.models.bert_model import BERTNER
 from matbert_ner.models.model_trainer import NERTrainer
+from matbert_ner.models.model_package import load_package
 
 
-def predict(texts, is_file, model_file, state_path, predict_path=None, return_full_dict=False, scheme="IOBES", batch_size=256, device="cpu", seed=None):
+def predict(texts, is_file, model_file, state_path, predict_path=None, return_full_dict=False, scheme="IOBES", batch_size=256, max_tokens=None, device="cpu", seed=None, constrained_crf=False, workers=1, cache_dir=None, package_path=None):
     """
     Predict labels for texts. Please limit input to 512 tokens or less.
 
@@ -19,9 +22,15 @@ def predict(texts, is_file, model_file, state_path, predict_path=None, return_fu
         predict_path (str): Name of output file
         return_full_dict (bool): Toggle for returning the full JSON entry or just the summarized entities detected by the model
         scheme (str): IOBES or IOB2.
-        batch_size (int): Number of samples to predict in one batch pass.
+        batch_size (int): Number of samples to predict in one batch pass (maximum number if max_tokens is provided).
+        max_tokens (int, None): Maximum number of (padded) tokens in one batch pass for stable memory use regardless of text lengths.
         device (str): Select 'cpu', 'gpu', or torch specific logic for running on multiple GPUs.
         seed (int, None): Seed for prediction.
+        constrained_crf (bool): Toggle for decoding with invalid transitions as hard constraints instead of penalties.
+        workers (int): Number of processes used for pre-tokenizing untokenized text.
+        cache_dir (str, None): Directory for persistent preprocessing caches (e.g. pre-tokenized text) reused across calls.
+        package_path (str, None): Path to a single-file model package (see NERTrainer.save_package). If provided, the model file, state path, scheme, and
+            constrained_crf arguments are ignored and the configuration, tokenizer, and fine-tuned weights are all loaded from the package.
 
     Returns:
         ([dict]): dictionaries of tokens and label annotations
@@ -45,10 +54,19 @@ def predict(texts, is_file, model_file, state_path, predict_path=None, return_fu
     torch.backends.cudnn.benchmark = False
     torch.backends.cudnn.deterministic = True
 
-    ner_data = NERData(model_file, scheme=scheme)
+    if package_path is not None:
+        bert_ner, tokenizer = load_package(package_path, seed=seed)
+        ner_data = NERData(model_file, scheme=bert_ner.scheme, cache_dir=cache_dir, workers=workers, tokenizer=tokenizer)
+        state_path = None
+    else:
+        ner_data = NERData(model_file, scheme=scheme, cache_dir=cache_dir, workers=workers)
     ner_data.preprocess(texts, split_dict, is_file=is_file, annotated=False, sentence_level=False, shuffle=False, seed=seed)
-    ner_data.create_dataloaders(batch_size=batch_size, shuffle=False, seed=seed)
-    bert_ner = BERTNER(model_file=model_file, classes=ner_data.classes, scheme=scheme, seed=seed)
+    ner_data.close()
+    ner_data.create_dataloaders(batch_size=batch_size, shuffle=False, seed=seed, max_tokens=max_tokens)
+    if package_path is None:
+        # the pretrained weights are only loaded if no fine-tuned state will overwrite them
+        bert_ner = BERTNER(model_file=model_file, classes=ner_data.classes, scheme=scheme, seed=seed, constrained_crf=constrained_crf,
+                           tokenizer=ner_data.tokenizer, pretrained=state_path is None)
     bert_ner_trainer = NERTrainer(bert_ner, device)
     annotations = bert_ner_trainer.predict(ner_data.dataloaders['predict'],
                                            original_data=ner_data.data['predict'],
@@ -56,3 +74,235 @@ def predict(texts, is_file, model_file, state_path, predict_path=None, return_fu
                                            predict_path=predict_path,
                                            return_full_dict=return_full_dict)
     return annotations
+
+
+def predict_stream(texts, is_file, model_file, state_path, predict_path=None, return_full_dict=False, scheme="IOBES", batch_size=256, max_tokens=None, chunk_size=1024, device="cpu", seed=None, constrained_crf=False, workers=1, cache_dir=None, package_path=None):
+    """
+    Predict labels for texts as a stream with bounded memory use regardless of the input size. Entries are parsed, preprocessed, and predicted in chunks.
+
+    Args:
+        texts ([str]): JSON (array or JSON lines) filename, or iterable of JSON entries or string texts to predict labels for. Untokenized text will be tokenized interally with
+            the Materials Tokenizer.
+        is_file (bool): Toggle for whether the texts are a JSON file or iterable of JSON entries/strings
+        model_file (str): Path to BERT model file.
+        state_path (str): Path to model state for NER task, fine tuned for specific task (e.g., gold nanoparticles).
+        predict_path (str): Name of output file (written as JSON lines as the predictions are made)
+        return_full_dict (bool): Toggle for returning the full JSON entry or just the summarized entities detected by the model
+        scheme (str): IOBES or IOB2.
+        batch_size (int): Number of samples to predict in one batch pass (maximum number if max_tokens is provided).
+        max_tokens (int, None): Maximum number of (padded) tokens in one batch pass for stable memory use regardless of text lengths.
+        chunk_size (int): Number of entries preprocessed together (bounds the memory use).
+        device (str): Select 'cpu', 'gpu', or torch specific logic for running on multiple GPUs.
+        seed (int, None): Seed for prediction.
+        constrained_crf (bool): Toggle for decoding with invalid transitions as hard constraints instead of penalties.
+        workers (int): Number of processes used for pre-tokenizing untokenized text.
+        cache_dir (str, None): Directory for persistent preprocessing caches (e.g. pre-tokenized text) reused across calls.
+        package_path (str, None): Path to a single-file model package (see NERTrainer.save_package). If provided, the model file, state path, scheme, and
+            constrained_crf arguments are ignored and the configuration, tokenizer, and fine-tuned weights are all loaded from the package.
+
+    Yields:
+        (dict): dictionary of tokens and label annotations for each entry (in input order)
+
+    """
+    if 'gpu' in device:
+        gpu = True
+        try:
+            d, n = device.split(':')
+        except:
+            print('ValueError: Improper device format in command-line argument')
+        device = 'cuda'
+    else:
+        gpu = False
+    if gpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = str(n)
+
+    torch.device('cuda' if gpu else 'cpu')
+    torch.backends.cudnn.benchmark = False
+    torch.backends.cudnn.deterministic = True
+
+    if package_path is not None:
+        bert_ner, tokenizer = load_package(package_path, seed=seed)
+        ner_data = NERData(model_file, scheme=bert_ner.scheme, cache_dir=cache_dir, workers=workers, tokenizer=tokenizer)
+        state_path = None
+    else:
+        ner_data = NERData(model_file, scheme=scheme, cache_dir=cache_dir, workers=workers)
+    predict_iter = ner_data.create_stream_dataloader(texts, is_file=is_file, sentence_level=False, chunk_size=chunk_size, batch_size=batch_size, max_tokens=max_tokens)
+    if package_path is None:
+        # the pretrained weights are only loaded if no fine-tuned state will overwrite them
+        bert_ner = BERTNER(model_file=model_file, classes=ner_data.classes, scheme=scheme, seed=seed, constrained_crf=constrained_crf,
+                           tokenizer=ner_data.tokenizer, pretrained=state_path is None)
+    bert_ner_trainer = NERTrainer(bert_ner, device)
+    f = open(predict_path, 'w') if predict_path is not None else None
+    try:
+        for annotation in bert_ner_trainer.predict_stream(predict_iter, state_path=state_path, return_full_dict=True):
+            if f is not None:
+                f.write(json.dumps(annotation)+'\n')
+            yield annotation if return_full_dict else annotation['entities']
+    finally:
+        if f is not None:
+            f.close()
+        ner_data.close()
+
+
+class Predictor(object):
+    """
+    A predictor that loads the tokenizers and model once and keeps them warm across calls. Calls are serialized with a lock, so a single
+    predictor can be shared by multiple threads. Every input gets exactly one result (entries with duplicate identifiers are not dropped).
+
+    Args:
+        model_file (str, None): Path to BERT model file (may be None if a package is provided).
+        state_path (str, None): Path to model state for NER task, fine tuned for specific task (e.g., gold nanoparticles).
+        package_path (str, None): Path to a single-file model package (see NERTrainer.save_package). If provided, the model file, state path, scheme,
+            and constrained_crf arguments are ignored.
+        scheme (str): IOBES or IOB2.
+        batch_size (int): Number of samples to predict in one batch pass (maximum number if max_tokens is provided).
+        max_tokens (int, None): Maximum number of (padded) tokens in one batch pass for stable memory use regardless of text lengths.
+        device (str): Select 'cpu', 'gpu', or torch specific logic for running on multiple GPUs.
+        seed (int, None): Seed for prediction.
+        constrained_crf (bool): Toggle for decoding with invalid transitions as hard constraints instead of penalties.
+        workers (int): Number of processes used for pre-tokenizing untokenized text (started on first use and kept until close).
+        cache_dir (str, None): Directory for persistent preprocessing caches (e.g. pre-tokenized text) reused across calls.
+        warmup_batches (int): Number of warm-up batches predicted on construction (e.g. to load the text tokenizer and allocate memory up front).
+
+    """
+    # text predicted by the warm-up batches
+    warmup_text = 'The perovskite SrTiO3 was synthesized by a solid state reaction of SrCO3 and TiO2 at 1200 K.'
+
+    def __init__(self, model_file=None, state_path=None, package_path=None, scheme="IOBES", batch_size=256, max_tokens=None, device="cpu", seed=None, constrained_crf=False, workers=1, cache_dir=None, warmup_batches=0):
+        if 'gpu' in device:
+            gpu = True
+            try:
+                d, n = device.split(':')
+            except:
+                print('ValueError: Improper device format in command-line argument')
+            device = 'cuda'
+        else:
+            gpu = False
+        if gpu:
+            os.environ['CUDA_VISIBLE_DEVICES'] = str(n)
+
+        torch.device('cuda' if gpu else 'cpu')
+        torch.backends.cudnn.benchmark = False
+        torch.backends.cudnn.deterministic = True
+
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.seed = seed
+        if package_path is not None:
+            bert_ner, tokenizer = load_package(package_path, seed=seed)
+            self.ner_data = NERData(model_file, scheme=bert_ner.scheme, cache_dir=cache_dir, workers=workers, tokenizer=tokenizer, deduplicate=False)
+            self.trainer = NERTrainer(bert_ner, device)
+        else:
+            self.ner_data = NERData(model_file, scheme=scheme, cache_dir=cache_dir, workers=workers, deduplicate=False)
+            # the classes of unannotated data (replaced by the classes of the state)
+            self.ner_data.get_classes([])
+            bert_ner = BERTNER(model_file=model_file, classes=self.ner_data.classes, scheme=scheme, seed=seed, constrained_crf=constrained_crf,
+                               tokenizer=self.ner_data.tokenizer, pretrained=state_path is None)
+            self.trainer = NERTrainer(bert_ner, device)
+            if state_path is not None:
+                self.trainer.load_state(state_path, optimizer=False)
+        # serializes calls (the preprocessing state, tokenizers, and caches are shared)
+        self.lock = threading.Lock()
+        self.warmup(warmup_batches)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """
+        Shuts down the pre-tokenization worker processes (if started). The predictor remains usable and restarts them as needed.
+        """
+        with self.lock:
+            self.ner_data.close()
+
+    def warmup(self, n_batches=1):
+        """
+        Predicts warm-up batches of full size (or up to the token budget) to load lazy dependencies and allocate memory before the first real call.
+
+        Args:
+            n_batches (int): Number of warm-up batches.
+
+        """
+        for _ in range(n_batches):
+            self.predict_batch(self.batch_size*[self.warmup_text])
+
+    def predict_batch(self, texts, return_full_dict=False):
+        """
+        Predict labels for a list of texts that are preprocessed and predicted together.
+
+        Args:
+            texts ([str]): List of JSON entries or string texts to predict labels for. Untokenized text will be tokenized interally with
+                the Materials Tokenizer.
+            return_full_dict (bool): Toggle for returning the full JSON entry or just the summarized entities detected by the model
+
+        Returns:
+            ([dict]): dictionaries of tokens and label annotations (in input order)
+
+        """
+        texts = list(texts)
+        if len(texts) == 0:
+            return []
+        with self.lock:
+            try:
+                self.ner_data.preprocess(texts, {'predict': 1.0}, is_file=False, annotated=False, sentence_level=False, shuffle=False, seed=self.seed)
+                self.ner_data.create_dataloaders(batch_size=self.batch_size, shuffle=False, seed=self.seed, max_tokens=self.max_tokens)
+                return self.trainer.predict(self.ner_data.dataloaders['predict'], original_data=self.ner_data.data['predict'], return_full_dict=return_full_dict)
+            finally:
+                # release the preprocessed data between calls
+                self.ner_data.data = None
+                self.ner_data.dataset = None
+                self.ner_data.dataloaders = None
+
+    def predict_iter(self, texts, is_file=False, return_full_dict=False, chunk_size=1024):
+        """
+        Predict labels for texts as a stream, preprocessing and predicting them in chunks so that memory use is bounded regardless of the input size.
+        The lock is only held while a chunk is predicted, so other calls can proceed between chunks.
+
+        Args:
+            texts ([str]): JSON (array or JSON lines) filename, or iterable of JSON entries or string texts to predict labels for.
+            is_file (bool): Toggle for whether the texts are a JSON file or iterable of JSON entries/strings
+            return_full_dict (bool): Toggle for returning the full JSON entry or just the summarized entities detected by the model
+            chunk_size (int): Number of entries preprocessed and predicted together.
+
+        Yields:
+            (dict): dictionary of tokens and label annotations for each entry (in input order)
+
+        """
+        entries = iterate_json(texts) if is_file else iter(texts)
+        # position of the chunk in the stream
+        offset = 0
+        while True:
+            chunk = list(islice(entries, chunk_size))
+            if len(chunk) == 0:
+                return
+            for entry, annotation in zip(chunk, self.predict_batch(chunk, return_full_dict=return_full_dict)):
+                if return_full_dict:
+                    # ids (and the dois of entries identified by position) are numbered across the stream instead of within the chunk
+                    annotation['id'] += offset
+                    if self.ner_data.entry_format(entry)[0] in ('text', 'index'):
+                        annotation['meta']['doi'] += offset
+                yield annotation
+            offset += len(chunk)
+
+    def predict(self, texts, is_file=False, return_full_dict=False):
+        """
+        Predict labels for a single text, a list of texts, or a JSON file.
+
+        Args:
+            texts (str, [str]): JSON filename, a single JSON entry or string text, or a list of JSON entries or string texts to predict labels for.
+            is_file (bool): Toggle for whether the texts are a JSON file
+            return_full_dict (bool): Toggle for returning the full JSON entry or just the summarized entities detected by the model
+
+        Returns:
+            (dict, [dict]): dictionary of tokens and label annotations for a single text, otherwise a list of them (in input order)
+
+        """
+        if is_file:
+            return list(self.predict_iter(texts, is_file=True, return_full_dict=return_full_dict))
+        elif isinstance(texts, (str, dict)):
+            return self.predict_batch([texts], return_full_dict=return_full_dict)[0]
+        else:
+            return self.predict_batch(texts, return_full_dict=return_full_dict)
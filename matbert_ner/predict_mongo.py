@@ -3,7 +3,6 @@ import pymongo
 import itertools
 import json
 from datetime import datetime
-import numpy as np
 from tqdm import tqdm
 
 
@@ -22,6 +21,8 @@ state_path = save_dir+'best.pt'
 scheme = 'IOBES'
 split_dict = {'predict': 1.0}
 fetch_batch_size = 500
+max_tokens = 65536
+workers = 8
 sentence_level = False
 seed = None
 device = 'gpu:0'
@@ -64,14 +65,14 @@ else:
     print('query: in unprocessed dois')
 
 i = 0
-ner_data = NERData(model_file, scheme=scheme)
+ner_data = NERData(model_file, scheme=scheme, workers=workers)
 for entries in grouper(fetch_batch_size, db.entries.find(query)):
     try:
         entries_clean = [{'meta': {'doi': entry['doi'], 'par': 0}, 'text': '{}. {}'.format(entry['title'], entry['abstract'])} for entry in entries]
         ner_data.preprocess(entries_clean, split_dict, is_file=False, annotated=False, sentence_level=False, shuffle=False, seed=seed)
-        ner_data.create_dataloaders(batch_size=int(np.ceil(len(ner_data.data['predict'])/4)), shuffle=False, seed=seed)
+        ner_data.create_dataloaders(batch_size=len(ner_data.data['predict']), shuffle=False, seed=seed, max_tokens=max_tokens)
         if i ==0:
-            bert_ner = BERTNER(model_file=model_file, classes=ner_data.classes, scheme=scheme, seed=seed)
+            bert_ner = BERTNER(model_file=model_file, classes=ner_data.classes, scheme=scheme, seed=seed, tokenizer=ner_data.tokenizer, pretrained=False)
             bert_ner_trainer = NERTrainer(bert_ner, device)
             bert_ner_trainer.load_state(state_path=state_path, optimizer=False)
             labels = list(set(ner_data.classes))
@@ -86,4 +87,6 @@ for entries in grouper(fetch_batch_size, db.entries.find(query)):
         i += 1
     except Exception as exception:
         print('Fetched Batch Failed')
-        print(exception)
\ No newline at end of file
+        print(exception)
+
+ner_data.close()
\ No newline at end of file
@@ -0,0 +1,397 @@
+import json
+import time
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from matbert_ner.predict import Predictor
+
+
+# reason phrases of the response status codes
+status_reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+def normalize_entry(entry):
+    '''
+    Validates an input entry for prediction and keeps only its content (the entries of requests batched together share no metadata)
+        Arguments:
+            entry: Raw text, or JSON entry with either tokens (sentences of tokens), sents (list of sentence texts), or text
+        Returns:
+            Raw text or JSON entry with only its content
+    '''
+    if isinstance(entry, str):
+        return entry
+    if isinstance(entry, dict):
+        if 'tokens' in entry:
+            if not (isinstance(entry['tokens'], list) and all(isinstance(sentence, list) and all(isinstance(token, str) for token in sentence) for sentence in entry['tokens'])):
+                raise ValueError('tokens must be a list of sentences, each a list of token texts')
+            return {'tokens': entry['tokens']}
+        elif 'sents' in entry:
+            if not (isinstance(entry['sents'], list) and all(isinstance(sentence, str) for sentence in entry['sents'])):
+                raise ValueError('sents must be a list of sentence texts')
+            return {'sents': entry['sents']}
+        elif 'text' in entry and isinstance(entry['text'], str):
+            return entry['text']
+    raise ValueError('entries must be texts or objects with tokens, sents, or text')
+
+
+def estimate_tokens(entry):
+    '''
+    Estimates the number of tokens in a normalized entry (before BERT tokenization) without tokenizing it
+        Arguments:
+            entry: Normalized entry (see normalize_entry)
+        Returns:
+            Estimated number of tokens
+    '''
+    if isinstance(entry, str):
+        return len(entry.split())
+    elif 'tokens' in entry:
+        return sum(len(sentence) for sentence in entry['tokens'])
+    else:
+        return sum(len(sentence.split()) for sentence in entry['sents'])
+
+
+class MicroBatcher(object):
+    '''
+    An object that coalesces concurrent prediction requests into micro-batches bounded by a token budget and a maximum wait time
+    '''
+    def __init__(self, predictor, max_batch_tokens=16384, max_wait=0.01):
+        '''
+        Initializes the micro-batcher
+            Arguments:
+                predictor: Predictor object
+                max_batch_tokens: Maximum (estimated) number of tokens in a micro-batch, a larger request is predicted alone
+                max_wait: Maximum time in seconds a request waits for other requests to join its micro-batch
+            Returns:
+                MicroBatcher object
+        '''
+        self.predictor = predictor
+        self.max_batch_tokens = max_batch_tokens
+        self.max_wait = max_wait
+        # queue of pending requests (entries, estimated tokens, future)
+        self.queue = None
+        # predictions run in a single background thread so that the event loop keeps accepting requests
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # request that did not fit in the previous micro-batch
+        self.carry = None
+        # counters for the metrics
+        self.counts = {'requests': 0, 'entries': 0, 'batches': 0, 'batch_entries': 0, 'errors': 0}
+        self.latency_sum = 0.0
+        self.start_time = time.time()
+
+
+    async def submit(self, entries):
+        '''
+        Submits a request and waits for its predictions
+            Arguments:
+                entries: List of normalized entries
+            Returns:
+                List of annotations, one for each entry
+        '''
+        start = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((entries, sum(estimate_tokens(entry) for entry in entries), future))
+        try:
+            return await future
+        finally:
+            self.counts['requests'] += 1
+            self.counts['entries'] += len(entries)
+            self.latency_sum += time.perf_counter()-start
+
+
+    async def collect(self):
+        '''
+        Collects the next micro-batch of requests, waiting at most max_wait after the first request for others to join
+            Arguments:
+                None
+            Returns:
+                List of requests
+        '''
+        if self.carry is not None:
+            first, self.carry = self.carry, None
+        else:
+            first = await self.queue.get()
+        requests = [first]
+        tokens = first[1]
+        deadline = asyncio.get_running_loop().time()+self.max_wait
+        while tokens < self.max_batch_tokens:
+            timeout = deadline-asyncio.get_running_loop().time()
+            try:
+                request = self.queue.get_nowait() if timeout <= 0 else await asyncio.wait_for(self.queue.get(), timeout)
+            except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                break
+            # a request that would exceed the budget starts the next micro-batch
+            if tokens+request[1] > self.max_batch_tokens:
+                self.carry = request
+                break
+            requests.append(request)
+            tokens += request[1]
+        return requests
+
+
+    async def run(self):
+        '''
+        Predicts micro-batches of queued requests until cancelled
+            Arguments:
+                None
+            Returns:
+                None
+        '''
+        self.queue = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = await self.collect()
+            entries = [entry for request in requests for entry in request[0]]
+            try:
+                annotations = await loop.run_in_executor(self.executor, self.predictor.predict_batch, entries, True)
+            except Exception as exception:
+                self.counts['errors'] += 1
+                for _, _, future in requests:
+                    if not future.done():
+                        future.set_exception(exception)
+                continue
+            self.counts['batches'] += 1
+            self.counts['batch_entries'] += len(entries)
+            # split the annotations back into their requests
+            start = 0
+            for request_entries, _, future in requests:
+                if not future.done():
+                    future.set_result([{'tokens': annotation['tokens'], 'entities': annotation['entities']} for annotation in annotations[start:start+len(request_entries)]])
+                start += len(request_entries)
+
+
+    def metrics(self):
+        '''
+        Retrieves the server metrics
+            Arguments:
+                None
+            Returns:
+                Dictionary of request, entry, batch, and error counts, mean batch size and latency, queue size, and uptime
+        '''
+        metrics = dict(self.counts)
+        metrics['mean_batch_entries'] = self.counts['batch_entries']/self.counts['batches'] if self.counts['batches'] > 0 else 0.0
+        metrics['mean_latency'] = self.latency_sum/self.counts['requests'] if self.counts['requests'] > 0 else 0.0
+        metrics['queued_requests'] = self.queue.qsize() if self.queue is not None else 0
+        metrics['uptime'] = time.time()-self.start_time
+        return metrics
+
+
+class NERServer(object):
+    '''
+    A minimal HTTP/1.1 server (asyncio streams) for MatBERT NER predictions
+        POST /predict with {"texts": [...]} or {"entries": [...]} returns {"predictions": [{"tokens": ..., "entities": ...},...]}
+        GET /health returns the status and metrics (also at /metrics)
+    '''
+    def __init__(self, batcher, host='127.0.0.1', port=8000, max_body_bytes=1<<26):
+        '''
+        Initializes the server
+            Arguments:
+                batcher: MicroBatcher object
+                host: Host to bind to
+                port: Port to bind to (0 for any free port)
+                max_body_bytes: Maximum size of a request body
+            Returns:
+                NERServer object
+        '''
+        self.batcher = batcher
+        self.host = host
+        self.port = port
+        self.max_body_bytes = max_body_bytes
+        self.server = None
+        self.batcher_task = None
+
+
+    async def start(self):
+        '''
+        Starts the micro-batcher and begins accepting connections
+            Arguments:
+                None
+            Returns:
+                None
+        '''
+        self.batcher_task = asyncio.ensure_future(self.batcher.run())
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        # the bound port (if any free port was requested)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+
+    async def stop(self):
+        '''
+        Stops accepting connections and cancels the micro-batcher
+            Arguments:
+                None
+            Returns:
+                None
+        '''
+        self.server.close()
+        await self.server.wait_closed()
+        self.batcher_task.cancel()
+        try:
+            await self.batcher_task
+        except asyncio.CancelledError:
+            pass
+
+
+    async def serve_forever(self):
+        '''
+        Starts the server and serves until cancelled
+            Arguments:
+                None
+            Returns:
+                None
+        '''
+        await self.start()
+        print('serving on http://{}:{}'.format(self.host, self.port))
+        try:
+            while True:
+                await asyncio.sleep(3600)
+        finally:
+            await self.stop()
+
+
+    async def handle_connection(self, reader, writer):
+        '''
+        Handles the (keep-alive) requests of a connection
+            Arguments:
+                reader: Stream reader
+                writer: Stream writer
+            Returns:
+                None
+        '''
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, version = (request_line.decode('latin-1').split()+['', '', ''])[:3]
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, _, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                try:
+                    length = int(headers.get('content-length', 0) or 0)
+                except ValueError:
+                    length = -1
+                # the body of a request with an invalid length can't be skipped, so the connection is closed
+                if length < 0:
+                    await self.respond(writer, 400, {'error': 'invalid Content-Length'}, keep_alive=False)
+                    break
+                if length > self.max_body_bytes:
+                    await self.respond(writer, 413, {'error': 'request body too large'}, keep_alive=False)
+                    break
+                body = await reader.readexactly(length) if length > 0 else b''
+                keep_alive = headers.get('connection', '').lower() != 'close' and version != 'HTTP/1.0'
+                status, content = await self.route(method, path.split('?')[0], body)
+                await self.respond(writer, status, content, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+    async def route(self, method, path, body):
+        '''
+        Routes a request to its endpoint
+            Arguments:
+                method: HTTP method
+                path: Request path
+                body: Request body
+            Returns:
+                status code, response content
+        '''
+        if path in ('/health', '/metrics'):
+            if method != 'GET':
+                return 405, {'error': 'use GET'}
+            return 200, {'status': 'ok', 'metrics': self.batcher.metrics()}
+        elif path == '/predict':
+            if method != 'POST':
+                return 405, {'error': 'use POST'}
+            try:
+                content = json.loads(body.decode('utf-8'))
+                entries = content.get('texts', content.get('entries')) if isinstance(content, dict) else content
+                if not isinstance(entries, list):
+                    raise ValueError('expected a list of texts or entries')
+                entries = [normalize_entry(entry) for entry in entries]
+            except ValueError as exception:
+                return 400, {'error': str(exception)}
+            if len(entries) == 0:
+                return 200, {'predictions': []}
+            try:
+                return 200, {'predictions': await self.batcher.submit(entries)}
+            except Exception as exception:
+                return 500, {'error': str(exception)}
+        else:
+            return 404, {'error': 'unknown path {}'.format(path)}
+
+
+    async def respond(self, writer, status, content, keep_alive=True):
+        '''
+        Writes a JSON response
+            Arguments:
+                writer: Stream writer
+                status: Status code
+                content: JSON-serializable response content
+                keep_alive: Boolean for whether the connection is kept open
+            Returns:
+                None
+        '''
+        body = json.dumps(content).encode('utf-8')
+        head = ['HTTP/1.1 {} {}'.format(status, status_reasons[status]), 'Content-Type: application/json',
+                'Content-Length: {}'.format(len(body)), 'Connection: {}'.format('keep-alive' if keep_alive else 'close')]
+        writer.write(('\r\n'.join(head)+'\r\n\r\n').encode('latin-1')+body)
+        await writer.drain()
+
+
+def parse_args():
+    '''
+    Parses command-line arguments
+    '''
+    parser = argparse.ArgumentParser(description='local HTTP inference server for MatBERT NER with dynamic micro-batching')
+    parser.add_argument('-pp', '--package_path', help='path to a single-file model package (replaces the model file and state path)',
+                        type=str, default=None)
+    parser.add_argument('-mf', '--model_file', help='path to BERT model file',
+                        type=str, default=None)
+    parser.add_argument('-sp', '--state_path', help='path to fine-tuned model state',
+                        type=str, default=None)
+    parser.add_argument('-ts', '--tag_scheme', help='tagging scheme of the model state (e.g. iob2, iobes)',
+                        type=str, default='iobes')
+    parser.add_argument('-cc', '--constrained_crf', help='switch for treating invalid crf transitions as hard constraints instead of penalties',
+                        action='store_true')
+    parser.add_argument('-dv', '--device', help='computation device for model (e.g. cpu, gpu:0, gpu:1)',
+                        type=str, default='cpu')
+    parser.add_argument('-bs', '--batch_size', help='maximum number of sequences in each model batch',
+                        type=int, default=256)
+    parser.add_argument('-mt', '--max_tokens', help='maximum number of (padded) tokens per model batch',
+                        type=int, default=None)
+    parser.add_argument('-mb', '--max_batch_tokens', help='maximum (estimated) number of tokens coalesced into a micro-batch',
+                        type=int, default=16384)
+    parser.add_argument('-mw', '--max_wait', help='maximum time in milliseconds a request waits for other requests to join its micro-batch',
+                        type=float, default=10.0)
+    parser.add_argument('-wb', '--warmup_batches', help='number of warm-up batches predicted before serving',
+                        type=int, default=1)
+    parser.add_argument('-cd', '--cache_dir', help='directory for persistent preprocessing caches (e.g. pre-tokenized text)',
+                        type=str, default=None)
+    parser.add_argument('-ho', '--host', help='host to bind to',
+                        type=str, default='127.0.0.1')
+    parser.add_argument('-po', '--port', help='port to bind to',
+                        type=int, default=8000)
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    predictor = Predictor(model_file=args.model_file, state_path=args.state_path, package_path=args.package_path, scheme=args.tag_scheme.upper(),
+                          batch_size=args.batch_size, max_tokens=args.max_tokens, device=args.device, constrained_crf=args.constrained_crf,
+                          cache_dir=args.cache_dir, warmup_batches=args.warmup_batches)
+    server = NERServer(MicroBatcher(predictor, max_batch_tokens=args.max_batch_tokens, max_wait=args.max_wait/1000), host=args.host, port=args.port)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        predictor.close()
@@ -0,0 +1,101 @@
+import sys
+import json
+import argparse
+import subprocess
+
+
+# dependencies that should only be imported on first use
+deferred_modules = ['chemdataextractor', 'gensim', 'pymatgen', 'monty', 'torchtools', 'seqeval']
+
+# statement timed in a fresh interpreter for each module import
+import_statement = '''
+import sys, json, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter()-start
+print(json.dumps({{'time': elapsed, 'loaded': [m for m in {deferred} if m in sys.modules]}}))
+'''
+
+# statement timed in a fresh interpreter for a cold prediction (imports, model load, and prediction)
+predict_statement = '''
+import sys, json, time
+start = time.perf_counter()
+from matbert_ner.predict import predict
+import_time = time.perf_counter()-start
+predict({texts}, False, {model_file}, {state_path}, device={device})
+elapsed = time.perf_counter()-start
+print(json.dumps({{'import_time': import_time, 'time': elapsed, 'loaded': [m for m in {deferred} if m in sys.modules]}}))
+'''
+
+
+def run_statement(statement):
+    '''
+    Runs a statement in a fresh interpreter and returns its JSON output
+        Arguments:
+            statement: Python statement that prints a JSON dictionary as its last line
+        Returns:
+            Dictionary parsed from the output
+    '''
+    output = subprocess.run([sys.executable, '-c', statement], stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+    return json.loads(output.strip().split('\n')[-1])
+
+
+def benchmark_import(module, repeats):
+    '''
+    Measures the time to import a module in fresh interpreters
+        Arguments:
+            module: Name of the module
+            repeats: Number of fresh interpreters
+        Returns:
+            Minimum import time and the deferred dependencies that were loaded by the import
+    '''
+    results = [run_statement(import_statement.format(module=module, deferred=repr(deferred_modules))) for _ in range(repeats)]
+    return min(result['time'] for result in results), results[0]['loaded']
+
+
+def benchmark_predict(texts, model_file, state_path, device, repeats):
+    '''
+    Measures the time of a cold prediction (in fresh interpreters)
+        Arguments:
+            texts: List of texts to predict
+            model_file: Path to BERT model file
+            state_path: Path to model state
+            device: Computation device
+            repeats: Number of fresh interpreters
+        Returns:
+            Minimum import and total times and the deferred dependencies that were loaded by the prediction
+    '''
+    statement = predict_statement.format(texts=repr(texts), model_file=repr(model_file), state_path=repr(state_path), device=repr(device), deferred=repr(deferred_modules))
+    results = [run_statement(statement) for _ in range(repeats)]
+    return min(result['import_time'] for result in results), min(result['time'] for result in results), results[0]['loaded']
+
+
+def parse_args():
+    '''
+    Parses command-line arguments
+    '''
+    parser = argparse.ArgumentParser(description='startup time benchmark for imports and cold predictions')
+    parser.add_argument('-md', '--modules', help='comma-separated modules to time the import of',
+                        type=str, default='matbert_ner,matbert_ner.predict,matbert_ner.utils.data,matbert_ner.models.model_trainer')
+    parser.add_argument('-mf', '--model_file', help='path to BERT model file for the cold prediction (skipped if not provided)',
+                        type=str, default=None)
+    parser.add_argument('-sp', '--state_path', help='path to model state for the cold prediction',
+                        type=str, default=None)
+    parser.add_argument('-tx', '--text', help='text for the cold prediction',
+                        type=str, default='The perovskite SrTiO3 was synthesized by a solid state reaction at 1200 K.')
+    parser.add_argument('-dv', '--device', help='computation device for the cold prediction',
+                        type=str, default='cpu')
+    parser.add_argument('-rp', '--repeats', help='number of fresh interpreters per measurement (minimum time is reported)',
+                        type=int, default=3)
+    args = parser.parse_args()
+    return args.modules.split(','), args.model_file, args.state_path, args.text, args.device, args.repeats
+
+
+if __name__ == '__main__':
+    modules, model_file, state_path, text, device, repeats = parse_args()
+    for module in modules:
+        elapsed, loaded = benchmark_import(module, repeats)
+        print('import {}: {:.3f} s (deferred dependencies loaded: {})'.format(module, elapsed, ', '.join(loaded) if loaded else 'none'))
+    if model_file is not None:
+        import_time, elapsed, loaded = benchmark_predict([text], model_file, state_path, device, repeats)
+        print('cold predict: {:.3f} s, {:.3f} s of which importing (deferred dependencies loaded: {})'.format(elapsed, import_time, ', '.join(loaded) if loaded else 'none'))
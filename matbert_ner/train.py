@@ -36,6 +36,15 @@ def parse_args():
     parser.add_argument('-bs', '--batch_size',
                         help='number of samples in each batch',
                         type=int, default=10)
+    parser.add_argument('-mt', '--max_tokens',
+                        help='maximum number of (padded) tokens per batch, with the batch size as the maximum number of entries',
+                        type=int, default=None)
+    parser.add_argument('-nw', '--num_workers',
+                        help='number of worker processes loading batches in the background (0 to load batches in the main process)',
+                        type=int, default=0)
+    parser.add_argument('-pf', '--prefetch_factor',
+                        help='number of batches loaded in advance by each worker process',
+                        type=int, default=2)
     parser.add_argument('-on', '--optimizer_name',
                         help='name of optimizer, add "_lookahead" to implement lookahead on top of optimizer (not recommended for ranger or rangerlars)',
                         type=str, default='lamb')
@@ -64,22 +73,48 @@ def parse_args():
                         help='function for learning rate scheduler (linear, exponential, or cosine)',
                         type=str, default='exponential')
     parser.add_argument('-km', '--keep_model',
-                        help='switch for saving the best model parameters to disk',
+                        help='switch for saving the best model parameters (and a single-file inference package) to disk',
                         action='store_true')
+    parser.add_argument('-cc', '--constrained_crf',
+                        help='switch for treating invalid crf transitions as hard constraints instead of penalties',
+                        action='store_true')
+    parser.add_argument('-mi', '--metric_interval',
+                        help='number of training batches between batches that are decoded for metrics (0 for loss-only training progress)',
+                        type=int, default=1)
+    parser.add_argument('-br', '--batch_reports',
+                        help='switch for storing full per-batch classification reports in the history',
+                        action='store_true')
+    parser.add_argument('-cd', '--cache_dir',
+                        help='directory for persistent preprocessing caches (word-pieces and featurized data files)',
+                        type=str, default=None)
     args = parser.parse_args()
     return (args.device, args.seeds, args.tag_schemes, args.splits, args.datasets,
-            args.models, args.sentence_level, args.batch_size, args.optimizer_name, args.weight_decay,
+            args.models, args.sentence_level, args.batch_size, args.max_tokens, args.num_workers, args.prefetch_factor, args.optimizer_name, args.weight_decay,
             args.n_epoch, args.embedding_unfreeze, args.transformer_unfreeze,
             args.embedding_learning_rate, args.transformer_learning_rate, args.classifier_learning_rate,
-            args.scheduling_function, args.keep_model)
+            args.scheduling_function, args.keep_model, args.constrained_crf, args.metric_interval, args.batch_reports, args.cache_dir)
+
+
+def epoch_f1(epoch_metrics):
+    '''
+    Retrieve the micro-averaged f1-score of an epoch from the history
+        Arguments:
+            epoch_metrics: Epoch metrics (a report accumulated over the epoch, or a list of per-batch reports in older histories)
+        Returns:
+            f1-score
+    '''
+    if isinstance(epoch_metrics, dict):
+        return epoch_metrics['micro avg']['f1-score']
+    else:
+        return np.mean([batch['micro avg']['f1-score'] for batch in epoch_metrics])
 
 
 if __name__ == '__main__':
     # retrieve command line arguments
     (device, seeds, tag_schemes, splits, datasets,
-     models, sentence_level, batch_size, optimizer_name, weight_decay,
+     models, sentence_level, batch_size, max_tokens, num_workers, prefetch_factor, optimizer_name, weight_decay,
      n_epoch, embedding_unfreeze, transformer_unfreeze,
-     elr, tlr, clr, scheduling_function, keep_model) = parse_args()
+     elr, tlr, clr, scheduling_function, keep_model, constrained_crf, metric_interval, batch_reports, cache_dir) = parse_args()
     # if gpu
     if 'gpu' in device:
         # set device as cuda and retreive number
@@ -145,26 +180,30 @@ if __name__ == '__main__':
                         dataset = dataset.split('/')[-1].split('.')[-2]
                     for model in models:
                         # parameter tumple
-                        params = (model, dataset, 'sentence' if sentence_level else 'paragraph', scheme.lower(),
+                        params = (model, dataset, 'sentence' if sentence_level else 'paragraph', scheme.lower(), 'ccrf' if constrained_crf else 'crf',
                                   batch_size, optimizer_name, n_epoch, embedding_unfreeze, transformer_unfreeze.replace(',', ''),
                                   elr, tlr, clr, weight_decay, scheduling_function, seed, split)
                         # alias for save directory
-                        alias = '{}_{}_{}_{}_crf_{}_{}_{}_{}_{}_{:.0e}_{:.0e}_{:.0e}_{:.0e}_{}_{}_{}'.format(*params)
+                        alias = '{}_{}_{}_{}_{}_{}_{}_{}_{}_{}_{:.0e}_{:.0e}_{:.0e}_{:.0e}_{}_{}_{}'.format(*params)
                         save_dir = os.getcwd()+'/{}/'.format(alias)
                         print('Calculating results for {}'.format(alias))
                         # initialize ner data and split dictionary
-                        ner_data = NERData(model_files[model], scheme=scheme)
+                        ner_data = NERData(model_files[model], scheme=scheme, cache_dir=cache_dir)
                         if split == 100:
                             split_dict = {'train': split/100}
                         else:
                             split_dict = {'test': 0.1, 'valid': 0.00125*split, 'train': 0.01*split}
                         ner_data.preprocess(data_files[dataset], split_dict, is_file=True, sentence_level=sentence_level, shuffle=True, seed=seed)
-                        ner_data.create_dataloaders(batch_size=batch_size, shuffle=True, seed=seed)
+                        # print word-piece cache statistics (accumulated over the sweep)
+                        print('Word-piece cache: {hits} hits, {misses} misses ({hit_rate:.2%} hit rate), {size}/{max_size} words'.format(**ner_data.wordpiece_cache.stats()))
+                        # workers persist across the training epochs
+                        ner_data.create_dataloaders(batch_size=batch_size, shuffle=True, seed=seed, max_tokens=max_tokens,
+                                                    num_workers=num_workers, prefetch_factor=prefetch_factor, persistent_workers=num_workers > 0)
                         if split == 100:
                             ner_data.dataloaders['valid'] = None
                             ner_data.dataloaders['test'] = None
                         # construct model trainer
-                        bert_ner_trainer = NERTrainer(BERTNER(model_file=model_files[model], classes=ner_data.classes, scheme=scheme, seed=seed), device)
+                        bert_ner_trainer = NERTrainer(BERTNER(model_file=model_files[model], classes=ner_data.classes, scheme=scheme, seed=seed, constrained_crf=constrained_crf, tokenizer=ner_data.tokenizer), device, batch_reports=batch_reports, metric_interval=metric_interval)
                         # print classes
                         print('Classes: {}'.format(' '.join(ner_data.classes)))
                         # if test file already exists, skip, otherwise, train
@@ -176,12 +215,12 @@ if __name__ == '__main__':
                             if split == 100:
                                 print('{:<10}{:<10}'.format('epoch', 'training'))
                                 for i in range(len(history['training'].keys())):
-                                    metrics = {key: np.mean([batch['micro avg']['f1-score'] for batch in history[key]['epoch_{}'.format(i)]]) for key in ['training']}
+                                    metrics = {key: epoch_f1(history[key]['epoch_{}'.format(i)]) for key in ['training']}
                                     print('{:<10d}{:<10.4f}'.format(i, metrics['training']))
                             else:
                                 print('{:<10}{:<10}{:10}'.format('epoch', 'training', 'validation'))
                                 for i in range(len(history['training'].keys())):
-                                    metrics = {key: np.mean([batch['micro avg']['f1-score'] for batch in history[key]['epoch_{}'.format(i)]]) for key in ['training', 'validation']}
+                                    metrics = {key: epoch_f1(history[key]['epoch_{}'.format(i)]) for key in ['training', 'validation']}
                                     print('{:<10d}{:<10.4f}{:<10.4f}'.format(i, metrics['training'], metrics['validation']))
                         else:
                             try:
@@ -236,6 +275,10 @@ if __name__ == '__main__':
                                         f.write('{:<20}{}\n'.format(entity_type, ', '.join(entry['entities'][entity_type])))
                                     f.write(160*'-'+'\n')
                                     f.write(160*'='+'\n')
+                        # export the best model parameters as a single-file inference package
+                        if keep_model and succeeded and os.path.exists(save_dir+'best.pt'):
+                            bert_ner_trainer.load_state(state_path=save_dir+'best.pt', optimizer=False)
+                            bert_ner_trainer.save_package(save_dir+'package.safetensors')
                         if not keep_model:
                             try:
                                 os.remove(save_dir+'best.pt')
@@ -0,0 +1,503 @@
+import os
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+from collections import OrderedDict
+import numpy as np
+
+
+def hash_file(path, chunk_size=1<<20):
+    '''
+    Hashes the contents of a file
+        Arguments:
+            path: Path to the file
+            chunk_size: Number of bytes read at a time
+        Returns:
+            Hex digest of the file hash
+    '''
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def concatenate_ranges(starts, lengths):
+    '''
+    Concatenates integer ranges without a Python loop
+        Arguments:
+            starts: Array of range starts
+            lengths: Array of range lengths
+        Returns:
+            Array of the concatenated ranges
+    '''
+    # position within each range added to the start of its range
+    total = int(np.sum(lengths))
+    range_offsets = np.cumsum(lengths)-lengths
+    return np.arange(total, dtype=np.int64)-np.repeat(range_offsets, lengths)+np.repeat(starts, lengths)
+
+
+class WordPieceCache(object):
+    '''
+    A bounded (least recently used) cache mapping raw words to their BERT subtoken ids for a specific tokenizer vocabulary
+    '''
+    # caches shared across instances, keyed by tokenizer vocabulary hash
+    shared = {}
+
+    def __init__(self, vocab_hash, max_size=262144, cache_dir=None):
+        '''
+        Initializes the word-piece cache
+            Arguments:
+                vocab_hash: Hash of the tokenizer vocabulary (and normalization) the subtoken ids belong to
+                max_size: Maximum number of cached words
+                cache_dir: Optional directory the cache is persisted to (loaded from if it already exists)
+            Returns:
+                WordPieceCache object
+        '''
+        self.vocab_hash = vocab_hash
+        self.max_size = max_size
+        # cached words in order of use (least recent first)
+        self.entries = OrderedDict()
+        # lookup statistics
+        self.hits = 0
+        self.misses = 0
+        # persistence
+        self.cache_path = None
+        self.set_cache_dir(cache_dir)
+
+
+    @staticmethod
+    def hash_tokenizer(tokenizer):
+        '''
+        Hashes the vocabulary and normalization of a (fast) BERT tokenizer
+            Arguments:
+                tokenizer: BertTokenizerFast object
+            Returns:
+                Hex digest of the tokenizer hash
+        '''
+        # serialized tokenizer without the (mutable) truncation and padding settings
+        state = json.loads(tokenizer.backend_tokenizer.to_str())
+        state.pop('truncation', None)
+        state.pop('padding', None)
+        return hashlib.sha256(json.dumps(state, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+    @classmethod
+    def from_tokenizer(cls, tokenizer, max_size=262144, cache_dir=None):
+        '''
+        Retrieves the cache shared by all tokenizers with the same vocabulary, creating it if necessary
+            Arguments:
+                tokenizer: BertTokenizerFast object
+                max_size: Maximum number of cached words
+                cache_dir: Optional directory the cache is persisted to
+            Returns:
+                WordPieceCache object
+        '''
+        vocab_hash = cls.hash_tokenizer(tokenizer)
+        if vocab_hash not in cls.shared:
+            cls.shared[vocab_hash] = cls(vocab_hash, max_size, cache_dir)
+        else:
+            cache = cls.shared[vocab_hash]
+            # the largest requested size is kept
+            cache.max_size = max(cache.max_size, max_size)
+            if cache_dir is not None:
+                cache.set_cache_dir(cache_dir)
+        return cls.shared[vocab_hash]
+
+
+    def set_cache_dir(self, cache_dir):
+        '''
+        Sets the directory the cache is persisted to, merging in the entries already saved there
+            Arguments:
+                cache_dir: Directory for the cache file (None for no persistence)
+            Returns:
+                None
+        '''
+        if cache_dir is None:
+            return
+        cache_path = os.path.join(cache_dir, 'wordpiece_{}.json'.format(self.vocab_hash[:16]))
+        if cache_path != self.cache_path:
+            self.cache_path = cache_path
+            if os.path.exists(self.cache_path):
+                self.load()
+
+
+    def lookup(self, words, encode):
+        '''
+        Retrieves the subtoken ids for a list of words, encoding (and caching) the words that are missing in a single call
+            Arguments:
+                words: List of raw words
+                encode: Function mapping a list of unique words to a list of their subtoken ids
+            Returns:
+                List of subtoken id tuples, one for each word
+        '''
+        # unique words in order of appearance
+        pieces = dict.fromkeys(words)
+        missing = []
+        for word in pieces:
+            ids = self.entries.get(word)
+            if ids is None:
+                missing.append(word)
+            else:
+                # mark as recently used
+                self.entries.move_to_end(word)
+                pieces[word] = ids
+        if len(missing) > 0:
+            for word, ids in zip(missing, encode(missing)):
+                pieces[word] = self.entries[word] = tuple(ids)
+            # evict least recently used words
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        # every occurrence beyond the first encoding of a word is a hit
+        self.misses += len(missing)
+        self.hits += len(words)-len(missing)
+        return [pieces[word] for word in words]
+
+
+    def stats(self):
+        '''
+        Retrieves the cache statistics
+            Arguments:
+                None
+            Returns:
+                Dictionary of hits, misses, hit rate, size, and maximum size
+        '''
+        lookups = self.hits+self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits/lookups if lookups > 0 else 0.0,
+                'size': len(self.entries), 'max_size': self.max_size}
+
+
+    def load(self):
+        '''
+        Loads cached words from the cache file (entries already in memory take precedence)
+            Arguments:
+                None
+            Returns:
+                None
+        '''
+        with open(self.cache_path, 'r') as f:
+            content = json.load(f)
+        # ignore caches written for a different vocabulary
+        if content.get('vocab_hash') != self.vocab_hash:
+            return
+        entries = OrderedDict((word, tuple(ids)) for word, ids in content['entries'])
+        entries.update(self.entries)
+        while len(entries) > self.max_size:
+            entries.popitem(last=False)
+        self.entries = entries
+
+
+    def save(self):
+        '''
+        Saves the cached words to the cache file (if persistence is enabled)
+            Arguments:
+                None
+            Returns:
+                None
+        '''
+        if self.cache_path is None:
+            return
+        os.makedirs(os.path.dirname(self.cache_path) or '.', exist_ok=True)
+        # write to a temporary file and swap it in so that concurrent readers never see a partial file
+        tmp_path = '{}.{}.tmp'.format(self.cache_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'vocab_hash': self.vocab_hash, 'entries': list(self.entries.items())}, f)
+        os.replace(tmp_path, self.cache_path)
+
+
+class FeatureCache(object):
+    '''
+    A content-addressed on-disk cache of a featurized corpus, stored as memory-mapped arrays of the concatenated sequences of every entry
+    '''
+    # format version (bump to invalidate existing caches when the featurization changes)
+    version = 4
+    # per-token arrays and their storage types
+    token_arrays = {'token_ids': np.int32, 'label_ids': np.uint8, 'valid_mask': np.uint8}
+
+    def __init__(self, cache_dir, key):
+        '''
+        Initializes the feature cache
+            Arguments:
+                cache_dir: Directory containing the feature caches
+                key: Hash of every input that determines the features
+            Returns:
+                FeatureCache object
+        '''
+        self.key = key
+        self.path = os.path.join(cache_dir, 'features_{}'.format(key[:32]))
+        # cached contents (populated by load)
+        self.classes = None
+        self.entries = None
+        self.arrays = None
+
+
+    @classmethod
+    def from_inputs(cls, cache_dir, data_file, tokenizer_hash, scheme, annotated, sentence_level, token_limit):
+        '''
+        Constructs the feature cache addressed by the data file contents, the tokenizer, and the preprocessing options
+            Arguments:
+                cache_dir: Directory containing the feature caches
+                data_file: Path to data file
+                tokenizer_hash: Hash of the tokenizer vocabulary and normalization
+                scheme: Labeling scheme
+                annotated: Boolean for whether the data is annotated
+                sentence_level: Boolean for whether sentences are separate entries
+                token_limit: Maximum number of tokens in a sequence
+            Returns:
+                FeatureCache object
+        '''
+        inputs = {'version': cls.version, 'data': hash_file(data_file), 'tokenizer': tokenizer_hash, 'scheme': scheme,
+                  'annotated': annotated, 'sentence_level': sentence_level, 'token_limit': token_limit}
+        return cls(cache_dir, hashlib.sha256(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest())
+
+
+    def exists(self):
+        '''
+        Checks whether the cache has been written
+            Arguments:
+                None
+            Returns:
+                Boolean
+        '''
+        return os.path.exists(os.path.join(self.path, 'meta.json'))
+
+
+    def save(self, classes, entries, features):
+        '''
+        Writes the featurized corpus to the cache
+            Arguments:
+                classes: A list of classes (labels)
+                entries: List of labeled entries in the form [{'id': ..., 'meta': ..., 'tokens': [{'text': [...], 'label_ids': [...]},...]},...]
+                features: List of (unpadded) sequence features in entry order, each with the 'id' of its entry and part 'pt'
+            Returns:
+                None
+        '''
+        # position of each entry id
+        entry_index = {entry['id']: i for i, entry in enumerate(entries)}
+        # sequence lengths and offsets into the concatenated token arrays
+        lengths = np.array([len(d['token_ids']) for d in features], dtype=np.int64)
+        arrays = {'offsets': np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+                  'pts': np.array([d['pt'] for d in features], dtype=np.int32),
+                  # offsets of the sequences of each entry
+                  'entry_offsets': np.searchsorted([entry_index[d['id']] for d in features], np.arange(len(entries)+1)).astype(np.int64)}
+        for key, dtype in self.token_arrays.items():
+            arrays[key] = np.fromiter((v for d in features for v in d[key]), dtype=dtype, count=int(lengths.sum()))
+        # write to a temporary directory and move it into place so that concurrent readers never see a partial cache
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = tempfile.mkdtemp(dir=os.path.dirname(self.path) or '.', prefix='.tmp_features_')
+        for key, array in arrays.items():
+            np.save(os.path.join(tmp_path, key+'.npy'), array)
+        with open(os.path.join(tmp_path, 'entries.json'), 'w') as f:
+            json.dump(entries, f)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump({'key': self.key, 'version': self.version, 'classes': classes,
+                       'entries': len(entries), 'sequences': len(features)}, f)
+        try:
+            os.rename(tmp_path, self.path)
+        except OSError:
+            # another process wrote the same cache first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+    def load(self):
+        '''
+        Loads the classes and labeled entries and memory-maps the feature arrays
+            Arguments:
+                None
+            Returns:
+                classes, entries
+        '''
+        with open(os.path.join(self.path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        with open(os.path.join(self.path, 'entries.json'), 'r') as f:
+            self.entries = json.load(f)
+        self.classes = meta['classes']
+        # plain array views of the memory maps (slicing np.memmap objects directly is slow)
+        self.arrays = {key: np.asarray(np.load(os.path.join(self.path, key+'.npy'), mmap_mode='r'))
+                       for key in ['offsets', 'pts', 'entry_offsets', *self.token_arrays.keys()]}
+        return self.classes, self.entries
+
+
+    def gather(self, entry_indices):
+        '''
+        Gathers the sequences of a list of entries into concatenated arrays
+            Arguments:
+                entry_indices: Positions of the entries in the cache
+            Returns:
+                Dictionary of sequence entry ids ('ids'), parts ('pts'), and offsets ('offsets') with the concatenated per-token arrays
+        '''
+        entry_indices = np.asarray(entry_indices, dtype=np.int64)
+        entry_offsets = self.arrays['entry_offsets']
+        offsets = self.arrays['offsets']
+        # positions of the sequences of the entries
+        counts = entry_offsets[entry_indices+1]-entry_offsets[entry_indices]
+        sequences = concatenate_ranges(entry_offsets[entry_indices], counts)
+        # positions of the tokens of the sequences
+        lengths = offsets[sequences+1]-offsets[sequences]
+        tokens = concatenate_ranges(offsets[sequences], lengths)
+        arrays = {'ids': np.repeat(np.array([self.entries[i]['id'] for i in entry_indices], dtype=np.int32), counts),
+                  'pts': self.arrays['pts'][sequences].astype(np.int32),
+                  'offsets': np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)}
+        arrays.update({key: self.arrays[key][tokens] for key in self.token_arrays.keys()})
+        return arrays
+
+
+class TokenizationCache(object):
+    '''
+    An on-disk (SQLite) cache of pre-tokenized text that is safe for concurrent use by multiple processes. Entries are evicted least recently used first
+    '''
+    def __init__(self, path, signature, max_bytes=1<<30):
+        '''
+        Initializes the tokenization cache
+            Arguments:
+                path: Path to the SQLite database file
+                signature: String identifying the tokenizer version and options (part of every key)
+                max_bytes: Maximum size of the cached values in bytes, beyond which the least recently used entries are evicted
+            Returns:
+                TokenizationCache object
+        '''
+        self.path = path
+        self.signature = signature
+        self.max_bytes = max_bytes
+        # connection (opened on first use in each process)
+        self.connection = None
+        self.pid = None
+        # lookup statistics
+        self.hits = 0
+        self.misses = 0
+
+
+    def connect(self):
+        '''
+        Opens the database connection for the current process, creating the database if necessary
+            Arguments:
+                None
+            Returns:
+                SQLite connection
+        '''
+        # connections must not be shared with forked processes
+        if self.connection is None or self.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            # wait for concurrent writers instead of failing
+            self.connection = sqlite3.connect(self.path, timeout=60)
+            # write-ahead logging lets readers proceed concurrently with a writer
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            with self.connection:
+                self.connection.execute('CREATE TABLE IF NOT EXISTS sentences (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, time REAL NOT NULL)')
+                self.connection.execute('CREATE INDEX IF NOT EXISTS sentences_time ON sentences (time)')
+                # running total of the cached bytes, kept up to date by triggers in the same transaction as every write (initialized from existing databases)
+                self.connection.execute('CREATE TABLE IF NOT EXISTS meta (id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER NOT NULL)')
+                self.connection.execute('INSERT OR IGNORE INTO meta (id, bytes) VALUES (0, (SELECT COALESCE(SUM(size), 0) FROM sentences))')
+                self.connection.execute('CREATE TRIGGER IF NOT EXISTS sentences_insert AFTER INSERT ON sentences BEGIN UPDATE meta SET bytes = bytes+NEW.size WHERE id = 0; END')
+                self.connection.execute('CREATE TRIGGER IF NOT EXISTS sentences_delete AFTER DELETE ON sentences BEGIN UPDATE meta SET bytes = bytes-OLD.size WHERE id = 0; END')
+                self.connection.execute('CREATE TRIGGER IF NOT EXISTS sentences_update AFTER UPDATE OF size ON sentences BEGIN UPDATE meta SET bytes = bytes+NEW.size-OLD.size WHERE id = 0; END')
+            self.pid = os.getpid()
+        return self.connection
+
+
+    def key(self, text):
+        '''
+        Hashes a text together with the tokenizer signature
+            Arguments:
+                text: Raw text
+            Returns:
+                Hex digest of the key
+        '''
+        return hashlib.sha256('{}\0{}'.format(self.signature, text).encode('utf-8')).hexdigest()
+
+
+    def get_many(self, texts, chunk_size=512):
+        '''
+        Retrieves the cached pre-tokenized sentences for a list of texts, marking the found entries as recently used
+            Arguments:
+                texts: List of raw texts
+                chunk_size: Number of keys per query
+            Returns:
+                Dictionary of sentences (lists of tokens) by text for the texts found in the cache
+        '''
+        connection = self.connect()
+        keys = {self.key(text): text for text in texts}
+        key_list = list(keys.keys())
+        found = {}
+        found_keys = []
+        for i in range(0, len(key_list), chunk_size):
+            chunk = key_list[i:i+chunk_size]
+            query = 'SELECT key, value FROM sentences WHERE key IN ({})'.format(','.join(len(chunk)*['?']))
+            for key, value in connection.execute(query, chunk):
+                found[keys[key]] = json.loads(value)
+                found_keys.append(key)
+        # update the access times of the hits for least recently used eviction
+        if len(found_keys) > 0:
+            now = time.time()
+            with connection:
+                for i in range(0, len(found_keys), chunk_size):
+                    chunk = found_keys[i:i+chunk_size]
+                    connection.execute('UPDATE sentences SET time = ? WHERE key IN ({})'.format(','.join(len(chunk)*['?'])), [now]+chunk)
+        self.hits += len(found)
+        self.misses += len(keys)-len(found)
+        return found
+
+
+    def put_many(self, sentences):
+        '''
+        Stores pre-tokenized sentences, evicting the least recently used entries if the cache exceeds its size
+            Arguments:
+                sentences: Dictionary of sentences (lists of tokens) by text
+            Returns:
+                None
+        '''
+        if len(sentences) == 0:
+            return
+        connection = self.connect()
+        now = time.time()
+        rows = []
+        for text, value in sentences.items():
+            value = json.dumps(value, ensure_ascii=False)
+            rows.append((self.key(text), value, len(value.encode('utf-8')), now))
+        with connection:
+            # upsert (instead of replace) so that the size triggers see replaced entries as updates
+            connection.executemany('INSERT INTO sentences (key, value, size, time) VALUES (?, ?, ?, ?) '
+                                   'ON CONFLICT(key) DO UPDATE SET value = excluded.value, size = excluded.size, time = excluded.time', rows)
+        self.evict()
+
+
+    def evict(self):
+        '''
+        Evicts the least recently used entries until the cached values fit in the maximum size
+            Arguments:
+                None
+            Returns:
+                None
+        '''
+        connection = self.connect()
+        excess = connection.execute('SELECT bytes FROM meta WHERE id = 0').fetchone()[0]-self.max_bytes
+        if excess <= 0:
+            return
+        keys = []
+        for key, size in connection.execute('SELECT key, size FROM sentences ORDER BY time'):
+            keys.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        with connection:
+            connection.executemany('DELETE FROM sentences WHERE key = ?', keys)
+
+
+    def stats(self):
+        '''
+        Retrieves the cache statistics
+            Arguments:
+                None
+            Returns:
+                Dictionary of hits, misses, hit rate, size (entries), bytes, and maximum bytes
+        '''
+        connection = self.connect()
+        size = connection.execute('SELECT COUNT(*) FROM sentences').fetchone()[0]
+        n_bytes = connection.execute('SELECT bytes FROM meta WHERE id = 0').fetchone()[0]
+        lookups = self.hits+self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits/lookups if lookups > 0 else 0.0,
+                'size': size, 'bytes': n_bytes, 'max_bytes': self.max_bytes}
@@ -1,29 +1,396 @@
 import json
-from transformers import BertTokenizer
+import re
+from transformers import BertTokenizerFast
 import random
+import multiprocessing
 import numpy as np
+from itertools import chain, islice
+from collections import Counter, OrderedDict
+from functools import partial
 import torch
-from torch.utils.data import DataLoader, TensorDataset
+from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import Dataset, IterableDataset, Sampler, DataLoader
 from tqdm import tqdm
 from matbert_ner.utils.tokenizer import MaterialsTextTokenizer
+from matbert_ner.utils.cache import WordPieceCache, FeatureCache, TokenizationCache
 from pathlib import Path
+import os
+
+
+# materials text tokenizer of a pre-tokenization worker process
+worker_pre_tokenizer = None
+# options for processing pre-tokenized sentences of unannotated entries
+pre_tokenize_options = {'convert_number': False, 'normalize_materials': False}
+
+
+def pre_tokenize(pre_tokenizer, entry):
+    '''
+    Pre-tokenizes an unannotated entry into sentences of tokens (entries that are already tokenized are passed through)
+        Arguments:
+            pre_tokenizer: MaterialsTextTokenizer object
+            entry: Filtered entry with either tokens, sentences, or text
+        Returns:
+            List of sentences, each a list of tokens
+    '''
+    try:
+        sents = entry['tokens']
+    except:
+        try:
+            sents = [pre_tokenizer.process(sent, **pre_tokenize_options) for sent in entry['sents']]
+        except:
+            sents = [pre_tokenizer.process(sent, **pre_tokenize_options) for sent in pre_tokenizer.tokenize(entry['text'], keep_sentences=True)]
+    return sents
+
+
+def init_pre_tokenize_worker(phraser_path):
+    '''
+    Initializes the materials text tokenizer (and phraser) once per pre-tokenization worker process
+        Arguments:
+            phraser_path: Path to the phraser
+        Returns:
+            None
+    '''
+    global worker_pre_tokenizer
+    worker_pre_tokenizer = MaterialsTextTokenizer(phraser_path)
+
+
+def pre_tokenize_worker(entry):
+    '''
+    Pre-tokenizes an unannotated entry in a worker process
+        Arguments:
+            entry: Filtered entry with either tokens, sentences, or text
+        Returns:
+            List of sentences, each a list of tokens
+    '''
+    return pre_tokenize(worker_pre_tokenizer, entry)
+
+
+def iterate_json(data_file, chunk_size=1<<20):
+    '''
+    Incrementally parses the entries of a JSON file, either a JSON array of entries or JSON lines (one entry per line)
+        Arguments:
+            data_file: Path to data file
+            chunk_size: Number of characters read at a time from a JSON array
+        Returns:
+            Generator of entries
+    '''
+    decoder = json.JSONDecoder()
+    separators = re.compile(r'[\s,]*')
+    delimiter = re.compile(r'\s*[,\]]')
+    with open(data_file, 'r') as f:
+        buffer = f.read(chunk_size)
+        pos = separators.match(buffer).end()
+        # JSON lines
+        if buffer[pos:pos+1] != '[':
+            f.seek(0)
+            for l in f:
+                if l.strip():
+                    yield json.loads(l)
+            return
+        # JSON array, decoded one entry at a time from a buffer that is refilled as needed
+        pos += 1
+        eof = False
+        while True:
+            pos = separators.match(buffer, pos).end()
+            if pos < len(buffer) and buffer[pos] == ']':
+                return
+            try:
+                entry, end = decoder.raw_decode(buffer, pos)
+                # an entry is only complete once its delimiter has been read (e.g. a number may continue in the next chunk)
+                complete = eof or delimiter.match(buffer, end) is not None
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                complete = False
+            if complete:
+                yield entry
+                pos = end
+            else:
+                content = f.read(chunk_size)
+                eof = len(content) == 0
+                buffer = buffer[pos:]+content
+                pos = 0
+
+
+def linear_partition(weights, capacity):
+    '''
+    Partitions a sequence of weights into the fewest consecutive groups with sums no greater than the capacity, balanced by minimizing the largest sum
+        Arguments:
+            weights: List of non-negative weights, none greater than the capacity
+            capacity: Maximum sum of a group
+        Returns:
+            List of (start, end) bounds of the groups
+    '''
+    def fill(bound):
+        # greedily fill each group up to the bound
+        bounds = []
+        start = 0
+        total = 0
+        for i, weight in enumerate(weights):
+            if total+weight > bound and i > start:
+                bounds.append((start, i))
+                start = i
+                total = 0
+            total += weight
+        bounds.append((start, len(weights)))
+        return bounds
+    # greedy filling to the capacity gives the fewest groups
+    n_groups = len(fill(capacity))
+    # binary search for the smallest bound that still gives the fewest groups
+    lower, upper = max(max(weights), -(-sum(weights)//n_groups)), capacity
+    while lower < upper:
+        middle = (lower+upper)//2
+        if len(fill(middle)) <= n_groups:
+            upper = middle
+        else:
+            lower = middle+1
+    return fill(lower)
+
+
+class RaggedDataset(Dataset):
+    '''
+    A dataset of variable length sequences stored as concatenated (columnar) arrays with offsets, which are padded per batch (see pad_collate)
+    '''
+    def __init__(self, ids, pts, offsets, token_ids, label_ids, valid_mask, tokens=None, labels=None):
+        '''
+        Initializes the ragged dataset
+            Arguments:
+                ids: Array of entry ids
+                pts: Array of entry part indices
+                offsets: Array of sequence offsets into the concatenated arrays (one more than the number of sequences)
+                token_ids: Array of concatenated sequence token ids
+                label_ids: Array of concatenated sequence label ids
+                valid_mask: Array of concatenated sequence valid masks
+                tokens: Optional list of sequence token strings
+                labels: Optional list of sequence label strings
+            Returns:
+                RaggedDataset object
+        '''
+        # tensors share memory with the arrays and sequences are views into them
+        self.ids = torch.from_numpy(np.asarray(ids))
+        self.pts = torch.from_numpy(np.asarray(pts))
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.token_ids = torch.from_numpy(np.asarray(token_ids))
+        self.label_ids = torch.from_numpy(np.asarray(label_ids))
+        self.valid_mask = torch.from_numpy(np.asarray(valid_mask, dtype=bool))
+        self.tokens = tokens
+        self.labels = labels
+        # sequence lengths (attention masks are derived from these)
+        self.lengths = self.offsets[1:]-self.offsets[:-1]
+
+
+    def __len__(self):
+        return len(self.ids)
+
+
+    def __getitem__(self, index):
+        start, end = self.offsets[index], self.offsets[index+1]
+        return self.ids[index], self.pts[index], self.token_ids[start:end], self.label_ids[start:end], self.valid_mask[start:end]
+
+
+def pad_collate(batch, pad_token_id=0, pad_label_id=0):
+    '''
+    Collates a batch from a ragged dataset, padding the sequences to the longest sequence in the batch
+        Arguments:
+            batch: List of (id, pt, token_ids, label_ids, valid_mask) tuples
+            pad_token_id: Token id used for padding
+            pad_label_id: Label id used for padding
+        Returns:
+            Batch tensors (ids, pts, token_ids, label_ids, attention_mask, valid_mask)
+    '''
+    ids, pts, token_ids, label_ids, valid_mask = zip(*batch)
+    token_ids = pad_sequence(token_ids, batch_first=True, padding_value=pad_token_id).long()
+    # attention masks from the sequence lengths
+    lengths = torch.tensor([len(sequence) for sequence in valid_mask], dtype=torch.long)
+    attention_mask = torch.arange(token_ids.shape[1]).unsqueeze(0) < lengths.unsqueeze(1)
+    return (torch.stack(ids), torch.stack(pts), token_ids,
+            pad_sequence(label_ids, batch_first=True, padding_value=pad_label_id),
+            attention_mask,
+            pad_sequence(valid_mask, batch_first=True, padding_value=0))
+
+
+def seed_worker(worker_id):
+    '''
+    Seeds the numpy and python random number generators of a dataloader worker process from its torch seed
+        Arguments:
+            worker_id: Index of the worker process
+        Returns:
+            None
+    '''
+    # torch seeds each worker with the base seed drawn from the dataloader generator plus the worker index
+    worker_seed = torch.initial_seed() % 2**32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
+
+
+class BucketBatchSampler(Sampler):
+    '''
+    A batch sampler that groups sequences of similar length into the same batches, optionally under a budget of padded tokens per batch
+    '''
+    def __init__(self, lengths, batch_size, shuffle=True, bucket_batches=100, seed=None, max_tokens=None):
+        '''
+        Initializes the bucketed batch sampler
+            Arguments:
+                lengths: Sequence lengths
+                batch_size: (Maximum) number of sequences per batch
+                shuffle: If True, the sequences are shuffled and sorted by length within buckets of bucket_batches batches, after which the batches are shuffled. Otherwise, all sequences are sorted by descending length
+                bucket_batches: Number of batches per bucket. Sequences are not sorted by length if 0
+                seed: Random seed for shuffling. Will not be seeded if the seed returns a False value
+                max_tokens: Maximum number of (padded) tokens per batch, a sequence longer than the budget forms a batch of its own. Not limited if None
+            Returns:
+                BucketBatchSampler object
+        '''
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_batches = bucket_batches
+        self.max_tokens = max_tokens
+        # random state (advances between epochs)
+        self.random_state = np.random.RandomState(seed if seed else None)
+        # batches of the next epoch (constructed early if the length is requested before iterating)
+        self.next_batches = None
+
+
+    def split_bucket(self, bucket):
+        '''
+        Splits a bucket of sequence indices into consecutive batches
+            Arguments:
+                bucket: Array of sequence indices
+            Returns:
+                List of index arrays, one for each batch
+        '''
+        if self.max_tokens is None:
+            return np.split(bucket, np.arange(self.batch_size, len(bucket), self.batch_size))
+        # start a new batch whenever the next sequence would exceed the number of sequences or padded tokens
+        starts = []
+        size = 0
+        max_length = 0
+        for i, length in enumerate(self.lengths[bucket]):
+            max_length = max(max_length, length)
+            if size == 0 or size == self.batch_size or (size+1)*max_length > self.max_tokens:
+                starts.append(i)
+                size = 0
+                max_length = length
+            size += 1
+        return np.split(bucket, starts[1:])
+
+
+    def batches(self, random_state):
+        '''
+        Constructs the batches for an epoch
+            Arguments:
+                random_state: Random state for shuffling
+            Returns:
+                List of index arrays, one for each batch
+        '''
+        indices = random_state.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        if self.bucket_batches > 0:
+            # sort by descending length, within buckets if shuffling
+            bucket_size = self.batch_size*self.bucket_batches if self.shuffle else max(len(indices), 1)
+            buckets = [bucket[np.argsort(-self.lengths[bucket], kind='stable')] for bucket in np.split(indices, np.arange(bucket_size, len(indices), bucket_size))]
+        else:
+            buckets = [indices]
+        batches = [batch for bucket in buckets for batch in self.split_bucket(bucket)]
+        # shuffle batch order
+        if self.shuffle and self.bucket_batches > 0:
+            random_state.shuffle(batches)
+        return batches
+
+
+    def __iter__(self):
+        batches = self.next_batches if self.next_batches is not None else self.batches(self.random_state)
+        self.next_batches = None
+        for batch in batches:
+            yield batch.tolist()
+
+
+    def __len__(self):
+        # the number of batches may vary between epochs under a token budget, so the batches of the next epoch are constructed once and kept for its iteration
+        if self.max_tokens is None:
+            return int(np.ceil(len(self.lengths)/self.batch_size))
+        if self.next_batches is None:
+            self.next_batches = self.batches(self.random_state)
+        return len(self.next_batches)
+
+
+class StreamingDataset(IterableDataset):
+    '''
+    A dataset of padded batches streamed from chunks of preprocessed entries, so that only one chunk is held in memory at a time. Batches are bucketed by length within each chunk
+    '''
+    def __init__(self, chunks, create_dataset, collate_fn, batch_size=32, bucket_batches=100, max_tokens=None):
+        '''
+        Initializes the streaming dataset
+            Arguments:
+                chunks: Iterable of (labeled entries, sequence features) for each chunk of entries
+                create_dataset: Function creating a ragged dataset from a list of sequence features
+                collate_fn: Function collating a list of ragged dataset items into a batch
+                batch_size: (Maximum) number of sequences per batch
+                bucket_batches: Sequences in a chunk are sorted by length if greater than 0
+                max_tokens: Maximum number of (padded) tokens per batch. Not limited if None
+            Returns:
+                StreamingDataset object
+        '''
+        self.chunks = chunks
+        self.create_dataset = create_dataset
+        self.collate_fn = collate_fn
+        self.batch_size = batch_size
+        self.bucket_batches = bucket_batches
+        self.max_tokens = max_tokens
+        # entries (in order) whose sequences have been streamed but not yet consumed, by id with their number of sequences
+        self.pending = OrderedDict()
+
+
+    def __iter__(self):
+        for entries, features in self.chunks:
+            sequence_counts = Counter(d['id'] for d in features)
+            for entry in entries:
+                self.pending[entry['id']] = (entry, sequence_counts[entry['id']])
+            if len(features) == 0:
+                continue
+            dataset = self.create_dataset(features)
+            for batch in BucketBatchSampler(dataset.lengths, self.batch_size, shuffle=False, bucket_batches=self.bucket_batches, max_tokens=self.max_tokens):
+                yield self.collate_fn([dataset[i] for i in batch])
+
 
 class NERData():
     '''
     An object for handling NER data
     '''
-    def __init__(self, model_file="allenai/scibert_scivocab_uncased", scheme='IOBES'):
+    def __init__(self, model_file="allenai/scibert_scivocab_uncased", scheme='IOBES', cache_dir=None, wordpiece_cache_size=262144, tokenization_cache_bytes=1<<30, workers=1, keep_strings=False, tokenizer=None, deduplicate=True):
         '''
         Initializes the NERData object
             Arguments:
                 model_file: Path to pre-trained BERT model
                 scheme: Labeling scheme
+                cache_dir: Optional directory for persistent preprocessing caches (word-pieces, pre-tokenized text, and featurized data files)
+                wordpiece_cache_size: Maximum number of words in the word-piece cache
+                tokenization_cache_bytes: Maximum size in bytes of the pre-tokenized text cache
+                workers: Number of processes used for pre-tokenizing unannotated text
+                keep_strings: Boolean for whether the sequence features (and datasets) keep the token and label strings alongside the ids
+                tokenizer: Optional BERT tokenizer e.g. from a model package (loaded from the model file if not provided)
+                deduplicate: Boolean for whether entries with duplicate identifiers are dropped (otherwise every entry is kept e.g. for one prediction per input)
             Returns:
                 NERData object
         '''
-        # load tokenizer
-        self.pre_tokenizer = MaterialsTextTokenizer(Path(__file__).resolve().parent.as_posix()+'/phraser.pkl')
-        self.tokenizer = BertTokenizer.from_pretrained(model_file)
+        # load tokenizer (the materials text tokenizer is only constructed once untokenized text is pre-tokenized)
+        self.phraser_path = Path(__file__).resolve().parent.as_posix()+'/phraser.pkl'
+        self._pre_tokenizer = None
+        self.tokenizer = tokenizer if tokenizer is not None else BertTokenizerFast.from_pretrained(model_file)
+        # smallest integer type for the token ids
+        self.token_dtype = np.int16 if len(self.tokenizer) <= np.iinfo(np.int16).max+1 else np.int32
+        # sequence feature keys (the token and label strings are only kept if requested)
+        self.keep_strings = keep_strings
+        self.feature_keys = (['tokens', 'labels'] if keep_strings else [])+['token_ids', 'label_ids', 'valid_mask']
+        # directory for persistent caches
+        self.cache_dir = cache_dir
+        # word-piece cache (shared by all NERData objects with the same tokenizer vocabulary)
+        self.wordpiece_cache = WordPieceCache.from_tokenizer(self.tokenizer, wordpiece_cache_size, cache_dir)
+        # pre-tokenized text cache (keyed by the text, tokenizer version, and processing options)
+        if cache_dir is not None:
+            signature = json.dumps({'version': MaterialsTextTokenizer.version, 'options': pre_tokenize_options}, sort_keys=True)
+            self.tokenization_cache = TokenizationCache(os.path.join(cache_dir, 'tokenization.sqlite'), signature, tokenization_cache_bytes)
+        else:
+            self.tokenization_cache = None
         # initialize classes
         self.classes = None
         self.class_dict = None
@@ -40,10 +407,45 @@ class NERData():
         self.cls_dict = {'text': '[CLS]', 'label': 'O'}
         # labeling scheme
         self.scheme = scheme
+        # drop entries with duplicate identifiers
+        self.deduplicate = deduplicate
+        # number of entries dropped as duplicates by the last call to filter_data
+        self.duplicate_count = 0
+        # pre-tokenization processes (the pool is started on first use and kept for later calls)
+        self.workers = workers
+        self.pool = None
         # initialize dataset and dataloaders
         self.data = None
         self.dataset = None
         self.dataloaders = None
+
+
+    @property
+    def pre_tokenizer(self):
+        '''
+        Materials text tokenizer, constructed on first access (pre-tokenized entries never need it)
+            Arguments:
+                None
+            Returns:
+                MaterialsTextTokenizer object
+        '''
+        if self._pre_tokenizer is None:
+            self._pre_tokenizer = MaterialsTextTokenizer(self.phraser_path)
+        return self._pre_tokenizer
+
+
+    def close(self):
+        '''
+        Shuts down the pre-tokenization worker processes (if started)
+            Arguments:
+                None
+            Returns:
+                None
+        '''
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
     
 
     def get_classes(self, labels):
@@ -57,7 +459,7 @@ class NERData():
         # the raw classes are the provided labels
         classes_raw = labels
         # prefixes for labeling schemes
-        if self.scheme in ['IOB', 'IOB2']:
+        if self.scheme in ['IOB', 'IOB1', 'IOB2']:
             prefixes = ['I', 'B']
         elif self.scheme == 'IOBES':
             prefixes = ['B', 'I', 'E', 'S']
@@ -70,56 +472,107 @@ class NERData():
         self.class_dict = {class_: i for i, class_ in enumerate(self.classes)}
     
 
+    def entry_format(self, entry):
+        '''
+        Detects the format of a raw entry from the keys it contains
+            Arguments:
+                entry: Raw JSON entry (or string)
+            Returns:
+                identifier format ('meta_split', 'meta', 'doi', 'text', or 'index'), content key ('tokens', 'sents', 'text', or None for the entry itself), labels flag
+        '''
+        if not isinstance(entry, dict):
+            return 'index', None, False
+        meta = entry.get('meta')
+        if isinstance(meta, dict) and 'doi' in meta and 'par' in meta:
+            id_format = 'meta_split' if 'split' in meta else 'meta'
+        elif 'doi' in entry:
+            id_format = 'doi'
+        elif 'text' in entry:
+            id_format = 'text'
+        else:
+            # print('Value Error: Invalid Input Entry Format For Unique Identifier (Key(s) Missing)'+
+            #       '\nSupported Formats:'+
+            #       '\n  \{[meta][doi\}+\{[meta][par]\}+\{[meta][split]\}'+
+            #       '\n  \{[meta][doi\}+\{[meta][par]\}'+
+            #       '\n  \{[doi]\}'+
+            #       '\n  \{[text]\}')
+            id_format = 'index'
+        content_key = next((key for key in ['tokens', 'sents', 'text'] if key in entry), None)
+        return id_format, content_key, 'labels' in entry
+
+
+    def iter_filter_data(self, data):
+        '''
+        Converts raw entries to a common format as a stream and drops entries with duplicate identifiers (the first occurrence is kept) unless deduplication is disabled
+            Arguments:
+                data: Iterable of raw JSON entries (or strings)
+            Returns:
+                Generator of (unique) identifiers and filtered entries
+        '''
+        # set of entry identifiers for constant time duplicate checks
+        identifier_set = set()
+        # formats by key layout, so the format is detected once per layout (usually once per file) instead of once per entry
+        formats = {}
+        entry_count = 0
+        kept_count = 0
+        for i, entry in enumerate(data):
+            entry_count += 1
+            if isinstance(entry, dict):
+                meta = entry.get('meta')
+                layout = (frozenset(entry), frozenset(meta) if isinstance(meta, dict) else None)
+            else:
+                layout = None
+            try:
+                id_format, content_key, labeled = formats[layout]
+            except KeyError:
+                id_format, content_key, labeled = formats[layout] = self.entry_format(entry)
+            if id_format == 'meta_split':
+                identifier = '{}/{}/{}'.format(meta['doi'], str(meta['par']), str(meta['split']))
+                d = {'meta': meta}
+            elif id_format == 'meta':
+                identifier = '{}/{}'.format(meta['doi'], str(meta['par']))
+                d = {'meta': {'doi': meta['doi'], 'par': meta['par'], 'split': 0}}
+            elif id_format == 'doi':
+                identifier = entry['doi']
+                d = {'meta': {'doi': entry['doi'], 'par': 0, 'split': 0}}
+            elif id_format == 'text':
+                identifier = entry['text']
+                d = {'meta': {'doi': i, 'par': 0, 'split': 0}}
+            else:
+                identifier = i
+                d = {'meta': {'doi': i, 'par': 0, 'split': 0}}
+            if content_key is None:
+                d['text'] = entry
+            else:
+                d[content_key] = entry[content_key]
+            if labeled:
+                d['labels'] = entry['labels']
+            # only entries with unique identifiers are retrieved (if deduplicating)
+            if not self.deduplicate or identifier not in identifier_set:
+                identifier_set.add(identifier)
+                kept_count += 1
+                yield identifier, d
+        # report of entries dropped as duplicates
+        self.duplicate_count = entry_count-kept_count
+        if self.duplicate_count > 0:
+            print('dropped {} of {} entries with duplicate identifiers'.format(self.duplicate_count, entry_count))
+
+
     def filter_data(self, data):
+        '''
+        Converts raw entries to a common format and drops entries with duplicate identifiers (the first occurrence is kept)
+            Arguments:
+                data: List of raw JSON entries (or strings)
+            Returns:
+                List of unique identifiers, list of filtered entries
+        '''
         # list of entry identifiers
         identifiers = []
         # list of raw data (json entries)
         data_filt = []
-        for i, entry in enumerate(tqdm(data, desc='| filtering entries |')):
-            try:
-                identifier = '{}/{}/{}'.format(entry['meta']['doi'], str(entry['meta']['par']), str(entry['meta']['split']))
-                d = {'meta': entry['meta']}
-            except:
-                try:
-                    identifier = '{}/{}'.format(entry['meta']['doi'], str(entry['meta']['par']))
-                    d = {'meta': {'doi': entry['meta']['doi'], 'par': entry['meta']['par'], 'split': 0}}
-                except:
-                    try:
-                        identifier = entry['doi']
-                        d = {'meta': {'doi': entry['doi'], 'par': 0, 'split': 0}}
-                    except:
-                        try:
-                            identifier = entry['text']
-                            d = {'meta': {'doi': i, 'par': 0, 'split': 0}}
-                        except:
-                            # print('Value Error: Invalid Input Entry Format For Unique Identifier (Key(s) Missing)'+
-                            #       '\nSupported Formats:'+
-                            #       '\n  \{[meta][doi\}+\{[meta][par]\}+\{[meta][split]\}'+
-                            #       '\n  \{[meta][doi\}+\{[meta][par]\}'+
-                            #       '\n  \{[doi]\}'+
-                            #       '\n  \{[text]\}')
-                            identifier = i
-                            d = {'meta': {'doi': i, 'par': 0, 'split': 0}}
-            try:
-                d['tokens'] = entry['tokens']
-            except:
-                try:
-                    d['sents'] = entry['sents']
-                except:
-                    try:
-                        d['text'] = entry['text']
-                    except:
-                        d['text'] = entry
-            try:
-                d['labels'] = entry['labels']
-            except:
-                pass
-            # only entries with unique identifiers are retrieved
-            if identifier in identifiers:
-                pass
-            else:
-                identifiers.append(identifier)
-                data_filt.append(d)
+        for identifier, d in self.iter_filter_data(tqdm(data, desc='| filtering entries |')):
+            identifiers.append(identifier)
+            data_filt.append(d)
         return identifiers, data_filt
 
     
@@ -158,20 +611,55 @@ class NERData():
             Returns:
                 List of dictionaries corresponding to the JSON entries
         '''
-        # list of raw data (json entries)
-        data_raw = []
         # filter data by unique identifiers
         _, data_filt = self.filter_data(data)
-        id = 0
+        data_raw = self.pre_tokenize_entries(data_filt)
+        # fill out classes
+        self.get_classes([])
+        return data_raw
+
+
+    def pre_tokenize_entries(self, data_filt, start_id=0):
+        '''
+        Pre-tokenizes filtered unannotated entries (in worker processes if set) into sentences of tokens without annotations
+            Arguments:
+                data_filt: List of filtered entries
+                start_id: Id of the first entry
+            Returns:
+                List of dictionaries corresponding to the JSON entries
+        '''
+        # list of raw data (json entries)
+        data_raw = []
+        # entries with raw text require sentence splitting and tokenization
+        def is_text(entry):
+            return 'tokens' not in entry and 'sents' not in entry
+        # raw text is looked up in the tokenization cache (if set) and only the remaining entries are pre-tokenized
+        if self.tokenization_cache is not None:
+            cached_sents = self.tokenization_cache.get_many([entry['text'] for entry in data_filt if is_text(entry)])
+        else:
+            cached_sents = {}
+        data_pending = [entry for entry in data_filt if not (is_text(entry) and entry['text'] in cached_sents)]
+        # pre-tokenized sentences for each pending entry (in order)
+        if self.workers > 1:
+            # start worker processes on first use
+            if self.pool is None:
+                self.pool = multiprocessing.Pool(self.workers, initializer=init_pre_tokenize_worker, initargs=(self.phraser_path,))
+            # chunks of entries are distributed to the workers and the results are returned in order
+            chunksize = max(1, min(64, len(data_pending)//(4*self.workers)))
+            pending_sents = self.pool.imap(pre_tokenize_worker, data_pending, chunksize=chunksize)
+        else:
+            pending_sents = (pre_tokenize(self.pre_tokenizer, entry) for entry in data_pending)
+        # newly pre-tokenized text to add to the tokenization cache
+        new_sents = {}
+        id = start_id
         for entry in tqdm(data_filt, desc='| pre-tokenizing unannotated entries |'):
+            if is_text(entry) and entry['text'] in cached_sents:
+                sents = cached_sents[entry['text']]
+            else:
+                sents = next(pending_sents)
+                if self.tokenization_cache is not None and is_text(entry):
+                    new_sents[entry['text']] = sents
             d = {'id': id, 'meta': entry['meta'], 'tokens': []}
-            try:
-                sents = entry['tokens']
-            except:
-                try:
-                    sents = [self.pre_tokenizer.process(sent, convert_number=False, normalize_materials=False) for sent in entry['sents']]
-                except:
-                    sents = [self.pre_tokenizer.process(sent, convert_number=False, normalize_materials=False) for sent in self.pre_tokenizer.tokenize(entry['text'], keep_sentences=True)]
             for tokens in sents:
                 s = []
                 for tok in tokens:
@@ -179,8 +667,8 @@ class NERData():
                 d['tokens'].append(s)
             data_raw.append(d)
             id += 1
-        # fill out classes
-        self.get_classes([])
+        if self.tokenization_cache is not None:
+            self.tokenization_cache.put_many(new_sents)
         return data_raw
 
     
@@ -285,115 +773,65 @@ class NERData():
 
     def label_entries(self, data_formatted):
         '''
-        Labels entries according to the desired labeling scheme
+        Labels entries according to the desired labeling scheme. The annotations of every sentence in a split are encoded as integer codes, the runs of equal codes determine the prefix of each token, and the (prefix, annotation) pairs are mapped to class ids with array operations
             Arguments:
                 data_formatted: A dictionary of formatted data with the splits as the keys e.g. {'split': [[[{'text': [...], 'annotation': [...]}],...],...],...}
             Returns:
-                Labeled data of same format as input, but the 'annotations' field for each sentence is replaced with a 'label' field where a label is in the form <Prefix>-<Annotation>
+                Labeled data of same format as input, but the 'annotation' field for each sentence is replaced with a 'label_ids' field of class ids where a class is in the form <Prefix>-<Annotation>
         '''
+        # tokens that don't work with bert (skipped after labeling)
+        skipped_tokens = {'̄', '̊'}
+        # prefixes by position in the class table
+        prefixes = ['B', 'I', 'E', 'S'] if self.scheme == 'IOBES' else ['B', 'I']
         # initialize empty dictionary
         data_labeled = {split: [] for split in data_formatted.keys()}
         # for split in dataset
         for split in data_formatted.keys():
-            # for entry in split (paragraph)
+            sentences = [sent for dat in data_formatted[split] for sent in dat['tokens']]
+            lengths = np.array([len(sent['text']) for sent in sentences], dtype=np.int64)
+            offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+            # integer code of each token annotation
+            annotations = list(chain.from_iterable(sent['annotation'] for sent in sentences))
+            annotation_codes = {annotation: code for code, annotation in enumerate(dict.fromkeys(annotations))}
+            codes = np.fromiter(map(annotation_codes.__getitem__, annotations), dtype=np.int64, count=len(annotations))
+            # class id of each (annotation code, prefix) pair, None or invalid annotations are mapped to outside
+            class_table = np.full((len(annotation_codes), len(prefixes)), self.class_dict['O'], dtype=np.int64)
+            for annotation, code in annotation_codes.items():
+                if annotation not in [None, *self.invalid_annotations]:
+                    class_table[code] = [self.class_dict['{}-{}'.format(prefix, annotation)] for prefix in prefixes]
+            # whether each token continues the run of the prior token (runs do not cross sentences)
+            continues = np.zeros(len(codes), dtype=bool)
+            continues[1:] = codes[1:] == codes[:-1]
+            continues[offsets[:-1][lengths > 0]] = False
+            # whether the run of each token continues with the next token
+            continued = np.zeros(len(codes), dtype=bool)
+            continued[:-1] = continues[1:]
+            # inside-outside-beginning-end-single scheme: beginning, inside, end, or single position in the run
+            if self.scheme == 'IOBES':
+                prefix_index = np.where(continues, np.where(continued, 1, 2), np.where(continued, 0, 3))
+            # inside-outside-beginning scheme (2): the first token of a run is the beginning
+            elif self.scheme == 'IOB2':
+                prefix_index = np.where(continues, 1, 0)
+            # inside-outside-beginning scheme (1): the first token of a run of more than one token is the beginning
+            elif self.scheme in ['IOB', 'IOB1']:
+                prefix_index = np.where(~continues & continued, 0, 1)
+            label_ids = class_table[codes, prefix_index]
+            # drop skipped tokens
+            texts = list(chain.from_iterable(sent['text'] for sent in sentences))
+            if not skipped_tokens.isdisjoint(texts):
+                keep = np.array([token not in skipped_tokens for token in texts], dtype=bool)
+                texts = [token for token, k in zip(texts, keep) if k]
+                label_ids = label_ids[keep]
+                offsets = np.concatenate([[0], np.cumsum(keep)])[offsets]
+            label_ids = label_ids.tolist()
+            offsets = offsets.tolist()
+            # regroup sentences by entry
+            n = 0
             for dat in data_formatted[split]:
-                # initialize empty list
                 d = {'id': dat['id'], 'meta': dat['meta'], 'tokens': []}
-                # for sentence in entry
-                for sent in dat['tokens']:
-                    # initialize text/label dictionary for sentence
-                    s = {key: [] for key in ['text', 'label']}
-                    # for token in sentence
-                    for i in range(len(sent['text'])):
-                        # skip tokens that don't work with bert
-                        if sent['text'][i] in ['̄','̊']:
-                            continue
-                        # otherwise append token to sentence
-                        s['text'].append(sent['text'][i])
-                        # inside-outside-beginning scheme (1)
-                        if self.scheme == 'IOB1':
-                            # None or invalid annotations are mapped to outside
-                            if sent['annotation'][i] in [None, *self.invalid_annotations]:
-                                s['label'].append('O')
-                            # if this is the first token in a sentence of more than one token
-                            elif i == 0 and len(sent['annotation']) > 1:
-                                # if the next token is of the same type, it is the beginning of an entity
-                                if sent['annotation'][i+1] == sent['annotation'][i]:
-                                    s['label'].append('B-'+sent['annotation'][i])
-                                # otherwise inside
-                                else:
-                                    s['label'].append('I-'+sent['annotation'][i])
-                            # if the sentence is only one token long and not outside, it must be inside
-                            elif i == 0 and len(sent['annotation']) == 1:
-                                s['label'].append('I-'+sent['annotation'][i])
-                            # if the token is not the first in the sentence
-                            elif i > 0:
-                                # if the prior token was of the same type, it is inside
-                                if sent['annotation'][i-1] == sent['annotation'][i]:
-                                    s['label'].append('I-'+sent['annotation'][i])
-                                else:
-                                    # if the prior token was of a different type and the next is of the same type, beginning
-                                    if sent['annotation'][i+1] == sent['annotation'][i]:
-                                        s['label'].append('B-'+sent['annotation'][i])
-                                    # otherwise inside
-                                    else:
-                                        s['label'].append('I-'+sent['annotation'][i])
-                        # inside-outside-beginning scheme (2)
-                        elif self.scheme == 'IOB2':
-                            # None or invalid annotations are mapped to outside
-                            if sent['annotation'][i] in [None, *self.invalid_annotations]:
-                                s['label'].append('O')
-                            # if the first token is an entity, it must be the beginning
-                            elif i == 0:
-                                s['label'].append('B-'+sent['annotation'][i])
-                            # if the token is not the first in the sentence
-                            elif i > 0:
-                                # if the prior token was of the same type, then it is inside
-                                if sent['annotation'][i-1] == sent['annotation'][i]:
-                                    s['label'].append('I-'+sent['annotation'][i])
-                                # otherwise, it is beginning
-                                else:
-                                    s['label'].append('B-'+sent['annotation'][i])
-                        # inside-outside-beginning-end-single scheme
-                        elif self.scheme == 'IOBES':
-                            # None or invalid annotations are mapped to outside
-                            if sent['annotation'][i] in [None, *self.invalid_annotations]:
-                                s['label'].append('O')
-                            # if the the single token in a sentence is an entity, it must be single
-                            elif i == 0 and len(sent['annotation']) == 1:
-                                s['label'].append('S-'+sent['annotation'][i])
-                            # if the first token in a multi-token sentence is an entity
-                            elif i == 0 and len(sent['annotation']) > 1:
-                                # if the next token is of the same type, it is beginning
-                                if sent['annotation'][i+1] == sent['annotation'][i]:
-                                    s['label'].append('B-'+sent['annotation'][i])
-                                # if the next token is not of the same type, it is single
-                                else:
-                                    s['label'].append('S-'+sent['annotation'][i])
-                            # if not the first or last token
-                            elif i > 0 and i < len(sent['annotation'])-1:
-                                # if the token before is of a different type and the next of the same, then beginning
-                                if sent['annotation'][i-1] != sent['annotation'][i] and sent['annotation'][i+1] == sent['annotation'][i]:
-                                    s['label'].append('B-'+sent['annotation'][i])
-                                # if the token before is of the same type and the next of the same, then inside
-                                elif sent['annotation'][i-1] == sent['annotation'][i] and sent['annotation'][i+1] == sent['annotation'][i]:
-                                    s['label'].append('I-'+sent['annotation'][i])
-                                # if the token before is of the same type and the next of a different, then end
-                                elif sent['annotation'][i-1] == sent['annotation'][i] and sent['annotation'][i+1] != sent['annotation'][i]:
-                                    s['label'].append('E-'+sent['annotation'][i])
-                                # if the token before is of a different type and the next of a different, then single
-                                elif sent['annotation'][i-1] != sent['annotation'][i] and sent['annotation'][i+1] != sent['annotation'][i]:
-                                    s['label'].append('S-'+sent['annotation'][i])
-                            # if the last token
-                            elif i == len(sent['annotation'])-1:
-                                # if the token before is of the same type, then end
-                                if sent['annotation'][i-1] == sent['annotation'][i]:
-                                    s['label'].append('E-'+sent['annotation'][i])
-                                # if the token before is of a different type, then single
-                                if sent['annotation'][i-1] != sent['annotation'][i]:
-                                    s['label'].append('S-'+sent['annotation'][i])
-                    # append the labeled sentence to the entry
-                    d['tokens'].append(s)
+                for _ in dat['tokens']:
+                    d['tokens'].append({'text': texts[offsets[n]:offsets[n+1]], 'label_ids': label_ids[offsets[n]:offsets[n+1]]})
+                    n += 1
                 # append the entry to the labeled data split
                 data_labeled[split].append(d)
         self.data = data_labeled
@@ -402,215 +840,185 @@ class NERData():
     
     def insert_cls(self, d):
         # dictionary of classes (given class name, return index)
-        d['tokens'].insert(0, self.cls_dict['text'])
-        d['labels'].insert(0, self.cls_dict['label'])
+        if self.keep_strings:
+            d['tokens'].insert(0, self.cls_dict['text'])
+            d['labels'].insert(0, self.cls_dict['label'])
         d['token_ids'].insert(0, self.tokenizer.convert_tokens_to_ids(self.cls_dict['text']))
         d['label_ids'].insert(0, self.class_dict[self.cls_dict['label']])
-        d['attention_mask'].insert(0, 1)
         d['valid_mask'].insert(0, 1)
 
 
-    def create_features(self, data_labeled):
+    def encode_words(self, words):
+        '''
+        Tokenizes a list of words with the (fast) BERT tokenizer in a single call
+            Arguments:
+                words: List of raw words
+            Returns:
+                List of subtoken ids for each word
+        '''
+        # every word is tokenized as a separate pre-split sequence
+        return self.tokenizer([[word] for word in words], is_split_into_words=True, add_special_tokens=False,
+                              return_attention_mask=False, return_token_type_ids=False, verbose=False)['input_ids']
+
+
+    def tokenize_sentences(self, sentences):
+        '''
+        Tokenizes a batch of labeled sentences using the word-piece cache, the words missing from it are tokenized together in a single call
+            Arguments:
+                sentences: List of sentences in the form [{'text': [...], 'label_ids': [...]},...]
+            Returns:
+                List of sentence features in the form [{'token_ids': [...], 'label_ids': [...], 'valid_mask': [...]},...] (with 'tokens' and 'labels' if the strings are kept)
+        '''
+        # special token and placeholder ids
+        sep_id = self.tokenizer.convert_tokens_to_ids(self.sep_dict['text'])
+        sep_label_id = self.class_dict[self.sep_dict['label']]
+        outside_id = self.class_dict['O']
+        classes = np.array(self.classes, dtype=object)
+        # subtoken ids for every word in the batch
+        word_pieces = self.wordpiece_cache.lookup([word for sent in sentences for word in sent['text']], self.encode_words)
+        features = []
+        n = 0
+        for sent in sentences:
+            # sentences without words produce empty features
+            if len(sent['text']) == 0:
+                features.append({key: [] for key in self.feature_keys})
+                continue
+            pieces = word_pieces[n:n+len(sent['text'])]
+            n += len(sent['text'])
+            # index of the word each subtoken belongs to (words without subtokens are dropped)
+            word_ids = np.repeat(np.arange(len(pieces)), [len(p) for p in pieces])
+            token_ids = list(chain.from_iterable(pieces))
+            # the subtoken is valid for classification if it is the first for the original token
+            valid_mask = np.ones(len(word_ids), dtype=bool)
+            valid_mask[1:] = word_ids[1:] != word_ids[:-1]
+            # labels of the original tokens are broadcast onto their first subtokens, outside labels are placeholders (will not be seen by classifier)
+            label_ids = np.where(valid_mask, np.array(sent['label_ids'], dtype=np.int64)[word_ids], outside_id)
+            # append [SEP] token to end of sentence
+            feature = {'token_ids': token_ids+[sep_id],
+                       'label_ids': label_ids.tolist()+[sep_label_id],
+                       'valid_mask': valid_mask.astype(np.int64).tolist()+[1]}
+            if self.keep_strings:
+                feature['tokens'] = self.tokenizer.convert_ids_to_tokens(token_ids)+[self.sep_dict['text']]
+                feature['labels'] = classes[label_ids].tolist()+[self.sep_dict['label']]
+            features.append(feature)
+        return features
+
+
+    def create_features(self, data_labeled, batch_size=2048, save_cache=True):
         '''
         Converts the dictionary of InputExamples into InputFeatures
             Arguments:
                 data_labeled: A dictionary of InputExamples e.g. {'split': [InputExample,...],...}
+                batch_size: Number of sentences tokenized per call to the tokenizer
+                save_cache: Boolean for whether the word-piece cache is persisted afterwards
             Returns:
-                A dictionary of InputFeatures e.g. {'split': [{'tokens': [...], 'labels': [...], 'token_ids': [...], 'label_ids': [...], 'attention_mask': [...], 'valid_mask': [...]},...],...}
+                A dictionary of InputFeatures e.g. {'split': [{'token_ids': [...], 'label_ids': [...], 'valid_mask': [...]},...],...}
         '''
         
         # initialize empty dictionary
         data_feature = {split: [] for split in data_labeled.keys()}
         # for split in dataset
         for split in data_labeled.keys():
-            data_label_range = tqdm(data_labeled[split], desc='| writing {} features |'.format(split))
-            # for example in dataset split
-            for dat in data_label_range:
-                # initialize empty dictionary for features
-                d = {key: dat['id'] if key == 'id' else [] for key in ['id', 'tokens', 'labels', 'token_ids', 'label_ids', 'attention_mask', 'valid_mask']}
-                # for sentence in example
-                for i in range(len(dat['tokens'])):
-                    s = {key: [] for key in ['tokens', 'labels', 'token_ids', 'label_ids', 'attention_mask', 'valid_mask']}
-                    # for token in sentence
-                    n_tokens = len(dat['tokens'][i]['text'])
-                    for j in range(n_tokens):
-                        # split token using bert tokenizer
-                        word_tokens = self.tokenizer.tokenize(dat['tokens'][i]['text'][j])
-                        # for subtoken from bert tokenization
-                        for k, word_token in enumerate(word_tokens):
-                            # append to tokens
-                            s['tokens'].append(word_token)
-                            # append to token ids using tokenizer
-                            s['token_ids'].append(self.tokenizer.convert_tokens_to_ids(word_token))
-                            # append to attention mask
-                            s['attention_mask'].append(1)
-                            # if the subtoken is the first for the original token
-                            if k == 0:
-                                # the subtoken is valid for classification
-                                s['valid_mask'].append(1)
-                                # append the label
-                                s['labels'].append(dat['tokens'][i]['label'][j])
-                                # append the label id using the class dictionary
-                                s['label_ids'].append(self.class_dict[dat['tokens'][i]['label'][j]])
-                            # if the subtoken is not the first for the original token
-                            else:
-                                # the subtoken is not valid for classification
-                                s['valid_mask'].append(0)
-                                # append outside label as a placeholder (will not be seen by classifier)
-                                s['labels'].append('O')
-                                # append outside label id as placeholder (will not be seen by classifier)
-                                s['label_ids'].append(self.class_dict['O'])
-                        # append [SEP] token to end of sentence
-                        if j == len(dat['tokens'][i]['text'])-1:
-                            s['tokens'].append(self.sep_dict['text'])
-                            s['labels'].append(self.sep_dict['label'])
-                            s['token_ids'].append(self.tokenizer.convert_tokens_to_ids(self.sep_dict['text']))
-                            s['label_ids'].append(self.class_dict[self.sep_dict['label']])
-                            s['attention_mask'].append(1)
-                            s['valid_mask'].append(1)
-                    d['tokens'].append(s['tokens'])
-                    d['labels'].append(s['labels'])
-                    d['token_ids'].append(s['token_ids'])
-                    d['label_ids'].append(s['label_ids'])
-                    d['attention_mask'].append(s['attention_mask'])
-                    d['valid_mask'].append(s['valid_mask'])
+            # sentences of every example in dataset split
+            sentences = [sent for dat in data_labeled[split] for sent in dat['tokens']]
+            # sentence features in batches
+            features = []
+            for i in tqdm(range(0, len(sentences), batch_size), desc='| writing {} features |'.format(split)):
+                features.extend(self.tokenize_sentences(sentences[i:i+batch_size]))
+            # regroup sentence features by example
+            offsets = np.cumsum([0]+[len(dat['tokens']) for dat in data_labeled[split]])
+            for n, dat in enumerate(data_labeled[split]):
+                # initialize dictionary for features
+                d = {'id': dat['id']}
+                # lists of sentence features
+                d.update({key: [s[key] for s in features[offsets[n]:offsets[n+1]]] for key in self.feature_keys})
                 data_feature[split].append(d)
+        # persist the word-piece cache (if a cache directory is set)
+        if save_cache:
+            self.wordpiece_cache.save()
         return data_feature
 
 
     def split_entries_merge_sentences(self, data_feature, sentence_level):
-        # initialize empty dictionary
-
-
-        def partition(a, k, no_improvement_threshold=5, max_iterations=100):
-            # one split 
-            if k <= 1 or k >= len(a): return [(0, len(a))]
-            # partition between
-            pb = [int((i+1)*len(a)/k) for i in range(k-1)]
-            # average height
-            ah = np.sum(a)/k
-            # best score
-            bs = None
-            # best boundaries
-            bb = None
-            # iteration count
-            n = 0
-            while True:
-                # starting indices
-                s = [0]+pb
-                # ending indices
-                e = pb+[len(a)]
-                # boundaries
-                b = [(s[i], e[i]) for i in range(k)]
-                # partitions
-                p = [a[b[i][0]:b[i][1]] for i in range(k)]
-                # heights
-                h = [sum(sp) for sp in p]
-                # absolute height differences
-                ahd = np.abs(ah-h)
-                # worst partition index
-                wpi = np.argmax(ahd)
-                whd = ah-h[wpi]
-                # update best so far
-                if bs is None or abs(whd) < bs:
-                    bs = abs(whd)
-                    bb = b
-                    # no improvement count
-                    nin = 0
-                else:
-                    # increment no improvement count
-                    nin += 1
-                # termination condition
-                if whd == 0 or nin > no_improvement_threshold or n > max_iterations:
-                    # return best partition boundaries
-                    return bb
-                # increment iterations
-                n += 1
-                # move
-                m = -1 if whd < 0 else 1
-                # bound to move
-                mb = 0 if wpi == 0\
-                                else k-2 if wpi == k-1\
-                                else wpi-1 if (whd < 0) ^ (h[wpi-1] > h[wpi+1])\
-                                else wpi
-                # direction
-                d = -1 if mb < wpi else 1
-                pb[mb] += m*d
-
+        '''
+        Merges the sentences of each entry into sequences, splitting entries that exceed the token limit into the fewest sequences of balanced length (or splits the sentences into separate sequences)
+            Arguments:
+                data_feature: A dictionary of InputFeatures by entry with lists of sentence features e.g. {'split': [{'id': ..., 'tokens': [[...],...],...},...],...}
+                sentence_level: Boolean that controls whether the sentences in entries are split into separate entries (True) or combines them into a single sequence entry (False)
+            Returns:
+                A dictionary of InputFeatures by sequence, each with the 'id' of its entry and part 'pt'
+        '''
+        keys = self.feature_keys
+        # maximum number of tokens in a sequence part excluding the [CLS] token
+        capacity = self.token_limit-1
+        # [SEP] token closing the pieces of split sentences
+        sep = {'tokens': self.sep_dict['text'], 'labels': self.sep_dict['label'],
+               'token_ids': self.tokenizer.convert_tokens_to_ids(self.sep_dict['text']), 'label_ids': self.class_dict[self.sep_dict['label']], 'valid_mask': 1}
         dat_split_feature = {split: [] for split in data_feature.keys()}
         for split in data_feature.keys():
             data_label_range = tqdm(data_feature[split], desc=('| splitting long {} paragraphs' if sentence_level else '| splitting {} paragraphs |').format(split))
             for dat in data_label_range:
                 if sentence_level:
-                    for i in range(len(dat['tokens'])):
+                    for i in range(len(dat['token_ids'])):
                         d = {'id': dat['id'], 'pt': i}
-                        d.update({key: dat[key][i] for key in ['tokens', 'labels', 'token_ids', 'label_ids', 'attention_mask', 'valid_mask']})
+                        d.update({key: dat[key][i] for key in keys})
                         dat_split_feature[split].append(d)
                 else:
-                    slen = [len(s) for s in dat['tokens']]
-                    tnum = sum(slen)
-                    n_splits= int(np.ceil((self.token_limit-np.sqrt(self.token_limit**2-4*tnum))/2))
-                    n_shave = 0
-                    if n_splits > 1:
-                        valid = False
-                        while not valid:
-                            bounds = partition(slen, n_splits)
-                            ds = []
-                            ml= 0
-                            for i in range(len(bounds)):
-                                d = {'id': dat['id'], 'pt': i}
-                                d.update({key: [v for s in dat[key][bounds[i][0]:bounds[i][1]] for v in s] for key in ['tokens', 'labels', 'token_ids', 'label_ids', 'attention_mask', 'valid_mask']})
-                                self.insert_cls(d)
-                                ds.append(d)
-                                if len(d['tokens']) > ml:
-                                    ml = len(d['tokens'])
-                            if ml > self.token_limit:
-                                n_splits += 1
-                                if n_splits > len(dat['tokens']):
-                                    n_shave += 1
-                                    if n_shave == len(slen):
-                                        valid = True
-                                        print('failed to split paragraph on sentence breaks into subparagraphs below the token limit, skipping')
-                                    else:
-                                        d.update({key: [v for s in dat[key][:-n_shave] for v in s] for key in ['tokens', 'labels', 'token_ids', 'label_ids', 'attention_mask', 'valid_mask']})
-                                        slen = [len(s) for s in d['tokens']]
-                                        tnum = sum(slen)
-                                        n_splits = int(np.ceil((self.token_limit-np.sqrt(self.token_limit**2-4*tnum))/2))
-                            else:
-                                valid = True
-                                dat_split_feature[split].extend(ds)
-                    else:
-                        d = {'id': dat['id'], 'pt': 0}
-                        d.update({key: [v for s in dat[key] for v in s] for key in ['tokens', 'labels', 'token_ids', 'label_ids', 'attention_mask', 'valid_mask']})
+                    # units of sentences (or pieces of sentences above the capacity)
+                    units = []
+                    for i in range(len(dat['token_ids'])):
+                        sentence = {key: dat[key][i] for key in keys}
+                        if len(sentence['token_ids']) <= capacity:
+                            units.append(sentence)
+                        else:
+                            # every piece but the last (which ends with the sentence [SEP] token) is closed by an added [SEP] token
+                            pieces = self.split_sentence(sentence['valid_mask'], sentence['label_ids'], capacity-1)
+                            units.extend({key: sentence[key][start:end]+[sep[key]] for key in keys} for start, end in pieces[:-1])
+                            units.append({key: sentence[key][pieces[-1][0]:pieces[-1][1]] for key in keys})
+                    # fewest parts of balanced length (an entry without sentences is a single part)
+                    bounds = linear_partition([len(unit['token_ids']) for unit in units], capacity) if len(units) > 0 else [(0, 0)]
+                    for pt, (start, end) in enumerate(bounds):
+                        d = {'id': dat['id'], 'pt': pt}
+                        d.update({key: [v for unit in units[start:end] for v in unit[key]] for key in keys})
                         self.insert_cls(d)
                         dat_split_feature[split].append(d)
         return dat_split_feature
-    
 
-    def pad_features(self, data_split_feature):
-        dat_input_feature = {split: [] for split in data_split_feature.keys()}
-        for split in data_split_feature.keys():
-            max_length = 0
-            for dat in data_split_feature[split]:
-                length = len(dat['tokens'])
-                if length > max_length:
-                    max_length = length
-            for dat in data_split_feature[split]:
-                d = {key: dat[key] for key in dat.keys()}
-                length = len(dat['tokens'])
-                d['tokens'].extend((max_length-length)*[self.pad_dict['text']])
-                d['labels'].extend((max_length-length)*[self.pad_dict['label']])
-                d['token_ids'].extend((max_length-length)*[self.tokenizer.convert_tokens_to_ids(self.pad_dict['text'])])
-                d['label_ids'].extend((max_length-length)*[self.class_dict[self.pad_dict['label']]])
-                d['attention_mask'].extend((max_length-length)*[0])
-                d['valid_mask'].extend((max_length-length)*[0])
-                dat_input_feature[split].append(d)
-        return dat_input_feature
+
+    def split_sentence(self, valid_mask, label_ids, capacity):
+        '''
+        Splits a sentence above the capacity into pieces of balanced length, breaking only before the first subtokens of words (unless a single word is above the capacity)
+        and, where the capacity allows, only between words that are not inside the same entity (before or after words labeled O)
+            Arguments:
+                valid_mask: Valid mask of the sentence (ending with the [SEP] token)
+                label_ids: Label ids of the sentence
+                capacity: Maximum number of tokens in a piece
+            Returns:
+                List of (start, end) bounds of the pieces
+        '''
+        outside_id = self.class_dict['O']
+        # words start at the valid subtokens, with the [SEP] token kept with the last word
+        starts = [i for i, valid in enumerate(valid_mask[:-1]) if valid]
+        if len(starts) == 0 or starts[0] != 0:
+            starts.insert(0, 0)
+        # words given by (start, end, outside)
+        words = []
+        for start, end in zip(starts, starts[1:]+[len(valid_mask)]):
+            # words above the capacity are broken into pieces of the capacity
+            words.extend((a, min(a+capacity, end), label_ids[start] == outside_id) for a in range(start, end, capacity))
+        # blocks of words that are only broken between words inside the same entity if they would exceed the capacity
+        blocks = [[words[0][0], words[0][1]]]
+        for (_, _, previous_outside), (start, end, outside) in zip(words, words[1:]):
+            if previous_outside or outside or end-blocks[-1][0] > capacity:
+                blocks.append([start, end])
+            else:
+                blocks[-1][1] = end
+        return [(blocks[start][0], blocks[end-1][1]) for start, end in linear_partition([end-start for start, end in blocks], capacity)]
 
 
     def create_datasets(self, data_input_feature):
         '''
-        Creates datsets from a dictionary of InputFeatures, which are saved as an attribute
+        Creates ragged datsets from a dictionary of (unpadded) InputFeatures, which are saved as an attribute
             Arguments:
                 data_input_feature: A dictionary of InputFeatures e.g. {'split': [InputFeatures,...],...}
             Returns:
@@ -620,15 +1028,27 @@ class NERData():
         self.dataset = {}
         # for split in dataset
         for split in data_input_feature.keys():
-            # collect features
-            ids = torch.tensor([d['id'] for d in data_input_feature[split]], dtype=torch.long, device=torch.device('cpu'))
-            pts = torch.tensor([d['pt'] for d in data_input_feature[split]], dtype=torch.uint8, device=torch.device('cpu'))
-            token_ids = torch.tensor([d['token_ids'] for d in data_input_feature[split]], dtype=torch.long, device=torch.device('cpu'))
-            label_ids = torch.tensor([d['label_ids'] for d in data_input_feature[split]], dtype=torch.uint8, device=torch.device('cpu'))
-            attention_mask = torch.tensor([d['attention_mask'] for d in data_input_feature[split]], dtype=torch.bool, device=torch.device('cpu'))
-            valid_mask = torch.tensor([d['valid_mask'] for d in data_input_feature[split]], dtype=torch.bool, device=torch.device('cpu'))
-            # store as tensor dataset
-            self.dataset[split] = TensorDataset(ids, pts, token_ids, label_ids, attention_mask, valid_mask)
+            # store as ragged dataset (padded per batch by the dataloaders)
+            self.dataset[split] = self.create_dataset(data_input_feature[split])
+
+
+    def create_dataset(self, features):
+        '''
+        Creates a ragged dataset from a list of (unpadded) InputFeatures, concatenating the sequences into compact arrays
+            Arguments:
+                features: List of InputFeatures
+            Returns:
+                RaggedDataset object
+        '''
+        # sequence offsets into the concatenated arrays
+        offsets = np.concatenate([[0], np.cumsum([len(d['token_ids']) for d in features], dtype=np.int64)]).astype(np.int64)
+        ids = np.array([d['id'] for d in features], dtype=np.int32)
+        pts = np.array([d['pt'] for d in features], dtype=np.int32)
+        token_ids, label_ids, valid_mask = [np.fromiter(chain.from_iterable(d[key] for d in features), dtype=dtype, count=offsets[-1])
+                                            for key, dtype in [('token_ids', self.token_dtype), ('label_ids', np.uint8), ('valid_mask', bool)]]
+        if self.keep_strings:
+            return RaggedDataset(ids, pts, offsets, token_ids, label_ids, valid_mask, [d['tokens'] for d in features], [d['labels'] for d in features])
+        return RaggedDataset(ids, pts, offsets, token_ids, label_ids, valid_mask)
     
 
     def preprocess(self, data, split_dict={'main': 1}, is_file=True, annotated=True, sentence_level=False, shuffle=False, seed=256):
@@ -644,22 +1064,125 @@ class NERData():
             Returns:
                 None
         '''
+        # featurized data files are cached if a cache directory is set
+        if is_file and self.cache_dir is not None:
+            self.preprocess_cached(data, split_dict, annotated, sentence_level, shuffle, seed)
+            return
         # call load from file if the data is a file
         data = self.load(data, is_file, annotated)
         # shuffle the entries if shuffle is True
         if shuffle:
             data = self.shuffle_data(data, seed)
         # creat datasets
-        self.create_datasets(self.pad_features(self.split_entries_merge_sentences(self.create_features(self.label_entries(self.format_entries(self.split_entries(data, split_dict, shuffle, seed)))), sentence_level)))  
+        self.create_datasets(self.split_entries_merge_sentences(self.create_features(self.label_entries(self.format_entries(self.split_entries(data, split_dict, shuffle, seed)))), sentence_level))  
     
 
-    def create_dataloaders(self, batch_size=32, shuffle=True, seed=256):
+    def preprocess_cached(self, data_file, split_dict={'main': 1}, annotated=True, sentence_level=False, shuffle=False, seed=256):
+        '''
+        Preprocesses a JSON file using the on-disk feature cache. The unshuffled corpus is featurized once per data file, tokenizer, scheme, and sentence level, after which only the shuffling and splitting are repeated
+            Arguments:
+                data_file: Path to a JSON file containing raw entries
+                split_dict: Dictionary of splits and proprotions e.g. {'split_1': 0.1, 'split_2': 0.1, 'split_3': 0.8}
+                annotated: Boolean for whether the data is annotated
+                sentence_level: Boolean that controls whether the sentences in entries are split into separate entries (True) or combines them into a single sequence entry (False)
+                shuffle: Boolean for whether the raw data is shuffled before it is split
+                seed: Random seed for shuffling. Will not be seeded if the seed returns a False value
+            Returns:
+                None
+        '''
+        # cache addressed by the data file contents, tokenizer, and options
+        feature_cache = FeatureCache.from_inputs(self.cache_dir, data_file, self.wordpiece_cache.vocab_hash, self.scheme, annotated, sentence_level, self.token_limit)
+        if not feature_cache.exists():
+            # featurize the full corpus in file order
+            data_labeled = self.label_entries(self.format_entries({'main': self.load(data_file, True, annotated)}))
+            data_split_feature = self.split_entries_merge_sentences(self.create_features(data_labeled), sentence_level)
+            feature_cache.save(self.classes, data_labeled['main'], data_split_feature['main'])
+        classes, entries = feature_cache.load()
+        self.classes = classes
+        self.class_dict = {class_: i for i, class_ in enumerate(self.classes)}
+        # shuffle and split entry positions exactly as the entries themselves would be
+        indices = list(range(len(entries)))
+        if shuffle:
+            indices = self.shuffle_data(indices, seed)
+        index_split = self.split_entries(indices, split_dict, shuffle, seed)
+        # labeled entries
+        self.data = {split: [entries[i] for i in index_split[split]] for split in index_split.keys()}
+        # datasets gathered from the cached arrays
+        self.dataset = {}
+        for split in index_split.keys():
+            arrays = feature_cache.gather(index_split[split])
+            arrays['token_ids'] = arrays['token_ids'].astype(self.token_dtype)
+            if self.keep_strings:
+                # token and label text restored from the ids
+                sequences = [slice(start, end) for start, end in zip(arrays['offsets'][:-1], arrays['offsets'][1:])]
+                arrays['tokens'] = [self.tokenizer.convert_ids_to_tokens(arrays['token_ids'][sequence].tolist()) for sequence in sequences]
+                arrays['labels'] = [[self.classes[label_id] for label_id in arrays['label_ids'][sequence]] for sequence in sequences]
+            self.dataset[split] = RaggedDataset(**arrays)
+
+
+    def iter_preprocess(self, data, is_file=True, sentence_level=False, chunk_size=1024):
+        '''
+        Preprocesses unannotated raw entries as a stream of chunks for prediction. JSON files are parsed incrementally, so memory use is bounded by the chunk size rather than the input size
+            Arguments:
+                data: Either an iterable of raw entries or the path to a JSON (array or lines) file containing raw entries
+                is_file: Boolean that controls whether data is treated as file (True) or iterable (False)
+                sentence_level: Boolean that controls whether the sentences in entries are split into separate entries (True) or combines them into a single sequence entry (False)
+                chunk_size: Number of entries preprocessed together
+            Returns:
+                Generator of labeled entries and sequence features for each chunk
+        '''
+        # filtered entries with unique identifiers
+        data_filt = (d for _, d in self.iter_filter_data(iterate_json(data) if is_file else data))
+        # fill out classes
+        self.get_classes([])
+        start_id = 0
+        while True:
+            chunk = list(islice(data_filt, chunk_size))
+            if len(chunk) == 0:
+                break
+            data_labeled = self.label_entries(self.format_entries({'predict': self.pre_tokenize_entries(chunk, start_id)}))
+            data_split_feature = self.split_entries_merge_sentences(self.create_features(data_labeled, save_cache=False), sentence_level)
+            start_id += len(chunk)
+            yield data_labeled['predict'], data_split_feature['predict']
+        # persist the word-piece cache (if a cache directory is set)
+        self.wordpiece_cache.save()
+
+
+    def create_stream_dataloader(self, data, is_file=True, sentence_level=False, chunk_size=1024, batch_size=32, bucket_batches=100, max_tokens=None):
+        '''
+        Creates a dataloader streaming padded batches of unannotated entries for prediction (see iter_preprocess)
+            Arguments:
+                data: Either an iterable of raw entries or the path to a JSON (array or lines) file containing raw entries
+                is_file: Boolean that controls whether data is treated as file (True) or iterable (False)
+                sentence_level: Boolean that controls whether the sentences in entries are split into separate entries (True) or combines them into a single sequence entry (False)
+                chunk_size: Number of entries preprocessed together
+                batch_size: Number of entries per batch (maximum number if max_tokens is provided)
+                bucket_batches: Sequences in a chunk are sorted by length if greater than 0
+                max_tokens: Maximum number of (padded) tokens per batch. Not limited if None
+            Returns:
+                Dataloader over a StreamingDataset (the dataset tracks the entries awaiting predictions)
+        '''
+        # the classes are needed for the padding label before the first chunk is preprocessed
+        self.get_classes([])
+        # pads each batch to its longest sequence
+        collate_fn = partial(pad_collate, pad_token_id=self.tokenizer.convert_tokens_to_ids(self.pad_dict['text']), pad_label_id=self.class_dict[self.pad_dict['label']])
+        dataset = StreamingDataset(self.iter_preprocess(data, is_file, sentence_level, chunk_size), self.create_dataset, collate_fn, batch_size, bucket_batches, max_tokens)
+        # the dataset yields whole batches and is consumed in the main process, where its pending entries are tracked
+        return DataLoader(dataset, batch_size=None, num_workers=0, pin_memory=True)
+
+
+    def create_dataloaders(self, batch_size=32, shuffle=True, seed=256, bucket_batches=100, max_tokens=None, num_workers=0, prefetch_factor=2, persistent_workers=False):
         '''
         Creates dataloaders from dictionary of datasets which are saved as an attribute
             Arguments:
                 batch_size: Number of entries per batch in the dataloaders
                 shuffle: Boolean that controls whether the data is shuffled within the dataloaders between training epochs
                 seed: Random seed for shuffling. Will not be seeded if the seed returns a False value
+                bucket_batches: Number of batches per bucket of similar length sequences when shuffling (unshuffled data is sorted by length). Bucketing is disabled if 0
+                max_tokens: Maximum number of (padded) tokens per batch, with batch_size as the maximum number of entries. Not limited if None
+                num_workers: Number of worker processes collating batches in the background (batches are collated in the main process if 0)
+                prefetch_factor: Number of batches loaded in advance by each worker (ignored if num_workers is 0)
+                persistent_workers: Boolean that controls whether the worker processes are kept alive between epochs (ignored if num_workers is 0)
             Return:
                 None
         '''
@@ -668,9 +1191,20 @@ class NERData():
             torch.manual_seed(seed)
             torch.cuda.manual_seed(seed)
             np.random.seed(seed)
+        # pads each batch to its longest sequence
+        collate_fn = partial(pad_collate, pad_token_id=self.tokenizer.convert_tokens_to_ids(self.pad_dict['text']), pad_label_id=self.class_dict[self.pad_dict['label']])
+        # background workers (the options are only valid with worker processes)
+        if num_workers > 0:
+            worker_options = {'num_workers': num_workers, 'prefetch_factor': prefetch_factor, 'persistent_workers': persistent_workers, 'worker_init_fn': seed_worker}
+        else:
+            worker_options = {'num_workers': 0}
         # initialize empty dictionary
         self.dataloaders = {}
         # for split in dataset
         for split in self.dataset.keys():
-            # store dataloaders for tensor datasets
-            self.dataloaders[split] = DataLoader(self.dataset[split], batch_size=batch_size, shuffle=shuffle, num_workers=0, pin_memory=True)
+            # batches of similar length sequences (under the token budget if provided)
+            batch_sampler = BucketBatchSampler(self.dataset[split].lengths, batch_size, shuffle, bucket_batches, seed, max_tokens)
+            # store dataloaders for ragged datasets
+            # seeded base seeds for the worker processes (the batches themselves are sampled in the main process)
+            generator = torch.Generator().manual_seed(seed) if seed else None
+            self.dataloaders[split] = DataLoader(self.dataset[split], batch_sampler=batch_sampler, pin_memory=True, collate_fn=collate_fn, generator=generator, **worker_options)
@@ -1,22 +1,22 @@
 from os import path
 import string
+from collections import OrderedDict
 import regex
 import unidecode
-from monty.fractions import gcd_float
-from chemdataextractor.doc import Paragraph
-from gensim.models.phrases import Phraser
-from pymatgen.core.periodic_table import Element
-from pymatgen.core.composition import Composition, CompositionError
+# chemdataextractor, gensim, pymatgen, and monty are imported on first use, they are slow to import and not needed for pre-tokenized inputs
 
 
 class MaterialsTextTokenizer(object):
-    def __init__(self, phraser_path):
-        # initialize phraser from file
+    # version of the tokenizer output (bump whenever a change alters the tokens produced, invalidating cached tokenizations)
+    version = 1
+
+    def __init__(self, phraser_path, cache_size=65536):
         self.pad_token = '<pad>'
         self.unk_token = '<unk>'
         self.num_token = '<nUm>'
+        # phraser is loaded from file on first use (only needed for making phrases)
         self.phraser_path = phraser_path
-        self.phraser = Phraser.load(phraser_path)
+        self._phraser = None
         # elements by symbol
         self.element = ["H", "He", "Li", "Be", "B", "C", "N", "O", "F", "Ne", "Na", "Mg", "Al", "Si", "P", "S", "Cl", "Ar", "K",
                         "Ca", "Sc", "Ti", "V", "Cr", "Mn", "Fe", "Co", "Ni", "Cu", "Zn", "Ga", "Ge", "As", "Se", "Br", "Kr",
@@ -83,6 +83,54 @@ class MaterialsTextTokenizer(object):
         self.punctuation = list(string.punctuation) + ["\"", "“", "”", "≥", "≤", "×"]
         # dictionary of element name : element symbol
         self.element_name_dict = {en: es for en, es in zip(self.element_name, self.element)}
+        # hashed indexes for membership tests (the lists above keep their order for the regular expressions)
+        self.element_set = frozenset(self.element)
+        self.element_name_ul_set = frozenset(self.element_name_ul)
+        self.split_unit_set = frozenset(self.split_unit)
+        self.punctuation_set = frozenset(self.punctuation)
+        # diatomic gases that are formulae despite only having one element
+        self.diatomic_set = frozenset(['O2', 'N2', 'Cl2', 'F2', 'H2'])
+        # bounded (least recently used) per-instance caches for formula detection and normalization
+        # (plain dictionaries consulted by the methods, so the tokenizer holds no references to itself and stays picklable)
+        self.cache_size = cache_size
+        self.formula_caches = {name: OrderedDict() for name in ['is_element', 'is_simple_formula', 'normalized_formula']}
+        self.formula_cache_counts = {name: {'hits': 0, 'misses': 0} for name in self.formula_caches.keys()}
+
+
+    @property
+    def phraser(self):
+        ''' phraser loaded from file on first access '''
+        if self._phraser is None:
+            from gensim.models.phrases import Phraser
+            self._phraser = Phraser.load(self.phraser_path)
+        return self._phraser
+
+
+    def cached(self, name, key, compute):
+        ''' value of a key in a formula cache, computed (and cached) on a miss, evicting the least recently used key above the cache size '''
+        cache = self.formula_caches[name]
+        counts = self.formula_cache_counts[name]
+        if key in cache:
+            counts['hits'] += 1
+            cache.move_to_end(key)
+            return cache[key]
+        counts['misses'] += 1
+        value = compute()
+        cache[key] = value
+        if len(cache) > self.cache_size:
+            cache.popitem(last=False)
+        return value
+
+
+    def cache_stats(self):
+        ''' hits, misses, hit rate, size, and maximum size of each formula cache '''
+        stats = {}
+        for name, cache in self.formula_caches.items():
+            counts = self.formula_cache_counts[name]
+            lookups = counts['hits']+counts['misses']
+            stats[name] = {'hits': counts['hits'], 'misses': counts['misses'], 'hit_rate': counts['hits']/lookups if lookups > 0 else 0.0,
+                           'size': len(cache), 'max_size': self.cache_size}
+        return stats
 
 
     def tokenize(self, text, split_oxidation=True, keep_sentences=True):
@@ -92,7 +140,7 @@ class MaterialsTextTokenizer(object):
             elem_with_valence = self.element_valence_in_par.match(token) if split_oxidation else None
             # check if number with unit
             number_unit = self.number_and_unit.match(token)
-            if number_unit is not None and number_unit.group(2) in self.split_unit:
+            if number_unit is not None and number_unit.group(2) in self.split_unit_set:
                 # return split number and unit
                 return [number_unit.group(1), number_unit.group(2)]
             elif elem_with_valence is not None:
@@ -102,6 +150,7 @@ class MaterialsTextTokenizer(object):
                 # return unsplit token
                 return [token]
         # tokenize
+        from chemdataextractor.doc import Paragraph
         chem_data_extractor_par = Paragraph(text)
         tokens = chem_data_extractor_par.tokens
         tokens_out = []
@@ -127,7 +176,7 @@ class MaterialsTextTokenizer(object):
         processed, mat_list = [], []
         for i, token in enumerate(tokens):
             # exclude punctuation
-            if exclude_punctuation and token in self.punctuation:
+            if exclude_punctuation and token in self.punctuation_set:
                 continue
             # convert number
             elif convert_number and self.is_number(token):
@@ -139,7 +188,7 @@ class MaterialsTextTokenizer(object):
                 except IndexError:
                     token = self.num_token
             # chemical element name
-            elif token in self.element_name_ul:
+            elif token in self.element_name_ul_set:
                 mat_list.append((token, self.element_name_dict[token.lower()]))
                 token = token.lower()
             # simple formula
@@ -149,7 +198,7 @@ class MaterialsTextTokenizer(object):
                 if normalize_materials:
                     token = normalized_formula
             # lower case if only first letter is upper case
-            elif (len(token) == 1 or (len(token) > 1 and token[0].isupper() and token[1:].islower())) and token not in self.element and self.element_direction_in_par.match(token) is None:
+            elif (len(token) == 1 or (len(token) > 1 and token[0].isupper() and token[1:].islower())) and token not in self.element_set and self.element_direction_in_par.match(token) is None:
                 token = token.lower()
             # remove accents
             if remove_accents:
@@ -176,8 +225,13 @@ class MaterialsTextTokenizer(object):
         return self.number_basic.match(x.replace(',', '')) is not None
 
 
+    def is_element(self, txt):
+        return self.cached('is_element', txt, lambda: self.check_element(txt))
+
+
     @staticmethod
-    def is_element(txt):
+    def check_element(txt):
+        from pymatgen.core.periodic_table import Element
         try:
             Element(txt)
             return True
@@ -186,11 +240,16 @@ class MaterialsTextTokenizer(object):
     
 
     def is_simple_formula(self, text):
+        return self.cached('is_simple_formula', text, lambda: self.check_simple_formula(text))
+
+
+    def check_simple_formula(self, text):
+        from pymatgen.core.composition import Composition, CompositionError
         if self.valence_info.search(text) is not None:
             return False
         elif any(char.isdigit() or char.islower() for char in text):
             try:
-                if text in ['O2', 'N2', 'Cl2', 'F2', 'H2']:
+                if text in self.diatomic_set:
                     return True
                 composition = Composition(text)
                 if len(composition.keys()) < 2 or any([not self.is_element(key) for key in composition.keys()]):
@@ -204,6 +263,7 @@ class MaterialsTextTokenizer(object):
 
     @staticmethod
     def get_ordered_integer_formula(element_amount, max_denominator=1000):
+        from monty.fractions import gcd_float
         g = gcd_float(list(element_amount.values()), 1/max_denominator)
         d = {k: round(v/g) for k, v in element_amount.items()}
         formula = ''
@@ -216,6 +276,11 @@ class MaterialsTextTokenizer(object):
 
     
     def normalized_formula(self, formula, max_denominator=1000):
+        return self.cached('normalized_formula', (formula, max_denominator), lambda: self.normalize_formula(formula, max_denominator))
+
+
+    def normalize_formula(self, formula, max_denominator=1000):
+        from pymatgen.core.composition import Composition, CompositionError
         try:
             formula_dict = Composition(formula).get_el_amt_dict()
             return self.get_ordered_integer_formula(formula_dict, max_denominator)
@@ -225,4 +290,4 @@ class MaterialsTextTokenizer(object):
 
     @staticmethod
     def remove_accent(text):
-        return unidecode.unidecode(text) if len(text) > 1 else text
\ No newline at end of file
+        return unidecode.unidecode(text) if len(text) > 1 else text
\ No newline at end of file
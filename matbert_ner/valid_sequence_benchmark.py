@@ -0,0 +1,90 @@
+import time
+import argparse
+import torch
+from matbert_ner.models.valid_sequence_output import valid_sequence_output
+
+
+def loop_valid_sequence_output(sequence_output, label_ids, attention_mask, valid_mask, device):
+    '''
+    Original per-element loop implementation of valid_sequence_output (baseline for the benchmark and reference for the parity tests)
+        Arguments:
+            sequence_output: Batch of output representation of sequence from BERT
+            label_ids: Batch of sequence labels (may be None)
+            attention_mask: Batch of sequence attention masks
+            valid_mask: Batch of sequence valid masks
+            device: Device used for computation
+        Returns:
+            valid_sequence, valid_label_ids, valid_attention_mask
+    '''
+    batch_size, max_len, feat_dim = sequence_output.shape
+    valid_sequence = torch.zeros(batch_size, max_len, feat_dim, dtype=torch.float32, device=device)
+    if label_ids is not None:
+        valid_label_ids = torch.zeros(batch_size, max_len, dtype=torch.uint8, device=device)
+    else:
+        valid_label_ids = None
+    valid_attention_mask = torch.zeros(batch_size, max_len, dtype=torch.bool, device=device)
+    for i in range(batch_size):
+        k = 0
+        for j in range(max_len):
+            if valid_mask[i][j].item() == 1:
+                valid_sequence[i][k] = sequence_output[i][j]
+                if label_ids is not None:
+                    valid_label_ids[i][k] = label_ids[i][j]
+                valid_attention_mask[i][k] = attention_mask[i][j]
+                k += 1
+    return valid_sequence, valid_label_ids, valid_attention_mask
+
+
+def benchmark(function, inputs, device, repeats):
+    '''
+    Measures the minimum time of a function over repeated calls
+        Arguments:
+            function: valid_sequence_output implementation
+            inputs: Tuple of sequence output, label ids, attention mask, and valid mask
+            device: Computation device
+            repeats: Number of timed calls
+        Returns:
+            Minimum time in seconds
+    '''
+    times = []
+    for _ in range(repeats):
+        if 'cuda' in device:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        function(*inputs, device)
+        if 'cuda' in device:
+            torch.cuda.synchronize()
+        times.append(time.perf_counter()-start)
+    return min(times)
+
+
+def parse_args():
+    '''
+    Parses command-line arguments
+    '''
+    parser = argparse.ArgumentParser(description='benchmark of the vectorized valid_sequence_output against the original loop')
+    parser.add_argument('-bs', '--batch_size', help='number of sequences in the batch',
+                        type=int, default=32)
+    parser.add_argument('-ml', '--max_len', help='padded sequence length',
+                        type=int, default=256)
+    parser.add_argument('-fd', '--feat_dim', help='hidden size of the sequence output',
+                        type=int, default=768)
+    parser.add_argument('-vf', '--valid_fraction', help='fraction of valid (first subtoken) positions',
+                        type=float, default=0.75)
+    parser.add_argument('-dv', '--device', help='computation device (e.g. cpu, cuda)',
+                        type=str, default='cpu')
+    parser.add_argument('-rp', '--repeats', help='number of timed calls (minimum time is reported)',
+                        type=int, default=3)
+    args = parser.parse_args()
+    return args.batch_size, args.max_len, args.feat_dim, args.valid_fraction, args.device, args.repeats
+
+
+if __name__ == '__main__':
+    batch_size, max_len, feat_dim, valid_fraction, device, repeats = parse_args()
+    inputs = (torch.randn(batch_size, max_len, feat_dim, device=device),
+              torch.randint(0, 16, (batch_size, max_len), device=device),
+              torch.ones(batch_size, max_len, dtype=torch.long, device=device),
+              (torch.rand(batch_size, max_len, device=device) < valid_fraction).long())
+    loop_time = benchmark(loop_valid_sequence_output, inputs, device, repeats)
+    vectorized_time = benchmark(valid_sequence_output, inputs, device, repeats)
+    print('loop: {:.4f} s, vectorized: {:.4f} s, speedup: {:.1f}x'.format(loop_time, vectorized_time, loop_time/vectorized_time))
@@ -0,0 +1,33 @@
+import os
+import pytest
+from transformers import BertTokenizerFast
+from matbert_ner.utils.data import NERData
+
+
+# small word-piece vocabulary (every word is a single word-piece unless extended with ##x)
+vocab = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]', 'a', 'b', 'c', 'd', 'gold', 'nano', 'rod', '.', '##x']
+
+
+@pytest.fixture(scope='session')
+def vocab_path(tmp_path_factory):
+    vocab_path = os.path.join(str(tmp_path_factory.mktemp('vocab')), 'vocab.txt')
+    with open(vocab_path, 'w') as f:
+        f.write('\n'.join(vocab))
+    return vocab_path
+
+
+@pytest.fixture(scope='session')
+def tokenizer(vocab_path):
+    return BertTokenizerFast(vocab_file=vocab_path)
+
+
+@pytest.fixture
+def make_ner_data(tokenizer):
+    '''
+    Constructs NERData objects over the small vocabulary for a labeling scheme and a list of raw labels
+    '''
+    def make(scheme, labels=(), **kwargs):
+        ner_data = NERData(None, scheme=scheme, tokenizer=tokenizer, **kwargs)
+        ner_data.get_classes(list(labels))
+        return ner_data
+    return make
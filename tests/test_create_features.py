@@ -0,0 +1,70 @@
+import random
+import pytest
+from transformers import BertTokenizer
+
+
+def loop_create_features(tokenizer, class_dict, sep_dict, data_labeled):
+    '''
+    Original per-word loop implementation of NERData.create_features with the (slow) BERT tokenizer (reference for parity)
+    '''
+    data_feature = {split: [] for split in data_labeled.keys()}
+    for split in data_labeled.keys():
+        for dat in data_labeled[split]:
+            d = {key: dat['id'] if key == 'id' else [] for key in ['id', 'tokens', 'token_ids', 'label_ids', 'valid_mask']}
+            for i in range(len(dat['tokens'])):
+                s = {key: [] for key in ['tokens', 'token_ids', 'label_ids', 'valid_mask']}
+                n_tokens = len(dat['tokens'][i]['text'])
+                for j in range(n_tokens):
+                    word_tokens = tokenizer.tokenize(dat['tokens'][i]['text'][j])
+                    for k, word_token in enumerate(word_tokens):
+                        s['tokens'].append(word_token)
+                        s['token_ids'].append(tokenizer.convert_tokens_to_ids(word_token))
+                        if k == 0:
+                            s['valid_mask'].append(1)
+                            s['label_ids'].append(dat['tokens'][i]['label_ids'][j])
+                        else:
+                            s['valid_mask'].append(0)
+                            s['label_ids'].append(class_dict['O'])
+                    if j == len(dat['tokens'][i]['text'])-1:
+                        s['tokens'].append(sep_dict['text'])
+                        s['token_ids'].append(tokenizer.convert_tokens_to_ids(sep_dict['text']))
+                        s['label_ids'].append(class_dict[sep_dict['label']])
+                        s['valid_mask'].append(1)
+                for key in s.keys():
+                    d[key].append(s[key])
+            data_feature[split].append(d)
+    return data_feature
+
+
+# words with a single word-piece, several word-pieces, unknown words, punctuation, case and accents, and words without word-pieces
+words = ['a', 'b', 'gold', 'nano', 'rod', '.', 'ax', 'axx', 'goldx', 'zzz', 'a.b', 'gold.', 'Gold', 'NANO', 'gòld', 'ñ', '', ' ']
+
+
+def random_entries(rng, labels, n_entries=32):
+    '''
+    Random formatted entries over the word list (including empty sentences)
+    '''
+    entries = []
+    for id in range(n_entries):
+        sentences = []
+        for _ in range(rng.randint(1, 4)):
+            length = rng.randint(0, 12)
+            sentences.append({'text': [rng.choice(words) for _ in range(length)], 'annotation': [rng.choice([None, *labels]) for _ in range(length)]})
+        entries.append({'id': id, 'meta': {'doi': id, 'par': 0, 'split': 0}, 'tokens': sentences})
+    return {'main': entries}
+
+
+@pytest.mark.parametrize('scheme', ['IOB1', 'IOB2', 'IOBES'])
+def test_create_features_matches_loop(make_ner_data, vocab_path, scheme):
+    labels = ['MAT', 'SPL']
+    ner_data = make_ner_data(scheme, labels, keep_strings=True)
+    slow_tokenizer = BertTokenizer(vocab_file=vocab_path)
+    rng = random.Random(0)
+    for _ in range(20):
+        data_labeled = ner_data.label_entries(random_entries(rng, labels))
+        expected = loop_create_features(slow_tokenizer, ner_data.class_dict, ner_data.sep_dict, data_labeled)
+        result = ner_data.create_features(data_labeled, batch_size=16, save_cache=False)
+        for expected_entry, entry in zip(expected['main'], result['main']):
+            assert entry['id'] == expected_entry['id']
+            for key in ['tokens', 'token_ids', 'label_ids', 'valid_mask']:
+                assert entry[key] == expected_entry[key]
@@ -0,0 +1,47 @@
+import random
+import pytest
+import torch
+from transformers import BertConfig
+from matbert_ner.models.bert_model import BERTNER
+
+
+def random_entries(rng, annotations, n_entries=64):
+    '''
+    Random formatted entries with runs of annotations (without skipped tokens, which drop labels after labeling)
+    '''
+    entries = []
+    for id in range(n_entries):
+        sentences = []
+        for _ in range(rng.randint(1, 4)):
+            text, annotation = [], []
+            length = rng.randint(1, 12)
+            while len(text) < length:
+                label = rng.choice(annotations)
+                run = rng.randint(1, 4)
+                text.extend(rng.choice(['a', 'b', 'c']) for _ in range(run))
+                annotation.extend(run*[label])
+            sentences.append({'text': text, 'annotation': annotation})
+        entries.append({'id': id, 'meta': {'doi': id, 'par': 0, 'split': 0}, 'tokens': sentences})
+    return {'main': entries}
+
+
+@pytest.mark.parametrize('scheme', ['IOB1', 'IOB2', 'IOBES'])
+def test_crf_allows_labeled_sequences(make_ner_data, tokenizer, scheme):
+    labels = ['MAT', 'SPL']
+    ner_data = make_ner_data(scheme, labels)
+    config = BertConfig(vocab_size=tokenizer.vocab_size, hidden_size=8, num_hidden_layers=1, num_attention_heads=1, intermediate_size=8, max_position_embeddings=ner_data.token_limit)
+    model = BERTNER(None, ner_data.classes, scheme, seed=0, config=config, tokenizer=tokenizer, pretrained=False)
+    crf = model.crf
+    # every transition of the labeled sequences (with the [CLS] and [SEP] labels) is allowed by the scheme
+    outside_id = ner_data.class_dict['O']
+    data_labeled = ner_data.label_entries(random_entries(random.Random(0), [None, None, *labels]))
+    for entry in data_labeled['main']:
+        for sent in entry['tokens']:
+            label_ids = [outside_id]+sent['label_ids']+[outside_id]
+            assert crf.allowed_start[label_ids[0]] and crf.allowed_end[label_ids[-1]]
+            assert all(crf.allowed_transitions[a, b] for a, b in zip(label_ids, label_ids[1:]))
+    # the model predicts sequences of the scheme
+    input_ids = torch.tensor([tokenizer.convert_tokens_to_ids(['[CLS]', 'gold', 'nano', 'rod', '[SEP]'])])
+    with torch.no_grad():
+        prediction_ids = model.forward(input_ids=input_ids, attention_mask=torch.ones_like(input_ids), valid_mask=torch.ones_like(input_ids))
+    assert prediction_ids.shape == input_ids.shape
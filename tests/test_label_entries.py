@@ -0,0 +1,123 @@
+import random
+import pytest
+
+
+skipped = ['̄', '̊']
+
+
+def loop_label_entries(scheme, invalid_annotations, data_formatted):
+    '''
+    Original per-token loop implementation of NERData.label_entries (labels as strings, reference for parity)
+    '''
+    data_labeled = {split: [] for split in data_formatted.keys()}
+    for split in data_formatted.keys():
+        for dat in data_formatted[split]:
+            d = {'id': dat['id'], 'meta': dat['meta'], 'tokens': []}
+            for sent in dat['tokens']:
+                s = {key: [] for key in ['text', 'label']}
+                for i in range(len(sent['text'])):
+                    if sent['text'][i] in skipped:
+                        continue
+                    s['text'].append(sent['text'][i])
+                    if scheme == 'IOB1':
+                        if sent['annotation'][i] in [None, *invalid_annotations]:
+                            s['label'].append('O')
+                        elif i == 0 and len(sent['annotation']) > 1:
+                            if sent['annotation'][i+1] == sent['annotation'][i]:
+                                s['label'].append('B-'+sent['annotation'][i])
+                            else:
+                                s['label'].append('I-'+sent['annotation'][i])
+                        elif i == 0 and len(sent['annotation']) == 1:
+                            s['label'].append('I-'+sent['annotation'][i])
+                        elif i > 0:
+                            if sent['annotation'][i-1] == sent['annotation'][i]:
+                                s['label'].append('I-'+sent['annotation'][i])
+                            else:
+                                # the original loop raised an IndexError here when an entity started on the last token (labeled as inside)
+                                if i < len(sent['annotation'])-1 and sent['annotation'][i+1] == sent['annotation'][i]:
+                                    s['label'].append('B-'+sent['annotation'][i])
+                                else:
+                                    s['label'].append('I-'+sent['annotation'][i])
+                    elif scheme == 'IOB2':
+                        if sent['annotation'][i] in [None, *invalid_annotations]:
+                            s['label'].append('O')
+                        elif i == 0:
+                            s['label'].append('B-'+sent['annotation'][i])
+                        elif i > 0:
+                            if sent['annotation'][i-1] == sent['annotation'][i]:
+                                s['label'].append('I-'+sent['annotation'][i])
+                            else:
+                                s['label'].append('B-'+sent['annotation'][i])
+                    elif scheme == 'IOBES':
+                        if sent['annotation'][i] in [None, *invalid_annotations]:
+                            s['label'].append('O')
+                        elif i == 0 and len(sent['annotation']) == 1:
+                            s['label'].append('S-'+sent['annotation'][i])
+                        elif i == 0 and len(sent['annotation']) > 1:
+                            if sent['annotation'][i+1] == sent['annotation'][i]:
+                                s['label'].append('B-'+sent['annotation'][i])
+                            else:
+                                s['label'].append('S-'+sent['annotation'][i])
+                        elif i > 0 and i < len(sent['annotation'])-1:
+                            if sent['annotation'][i-1] != sent['annotation'][i] and sent['annotation'][i+1] == sent['annotation'][i]:
+                                s['label'].append('B-'+sent['annotation'][i])
+                            elif sent['annotation'][i-1] == sent['annotation'][i] and sent['annotation'][i+1] == sent['annotation'][i]:
+                                s['label'].append('I-'+sent['annotation'][i])
+                            elif sent['annotation'][i-1] == sent['annotation'][i] and sent['annotation'][i+1] != sent['annotation'][i]:
+                                s['label'].append('E-'+sent['annotation'][i])
+                            elif sent['annotation'][i-1] != sent['annotation'][i] and sent['annotation'][i+1] != sent['annotation'][i]:
+                                s['label'].append('S-'+sent['annotation'][i])
+                        elif i == len(sent['annotation'])-1:
+                            if sent['annotation'][i-1] == sent['annotation'][i]:
+                                s['label'].append('E-'+sent['annotation'][i])
+                            if sent['annotation'][i-1] != sent['annotation'][i]:
+                                s['label'].append('S-'+sent['annotation'][i])
+                d['tokens'].append(s)
+            data_labeled[split].append(d)
+    return data_labeled
+
+
+def random_entries(rng, annotations, n_entries=8):
+    '''
+    Random formatted entries with runs of annotations (including invalid annotations, skipped tokens, and empty sentences)
+    '''
+    entries = []
+    for id in range(n_entries):
+        sentences = []
+        for _ in range(rng.randint(1, 4)):
+            text, annotation = [], []
+            length = rng.randint(0, 12)
+            while len(text) < length:
+                label = rng.choice(annotations)
+                for _ in range(rng.randint(1, 4)):
+                    text.append(rng.choice(['a', 'b', 'c']+skipped) if rng.random() < 0.1 else rng.choice(['a', 'b', 'c']))
+                    annotation.append(label)
+            sentences.append({'text': text, 'annotation': annotation})
+        entries.append({'id': id, 'meta': {'doi': id, 'par': 0, 'split': 0}, 'tokens': sentences})
+    return {'main': entries}
+
+
+@pytest.mark.parametrize('scheme', ['IOB1', 'IOB2', 'IOBES'])
+def test_label_entries_matches_loop(make_ner_data, scheme):
+    labels = ['MAT', 'SPL', 'DSC']
+    ner_data = make_ner_data(scheme, labels)
+    annotations = [None, None, *labels, *ner_data.invalid_annotations]
+    rng = random.Random(0)
+    for _ in range(300):
+        data_formatted = random_entries(rng, annotations)
+        expected = loop_label_entries(scheme, ner_data.invalid_annotations, data_formatted)
+        result = ner_data.label_entries(data_formatted)
+        for expected_entry, entry in zip(expected['main'], result['main']):
+            for expected_sent, sent in zip(expected_entry['tokens'], entry['tokens']):
+                assert sent['text'] == expected_sent['text']
+                assert sent['label_ids'] == [ner_data.class_dict[label] for label in expected_sent['label']]
+
+
+def test_label_entries_iob1_entity_on_last_token(make_ner_data):
+    ner_data = make_ner_data('IOB1', ['MAT'])
+    data_formatted = {'main': [{'id': 0, 'meta': {'doi': 0, 'par': 0, 'split': 0},
+                                'tokens': [{'text': ['a', 'b', 'gold'], 'annotation': [None, None, 'MAT']},
+                                           {'text': ['a', 'gold', 'nano'], 'annotation': ['MAT', 'MAT', 'MAT']},
+                                           {'text': ['gold'], 'annotation': ['MAT']}]}]}
+    labels = [[ner_data.classes[label_id] for label_id in sent['label_ids']] for sent in ner_data.label_entries(data_formatted)['main'][0]['tokens']]
+    assert labels == [['O', 'O', 'I-MAT'], ['B-MAT', 'I-MAT', 'I-MAT'], ['I-MAT']]
@@ -0,0 +1,33 @@
+import gc
+import pickle
+import weakref
+from matbert_ner.utils.tokenizer import MaterialsTextTokenizer
+
+
+def test_formula_caches_are_bounded_and_least_recently_used():
+    tokenizer = MaterialsTextTokenizer('phraser.pkl', cache_size=2)
+    calls = []
+    def compute(key):
+        calls.append(key)
+        return key.lower()
+    for key in ['A', 'B', 'A', 'C', 'A', 'B']:
+        assert tokenizer.cached('normalized_formula', key, lambda: compute(key)) == key.lower()
+    # B was evicted by C (A was used more recently), and C by B
+    assert calls == ['A', 'B', 'C', 'B']
+    stats = tokenizer.cache_stats()['normalized_formula']
+    assert (stats['hits'], stats['misses'], stats['size'], stats['max_size']) == (2, 4, 2, 2)
+
+
+def test_tokenizer_is_picklable_without_reference_cycles():
+    tokenizer = MaterialsTextTokenizer('phraser.pkl')
+    tokenizer.cached('is_element', 'Au', lambda: True)
+    copy = pickle.loads(pickle.dumps(tokenizer))
+    assert copy.cached('is_element', 'Au', lambda: False)
+    # the tokenizer is freed by reference counting alone
+    gc.disable()
+    try:
+        reference = weakref.ref(tokenizer)
+        del tokenizer
+        assert reference() is None
+    finally:
+        gc.enable()
@@ -0,0 +1,28 @@
+import numpy as np
+from matbert_ner.utils.cache import FeatureCache
+
+
+def many_sentence_entries(n_sentences=300):
+    '''
+    Formatted entries with more sentences than fit in an unsigned byte
+    '''
+    sentences = [{'text': ['gold', 'a'], 'annotation': ['MAT', None]} for _ in range(n_sentences)]
+    return {'main': [{'id': 0, 'meta': {'doi': 0, 'par': 0, 'split': 0}, 'tokens': sentences},
+                     {'id': 1, 'meta': {'doi': 1, 'par': 0, 'split': 0}, 'tokens': sentences[:2]}]}
+
+
+def test_part_indices_above_255(make_ner_data, tmp_path):
+    ner_data = make_ner_data('IOB2', ['MAT'])
+    data_labeled = ner_data.label_entries(many_sentence_entries())
+    features = ner_data.split_entries_merge_sentences(ner_data.create_features(data_labeled, save_cache=False), True)['main']
+    expected_pts = list(range(300))+[0, 1]
+    dataset = ner_data.create_dataset(features)
+    assert dataset.pts.tolist() == expected_pts
+    # the cached features keep the part indices as well
+    cache = FeatureCache(str(tmp_path), 'key')
+    cache.save(ner_data.classes, data_labeled['main'], features)
+    cache.load()
+    arrays = cache.gather([1, 0])
+    assert arrays['pts'].tolist() == [0, 1]+list(range(300))
+    assert arrays['ids'].tolist() == [1, 1]+[0]*300
+    assert np.array_equal(arrays['offsets'][-1:], [sum(len(d['token_ids']) for d in features)])
@@ -0,0 +1,29 @@
+from transformers import BertConfig
+from matbert_ner.models.bert_model import BERTNER
+from matbert_ner.models.model_package import save_package
+from matbert_ner.predict import Predictor
+
+
+def test_predictor_keeps_duplicate_inputs(make_ner_data, tokenizer, tmp_path):
+    ner_data = make_ner_data('IOBES', ['MAT'])
+    config = BertConfig(vocab_size=tokenizer.vocab_size, hidden_size=8, num_hidden_layers=1, num_attention_heads=1, intermediate_size=8, max_position_embeddings=ner_data.token_limit)
+    package_path = str(tmp_path/'package.safetensors')
+    save_package(package_path, BERTNER(None, ner_data.classes, 'IOBES', seed=0, config=config, tokenizer=tokenizer, pretrained=False), tokenizer)
+    # entries sharing a doi, sharing their contents, or both
+    texts = [{'doi': 'x', 'tokens': [['gold', 'nano', 'rod']]},
+             {'doi': 'x', 'tokens': [['a', 'b']]},
+             {'doi': 'x', 'tokens': [['a', 'b']]},
+             {'meta': {'doi': 'y', 'par': 0}, 'tokens': [['c'], ['d', '.']]},
+             {'meta': {'doi': 'y', 'par': 0}, 'tokens': [['c'], ['d', '.']]},
+             {'tokens': [['a', 'b']]},
+             {'tokens': [['a', 'b']]}]
+    with Predictor(package_path=package_path, seed=0) as predictor:
+        annotations = predictor.predict(texts, return_full_dict=True)
+        assert len(annotations) == len(texts)
+        for text, annotation in zip(texts, annotations):
+            assert [[token['text'] for token in sentence] for sentence in annotation['tokens']] == text['tokens']
+        # chunks predict the same as a single batch
+        assert list(predictor.predict_iter(texts, return_full_dict=True, chunk_size=2)) == annotations
+        assert [annotation['id'] for annotation in annotations] == list(range(len(texts)))
+        # entries without identifiers are identified by their positions
+        assert [annotation['meta']['doi'] for annotation in annotations[-2:]] == [len(texts)-2, len(texts)-1]
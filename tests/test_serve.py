@@ -0,0 +1,67 @@
+import json
+import asyncio
+import threading
+from matbert_ner.serve import MicroBatcher, NERServer
+
+
+class FakePredictor(object):
+    '''
+    Stand-in for Predictor that annotates every word of an entry as O and reports each entry as its own entity
+    '''
+    def __init__(self):
+        self.batches = []
+        self.lock = threading.Lock()
+
+    def predict_batch(self, texts, return_full_dict=False):
+        with self.lock:
+            self.batches.append(list(texts))
+        return [{'tokens': [[{'text': word, 'annotation': 'O'} for word in text.split()]], 'entities': {'MAT': [text]}} for text in texts]
+
+
+async def request(port, method, path, body=None, headers=()):
+    '''
+    Sends a single HTTP request (closing the connection) and returns the status code and the JSON response
+    '''
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    body = json.dumps(body).encode('utf-8') if body is not None else b''
+    head = ['{} {} HTTP/1.1'.format(method, path), 'Host: localhost', 'Connection: close', *headers]
+    if not any(header.lower().startswith('content-length') for header in headers):
+        head.append('Content-Length: {}'.format(len(body)))
+    writer.write(('\r\n'.join(head)+'\r\n\r\n').encode('latin-1')+body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    status_line, _, rest = response.partition(b'\r\n')
+    return int(status_line.split()[1]), json.loads(rest.partition(b'\r\n\r\n')[2].decode('utf-8'))
+
+
+async def exercise_server():
+    predictor = FakePredictor()
+    server = NERServer(MicroBatcher(predictor, max_wait=0.05), port=0)
+    await server.start()
+    try:
+        # concurrent requests are coalesced and each gets the predictions of its own entries
+        texts = [['text {} {}'.format(i, j) for j in range(i % 3+1)] for i in range(12)]
+        responses = await asyncio.gather(*[request(server.port, 'POST', '/predict', {'texts': request_texts}) for request_texts in texts])
+        for request_texts, (status, content) in zip(texts, responses):
+            assert status == 200
+            assert [prediction['entities']['MAT'] for prediction in content['predictions']] == [[text] for text in request_texts]
+        assert len(predictor.batches) < len(texts)
+        status, content = await request(server.port, 'GET', '/health')
+        assert status == 200 and content['status'] == 'ok'
+        assert content['metrics']['requests'] == len(texts)
+        assert content['metrics']['entries'] == sum(len(request_texts) for request_texts in texts)
+        # malformed requests
+        assert (await request(server.port, 'POST', '/predict', {'texts': 'a'}))[0] == 400
+        assert (await request(server.port, 'POST', '/predict', {'texts': [1]}))[0] == 400
+        assert (await request(server.port, 'POST', '/predict', headers=['Content-Length: abc']))[0] == 400
+        assert (await request(server.port, 'POST', '/predict', headers=['Content-Length: -1']))[0] == 400
+        assert (await request(server.port, 'GET', '/unknown'))[0] == 404
+        assert (await request(server.port, 'GET', '/predict'))[0] == 405
+        assert (await request(server.port, 'POST', '/health'))[0] == 405
+    finally:
+        await server.stop()
+
+
+def test_server():
+    asyncio.run(exercise_server())
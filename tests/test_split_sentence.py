@@ -0,0 +1,64 @@
+import pytest
+from transformers import BertConfig
+from matbert_ner.models.bert_model import BERTNER
+from matbert_ner.models.model_trainer import NERTrainer
+
+
+def long_entries():
+    '''
+    Formatted entries with a sentence above the token limit (with an entity straddling the middle, where an entity-blind split would break it) between short sentences
+    '''
+    text = ['a' if i % 7 else 'ax' for i in range(600)]
+    annotation = ['MAT' if 280 <= i < 320 else None for i in range(600)]
+    sentences = [{'text': ['b', 'gold', 'c'], 'annotation': [None, 'MAT', None]},
+                 {'text': text, 'annotation': annotation},
+                 {'text': ['nano', 'rod', '.'], 'annotation': ['MAT', 'MAT', None]}]
+    return {'main': [{'id': 0, 'meta': {'doi': 0, 'par': 0, 'split': 0}, 'tokens': sentences}]}
+
+
+@pytest.mark.parametrize('scheme', ['IOB1', 'IOB2', 'IOBES'])
+def test_split_long_sentence(make_ner_data, tokenizer, scheme):
+    ner_data = make_ner_data(scheme, ['MAT'])
+    data_formatted = long_entries()
+    parts = ner_data.split_entries_merge_sentences(ner_data.create_features(ner_data.label_entries(data_formatted), save_cache=False), False)['main']
+    assert len(parts) > 1
+    cls_id, sep_id = tokenizer.convert_tokens_to_ids(['[CLS]', '[SEP]'])
+    outside_id = ner_data.class_dict['O']
+    for part in parts:
+        assert len(part['token_ids']) <= ner_data.token_limit
+        assert len(part['token_ids']) == len(part['label_ids']) == len(part['valid_mask'])
+        # every part is closed by a valid [SEP] token labeled O
+        assert part['token_ids'][0] == cls_id
+        assert part['token_ids'][-1] == sep_id
+        assert part['label_ids'][-1] == outside_id
+        assert part['valid_mask'][-1] == 1
+    # the entity straddling the middle of the long sentence is kept in a single part
+    runs = []
+    for part in parts:
+        run = 0
+        for label_id, valid in zip(part['label_ids'], part['valid_mask']):
+            if valid:
+                if label_id != outside_id:
+                    run += 1
+                elif run > 0:
+                    runs.append(run)
+                    run = 0
+    assert sorted(runs) == [1, 2, 40]
+
+    # restore the entry from the parts with the gold labels as predictions (parts in reverse order)
+    config = BertConfig(vocab_size=tokenizer.vocab_size, hidden_size=8, num_hidden_layers=1, num_attention_heads=1, intermediate_size=8, max_position_embeddings=ner_data.token_limit)
+    trainer = NERTrainer(BERTNER(None, ner_data.classes, scheme, seed=0, config=config, tokenizer=tokenizer, pretrained=False), 'cpu')
+    prediction_results = {'ids': [part['id'] for part in parts[::-1]], 'pts': [part['pt'] for part in parts[::-1]],
+                          'input_ids': [part['token_ids'] for part in parts[::-1]], 'attention_mask': [[1]*len(part['token_ids']) for part in parts[::-1]],
+                          'valid_mask': [part['valid_mask'] for part in parts[::-1]],
+                          'prediction_ids': [[l for l, v in zip(part['label_ids'], part['valid_mask']) if v] for part in parts[::-1]]}
+    prediction_results = trainer.merge_split_entries(prediction_results)
+    annotations = trainer.process_ids(prediction_results['ids'], prediction_results['input_ids'], prediction_results['attention_mask'],
+                                      prediction_results['valid_mask'], prediction_results['prediction_ids'])
+    restored = trainer.restore_original_data(annotations, data_formatted['main'])
+    assert len(restored) == 1
+    original_sentences = data_formatted['main'][0]['tokens']
+    assert len(restored[0]['tokens']) == len(original_sentences)
+    for original_sentence, sentence in zip(original_sentences, restored[0]['tokens']):
+        assert [token['text'] for token in sentence] == original_sentence['text']
+        assert [token['annotation'] for token in sentence] == [annotation or 'O' for annotation in original_sentence['annotation']]
@@ -0,0 +1,37 @@
+import time
+from matbert_ner.utils.cache import TokenizationCache
+
+
+def total_bytes(cache):
+    return cache.connect().execute('SELECT COALESCE(SUM(size), 0) FROM sentences').fetchone()[0]
+
+
+def test_running_total_tracks_inserts_replacements_and_evictions(tmp_path):
+    cache = TokenizationCache(str(tmp_path/'tokenization.sqlite'), 'signature', max_bytes=10**6)
+    cache.put_many({'a': [['a']], 'b': [['b', 'c']]})
+    cache.put_many({'a': [['a', 'much', 'longer', 'replacement']]})
+    assert cache.stats()['bytes'] == total_bytes(cache)
+    assert cache.stats()['size'] == 2
+    cache.max_bytes = 0
+    cache.evict()
+    assert cache.stats()['bytes'] == total_bytes(cache) == 0
+
+
+def test_running_total_initialized_from_existing_database(tmp_path):
+    path = str(tmp_path/'tokenization.sqlite')
+    TokenizationCache(path, 'signature').put_many({'a': [['a']], 'b': [['b']]})
+    cache = TokenizationCache(path, 'signature')
+    assert cache.stats()['bytes'] == total_bytes(cache) > 0
+
+
+def test_eviction_is_least_recently_used(tmp_path):
+    cache = TokenizationCache(str(tmp_path/'tokenization.sqlite'), 'signature', max_bytes=10**6)
+    for text in ['first', 'second', 'third']:
+        cache.put_many({text: [[text]]})
+        time.sleep(0.01)
+    # a hit on the oldest entry makes the second entry the least recently used
+    assert cache.get_many(['first']) == {'first': [['first']]}
+    size = total_bytes(cache)
+    cache.max_bytes = size-1
+    cache.evict()
+    assert set(cache.get_many(['first', 'second', 'third'])) == {'first', 'third'}
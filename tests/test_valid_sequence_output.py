@@ -0,0 +1,37 @@
+import torch
+from matbert_ner.models.valid_sequence_output import valid_sequence_output
+from matbert_ner.valid_sequence_benchmark import loop_valid_sequence_output
+
+
+def random_inputs(generator, batch_size=8, max_len=24, feat_dim=5, n_classes=7):
+    '''
+    Random batch with random valid masks, including an all-zero and an all-one row
+    '''
+    sequence_output = torch.randn(batch_size, max_len, feat_dim, generator=generator)
+    label_ids = torch.randint(0, n_classes, (batch_size, max_len), generator=generator)
+    attention_mask = torch.randint(0, 2, (batch_size, max_len), generator=generator)
+    valid_mask = torch.randint(0, 2, (batch_size, max_len), generator=generator)
+    valid_mask[0] = 0
+    valid_mask[1] = 1
+    return sequence_output, label_ids, attention_mask, valid_mask
+
+
+def test_parity_with_loop():
+    generator = torch.Generator().manual_seed(0)
+    for _ in range(50):
+        sequence_output, label_ids, attention_mask, valid_mask = random_inputs(generator)
+        expected = loop_valid_sequence_output(sequence_output, label_ids, attention_mask, valid_mask, 'cpu')
+        result = valid_sequence_output(sequence_output, label_ids, attention_mask, valid_mask, 'cpu')
+        for r, e in zip(result, expected):
+            assert r.dtype == e.dtype
+            assert torch.equal(r, e)
+
+
+def test_parity_without_labels():
+    generator = torch.Generator().manual_seed(1)
+    sequence_output, _, attention_mask, valid_mask = random_inputs(generator)
+    expected = loop_valid_sequence_output(sequence_output, None, attention_mask, valid_mask, 'cpu')
+    result = valid_sequence_output(sequence_output, None, attention_mask, valid_mask, 'cpu')
+    assert result[1] is None and expected[1] is None
+    assert torch.equal(result[0], expected[0])
+    assert torch.equal(result[2], expected[2])